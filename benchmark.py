@@ -0,0 +1,262 @@
+"""Benchmark offline untuk jalur panas bot: scan grup, pelacakan pasif dan save_user_data.
+
+Tidak butuh jaringan maupun MongoDB: Telegram diganti FakeClient yang
+menghasilkan peserta `User` sintetis, dan penyimpanan memakai SQLiteDataStore.
+
+Contoh:
+    python benchmark.py --users 100000 --groups 20 --overlap 0.3 --churn 0.05 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+
+os.environ.setdefault('TG_API_ID', '0')
+os.environ.setdefault('TG_API_HASH', 'benchmark')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from telethon import utils
+from telethon.tl.types import User
+
+from data_store import create_data_store
+from dialog_snapshot import normalize_group_id
+from main import TeleScrapeTracker
+
+DB_PRIMITIVES = ['_fetch_last_entries', '_fetch_history', '_write_entry', '_write_history_entries', '_write_memberships']
+
+
+class SyntheticPopulation:
+    """User dan grup sintetis dengan tingkat overlap grup dan perubahan identitas yang bisa diatur."""
+
+    def __init__(self, users: int, groups: int, overlap: float, seed: int = 1):
+        self.rng = random.Random(seed)
+        self.versions = {}
+        self.groups = {}
+        group_size = max(1, int(users / (1 + (groups - 1) * (1 - overlap))))
+        next_id, assigned = 1, []
+        for g in range(groups):
+            shared = self.rng.sample(assigned, min(len(assigned), int(group_size * overlap))) if assigned else []
+            fresh_count = min(group_size - len(shared), users - len(self.versions))
+            fresh = list(range(next_id, next_id + max(0, fresh_count)))
+            next_id += len(fresh)
+            for uid in fresh:
+                self.versions[uid] = 0
+            assigned.extend(fresh)
+            self.groups[normalize_group_id(1000000 + g)] = shared + fresh
+
+    @property
+    def user_ids(self):
+        return list(self.versions)
+
+    def user(self, uid: int) -> User:
+        version = self.versions[uid]
+        return User(id=uid, first_name=f"User{uid}", last_name=f"v{version}" if version else None, username=f"user{uid}_{version}", bot=False)
+
+    def churn(self, rate: float):
+        changed = self.rng.sample(self.user_ids, int(len(self.versions) * rate))
+        for uid in changed:
+            self.versions[uid] += 1
+        return len(changed)
+
+
+class FakeChat:
+    def __init__(self, chat_id: int, members: list):
+        self.id = utils.resolve_id(chat_id)[0]
+        self.title = f"Bench Group {chat_id}"
+        self.members = members
+
+
+class FakeMessage:
+    async def edit(self, *args, **kwargs):
+        pass
+
+
+class FakeEvent:
+    def __init__(self, sender: User, chat_id: int):
+        self.sender_id = sender.id
+        self.chat_id = int(chat_id)
+        self.is_private = False
+        self.is_group = True
+        self.is_channel = False
+        self.sender = sender
+
+    async def get_sender(self):
+        return self.sender
+
+
+class FakeClient:
+    """Pengganti TelegramClient: hanya yang dipakai jalur scan dan pasif."""
+
+    def __init__(self, population: SyntheticPopulation, page_latency: float = 0.0):
+        self.population = population
+        self.page_latency = page_latency
+
+    def add_event_handler(self, *args, **kwargs):
+        pass
+
+    async def iter_participants(self, chat, search=None):
+        for i, uid in enumerate(chat.members):
+            if i % 200 == 0:
+                # Satu "halaman" GetParticipants; latensi jaringan opsional.
+                await asyncio.sleep(self.page_latency)
+            yield self.population.user(uid)
+
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Instrumentation:
+    """Menghitung panggilan primitif database dan latensi update_user_history_batch."""
+
+    def __init__(self, data_store):
+        self.ops = {name: 0 for name in DB_PRIMITIVES}
+        self.batch_latencies = []
+        for name in DB_PRIMITIVES:
+            setattr(data_store, name, self._count(name, getattr(data_store, name)))
+        data_store.update_user_history_batch = self._time_batch(data_store.update_user_history_batch)
+
+    def _count(self, name, fn):
+        async def wrapper(*args, **kwargs):
+            self.ops[name] += 1
+            return await fn(*args, **kwargs)
+        return wrapper
+
+    def _time_batch(self, fn):
+        async def wrapper(batch):
+            started = time.perf_counter()
+            try:
+                return await fn(batch)
+            finally:
+                self.batch_latencies.append(time.perf_counter() - started)
+        return wrapper
+
+    def reset(self):
+        self.ops = {name: 0 for name in self.ops}
+        self.batch_latencies = []
+
+    def report(self, name: str, units: int, elapsed: float, unit: str):
+        """`unit` menamai apa yang dihitung fase ini (peserta scan, pesan, atau user)."""
+        total_ops = sum(self.ops.values())
+        result = {
+            'phase': name,
+            'unit': unit,
+            'units': units,
+            'seconds': round(elapsed, 4),
+            'units_per_sec': round(units / elapsed, 1) if elapsed else None,
+            'db_ops': total_ops,
+            'db_ops_per_unit': round(total_ops / units, 4) if units else None,
+            'db_ops_breakdown': dict(self.ops),
+            'batches': len(self.batch_latencies),
+            'batch_latency_p50_ms': round(percentile(self.batch_latencies, 50) * 1000, 3) if self.batch_latencies else None,
+            'batch_latency_p99_ms': round(percentile(self.batch_latencies, 99) * 1000, 3) if self.batch_latencies else None,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        print(f"📈 [Bench] {name}: {units} {unit} in {result['seconds']}s "
+              f"({result['units_per_sec']}/s), {result['db_ops_per_unit']} DB ops/{unit.rstrip('s')}, "
+              f"batch p50/p99 {result['batch_latency_p50_ms']}/{result['batch_latency_p99_ms']}ms, RSS {result['peak_rss_mb']}MB")
+        return result
+
+
+async def run_benchmark(args):
+    population = SyntheticPopulation(args.users, args.groups, args.overlap, args.seed)
+    client = FakeClient(population, args.page_latency_ms / 1000)
+    data_store = create_data_store('sqlite', sqlite_path=args.db, cache_size=args.cache_size)
+    await data_store.ensure_indexes()
+    tracker = TeleScrapeTracker(client=client, data_store=data_store)
+    tracker.my_id = 0
+    tracker.BATCH_SIZE = args.batch_size
+    tracker.completed_scan_group_ids = set(population.groups)
+    instrumentation = Instrumentation(data_store)
+    chats = [FakeChat(gid, members) for gid, members in population.groups.items()]
+    results = []
+
+    async def scan_all(phase):
+        instrumentation.reset()
+        started = time.perf_counter()
+        # Yang dihitung adalah baris peserta per grup: user di beberapa grup terhitung lebih dari sekali.
+        processed = 0
+        for chat in chats:
+            await tracker._direct_scan_group(FakeMessage(), chat, normalize_group_id(chat.id), len(chat.members), chat.title)
+            processed += len(chat.members)
+        results.append(instrumentation.report(phase, processed, time.perf_counter() - started, 'participants'))
+
+    await scan_all('scan_initial')
+    population.churn(args.churn)
+    await scan_all('scan_rescan_after_churn')
+
+    # Pelacakan pasif: pesan dari user acak di grup acak, dengan perubahan identitas sesuai churn.
+    instrumentation.reset()
+    rng = random.Random(args.seed + 1)
+    group_ids = list(population.groups)
+    tracker.passive_buffer.start()
+    started = time.perf_counter()
+    for _ in range(args.messages):
+        gid = rng.choice(group_ids)
+        uid = rng.choice(population.groups[gid])
+        if rng.random() < args.churn:
+            population.versions[uid] += 1
+        await tracker.handle_passive_tracking(FakeEvent(population.user(uid), gid))
+        # Beri kesempatan flusher berjalan, seperti saat event datang dari jaringan.
+        await asyncio.sleep(0)
+    await tracker.passive_buffer.close()
+    results.append(instrumentation.report('passive_tracking', args.messages, time.perf_counter() - started, 'messages'))
+
+    # save_user_data satu per satu (jalur /hisz dan /scan_user).
+    instrumentation.reset()
+    sample = rng.sample(population.user_ids, min(args.single_users, len(population.versions)))
+    started = time.perf_counter()
+    for uid in sample:
+        await tracker.save_user_data(population.user(uid), active_chat_id=group_ids[0])
+    results.append(instrumentation.report('save_user_data', len(sample), time.perf_counter() - started, 'users'))
+
+    await data_store.close()
+    tracker.log_listener.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for scan and passive-tracking hot paths.")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--overlap', type=float, default=0.2, help="Fraksi anggota grup yang juga ada di grup lain.")
+    parser.add_argument('--churn', type=float, default=0.05, help="Fraksi user yang berganti identitas.")
+    parser.add_argument('--messages', type=int, default=20000, help="Jumlah event pesan untuk fase pasif.")
+    parser.add_argument('--single-users', type=int, default=1000, help="Jumlah panggilan save_user_data.")
+    parser.add_argument('--batch-size', type=int, default=300)
+    parser.add_argument('--cache-size', type=int, default=50000)
+    parser.add_argument('--page-latency-ms', type=float, default=0.0, help="Latensi simulasi per 200 peserta.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', default=None, help="File SQLite (default: file sementara).")
+    parser.add_argument('--output', default=None, help="Tulis hasil sebagai JSON ke file ini.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        args.db = args.db or os.path.join(tmp, 'bench.db')
+        results = asyncio.run(run_benchmark(args))
+
+    report = {
+        'timestamp': int(time.time()),
+        'config': {k: v for k, v in vars(args).items() if k not in ('db', 'output')},
+        'results': results,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ [Bench] Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
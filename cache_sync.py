@@ -0,0 +1,113 @@
+import asyncio
+import time
+import uuid
+
+from log import get_logger
+
+log = get_logger('cache.sync')
+
+
+class CacheSync:
+    """Menyebarkan perubahan cache in-memory ke instance bot lain yang memakai database yang sama.
+
+    Setiap perubahan dicatat di log `cache_changes` dengan nomor versi
+    berurutan. Tiap instance hanya membaca versi terakhir per `interval`;
+    jika naik, hanya perubahan setelah versi lokal yang diambil dan
+    diterapkan lewat handler per jenis (`kind`). Celah versi yang tidak
+    terisi selama `gap_grace` detik (log sudah dipangkas atau penulisnya
+    mati) memicu reload penuh.
+    """
+
+    def __init__(self, data_store, interval: float = 5, retention: float = 86400, gap_grace: float = 30, batch_size: int = 1000):
+        self.data_store = data_store
+        self.interval = interval
+        self.retention = retention
+        self.gap_grace = gap_grace
+        self.batch_size = batch_size
+        self.origin = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.applied = 0
+        self.resyncs = 0
+        self._handlers = {}
+        self._gap = None
+        self._last_prune = 0
+        self._task = None
+
+    def subscribe(self, kind: str, apply, reload):
+        """`apply(op, key, value)` menerapkan satu perubahan; `reload()` (coroutine) memuat ulang semuanya dari DB."""
+        self._handlers[kind] = (apply, reload)
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._run())
+            log.info(f"✅ [CacheSync] Started (instance {self.origin}, interval {self.interval}s, version {self.version}).")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def mark_loaded(self):
+        """Dipanggil sebelum cache dimuat dari DB; perubahan setelah titik ini diterapkan ulang (idempoten)."""
+        self.version = await self.data_store.get_cache_version()
+
+    async def publish(self, kind: str, changes: list):
+        """Mencatat [(op, key, value)]. Cache lokal sudah diperbarui pemanggil, jadi kegagalan cukup di-log."""
+        if not changes or self.interval <= 0:
+            return
+        try:
+            await self.data_store.append_cache_changes(self.origin, [{'kind': kind, 'op': op, 'key': key, 'value': value} for op, key, value in changes])
+        except Exception as e:
+            log.warning(f"❗️ [CacheSync] Failed to publish {len(changes)} '{kind}' changes: {e}")
+
+    async def _apply(self, change):
+        handlers = self._handlers.get(change['kind'])
+        if handlers is None or change['origin'] == self.origin:
+            return
+        apply, reload = handlers
+        if change['op'] == 'reload':
+            await reload()
+        else:
+            apply(change['op'], change['key'], change['value'])
+        self.applied += 1
+
+    async def poll(self):
+        latest = await self.data_store.get_cache_version()
+        while self.version < latest:
+            progressed = False
+            for change in await self.data_store.get_cache_changes(self.version, self.batch_size):
+                if change['version'] != self.version + 1:
+                    break
+                await self._apply(change)
+                self.version = change['version']
+                progressed = True
+            if not progressed:
+                break
+        if self.version >= latest:
+            self._gap = None
+            return
+        # Versi berikutnya belum ada di log: penulisnya mungkin masih menulis, jadi ditunggu sebentar.
+        now = time.monotonic()
+        if self._gap is None or self._gap[0] != self.version:
+            self._gap = (self.version, now)
+        elif now - self._gap[1] >= self.gap_grace:
+            await self._resync(latest)
+
+    async def _resync(self, latest: int):
+        log.warning(f"❗️ [CacheSync] Change {self.version + 1} is missing, reloading caches (version {self.version} -> {latest}).")
+        self.version, self._gap = latest, None
+        for _, reload in self._handlers.values():
+            await reload()
+        self.resyncs += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+                if time.time() - self._last_prune > 3600:
+                    self._last_prune = time.time()
+                    await self.data_store.prune_cache_changes(self._last_prune - self.retention)
+            except Exception as e:
+                log.warning(f"❗️ [CacheSync] Poll failed: {e}")
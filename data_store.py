@@ -0,0 +1,501 @@
+import abc
+import asyncio
+import inspect
+import time
+
+from dialog_snapshot import normalize_group_id
+from identity_cache import IdentityCache
+from metrics import timed_db_call
+from log import get_logger
+
+log = get_logger('db')
+batch_log = get_logger('db.batch')
+
+
+def build_identity(user_entity) -> dict:
+    """Identitas yang dibandingkan antar entri riwayat: nama lengkap dan username."""
+    full_name = (user_entity.first_name or "") + (" " + (user_entity.last_name or "") if user_entity.last_name else "")
+    return {'full_name': full_name, 'username': user_entity.username}
+
+
+GROUP_LIST_KEYS = ('shared_chats', 'active_chats_snapshot')
+# Field checkpoint scan di scan_status; dihapus semua saat scan selesai atau /clear_checkpoint.
+SCAN_CHECKPOINT_FIELDS = ('filter_index', 'processed', 'total_saved_since_start')
+# Counter statistik: satu dokumen per grup (scope = group_id int) plus satu global.
+GLOBAL_STATS_SCOPE = 'global'
+STATS_FIELDS = ('users', 'members', 'identity_changes', 'memberships')
+
+
+def add_stat(stats: dict, scope, field: str = None, n: int = 1):
+    """Menambah increment ke {scope: {field: n}}. Setiap scope yang ada juga mendapat last_activity saat ditulis."""
+    counters = stats.setdefault(scope, {})
+    if field is not None:
+        counters[field] = counters.get(field, 0) + n
+
+
+def normalize_entry(entry: dict) -> dict:
+    """Salinan entri riwayat dengan daftar grup berupa ID int64 -100 yang unik dan terurut."""
+    entry = dict(entry)
+    for key in GROUP_LIST_KEYS:
+        if key in entry:
+            entry[key] = sorted({normalize_group_id(gid) for gid in entry[key]})
+    return entry
+
+
+def compact_history(history: list) -> list:
+    """Merapikan riwayat sesuai aturan di redmi.md.
+
+    Entri berurutan dengan nama dan username yang sama digabung ke entri
+    pertama (timestamp lama tetap), dan daftar grupnya di-union. Semua
+    daftar grup dinormalisasi lewat normalize_entry.
+    """
+    compacted = []
+    for entry in history:
+        entry = normalize_entry(entry)
+        last = compacted[-1] if compacted else None
+        if last is not None and (last.get('full_name'), last.get('username')) == (entry.get('full_name'), entry.get('username')):
+            for key in GROUP_LIST_KEYS:
+                if key in entry or key in last:
+                    last[key] = sorted(set(last.get(key, [])) | set(entry.get(key, [])))
+            continue
+        compacted.append(entry)
+    return compacted
+
+
+class DataStore(abc.ABC):
+    """Antarmuka penyimpanan yang dipakai TeleScrapeTracker.
+
+    Logika riwayat (kapan membuat entri baru, cache identitas, pencatatan
+    keanggotaan grup) ada di kelas ini, sehingga setiap backend cukup
+    mengimplementasikan operasi baca/tulis dasarnya dan semantik riwayatnya
+    tetap sama.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Setiap coroutine backend otomatis tercatat di metrik db_calls_total/db_call_seconds.
+        for name, fn in list(vars(cls).items()):
+            if inspect.iscoroutinefunction(fn) and (not name.startswith('_') or hasattr(DataStore, name)):
+                setattr(cls, name, timed_db_call(cls.__name__, name, fn))
+
+    def __init__(self, cache_size: int = 50000, cache_ttl: float = 3600, membership_touch_interval: float = 3600, history_limit: int = 20, cache_max_bytes: int = 0):
+        # Jumlah entri riwayat terbaru yang disimpan inline; entri yang lebih lama pindah ke arsip.
+        self.history_limit = max(1, history_limit)
+        self.identity_cache = IdentityCache(cache_size, cache_ttl, cache_max_bytes)
+        # Pasangan (user_id, group_id) yang last_seen-nya baru ditulis; ditulis ulang setelah TTL habis.
+        self.membership_cache = IdentityCache(cache_size, membership_touch_interval)
+        # Coroutine (entries, membership_pairs) untuk batch yang gagal ditulis, mis. RetrySpool.add.
+        self.on_write_failed = None
+
+    # --- Skema & migrasi ---
+
+    @abc.abstractmethod
+    async def ensure_indexes(self):
+        """Menyiapkan skema/index secara idempoten; mengembalikan [(nama, detik)] yang dibangun."""
+
+    async def migrate_current_identity(self):
+        """Mengisi data `current` untuk data lama. Default: tidak ada yang perlu dimigrasi."""
+        return 0
+
+    async def migrate_memberships(self, batch_size: int = 1000):
+        """Memindahkan snapshot grup lama ke penyimpanan memberships. Default: tidak ada."""
+        return 0
+
+    async def migrate_history_archive(self, batch_size: int = 1000):
+        """Melengkapi arsip riwayat dengan entri inline lama sebelum riwayat dipangkas. Default: tidak ada."""
+        return 0
+
+    async def migrate_int_ids(self, batch_size: int = 1000):
+        """Mengubah ID user/grup lama berbentuk string ke int64, per batch dan bisa dilanjutkan.
+        Default: tidak ada yang perlu dimigrasi."""
+        return 0
+
+    async def close(self):
+        pass
+
+    # --- Pemeliharaan ---
+
+    @abc.abstractmethod
+    async def get_job_checkpoint(self, job: str) -> dict:
+        """Checkpoint terakhir job pemeliharaan (dict kosong jika belum pernah jalan)."""
+
+    @abc.abstractmethod
+    async def save_job_checkpoint(self, job: str, checkpoint: dict):
+        pass
+
+    @abc.abstractmethod
+    async def normalize_group_ids(self) -> int:
+        """Menormalkan group_id di status scan, memberships dan judul grup; mengembalikan jumlah baris yang diubah."""
+
+    @abc.abstractmethod
+    async def _compact_histories_after(self, after_user_id: int, batch_size: int):
+        """Menerapkan compact_history ke `batch_size` user berikutnya (urut user_id, None = dari awal).
+
+        Mengembalikan (user_id terakhir atau None jika habis, jumlah dibaca,
+        daftar user_id yang riwayatnya dirapikan, jumlah user yang hanya
+        arsipnya dilengkapi dengan entri inline lama). Tulisan live yang
+        terjadi bersamaan tidak boleh tertimpa.
+        """
+
+    async def run_compaction(self, batch_size: int = 500, pause: float = 0.05, progress=None):
+        """Job pemeliharaan yang bisa dilanjutkan: normalisasi ID grup lalu compact riwayat per batch."""
+        checkpoint = await self.get_job_checkpoint('compaction')
+        # Checkpoint dari versi lama menyimpan user_id sebagai string.
+        after = None if checkpoint.get('after_user_id') is None else int(checkpoint['after_user_id'])
+        scanned, changed, backfilled = (
+            (checkpoint.get('scanned', 0), checkpoint.get('changed', 0), checkpoint.get('backfilled', 0)) if after is not None else (0, 0, 0)
+        )
+        normalized = await self.normalize_group_ids()
+        if after is not None:
+            log.info(f"[DB Compact] Resuming after user {after} ({scanned} users already scanned).")
+        while True:
+            last_user_id, batch_scanned, changed_ids, batch_backfilled = await self._compact_histories_after(after, batch_size)
+            if last_user_id is None:
+                break
+            for uid in changed_ids:
+                self.identity_cache.invalidate(uid)
+            after, scanned, changed, backfilled = last_user_id, scanned + batch_scanned, changed + len(changed_ids), backfilled + batch_backfilled
+            await self.save_job_checkpoint('compaction', {'after_user_id': after, 'scanned': scanned, 'changed': changed, 'backfilled': backfilled})
+            if progress is not None:
+                await progress(scanned, changed)
+            # Beri jeda agar pelacakan live tetap mendapat giliran menulis.
+            await asyncio.sleep(pause)
+        await self.save_job_checkpoint('compaction', {
+            'after_user_id': None, 'scanned': scanned, 'changed': changed, 'backfilled': backfilled, 'completed_at': int(time.time())
+        })
+        log.info(f"✅ [DB Compact] Done: {normalized} group IDs normalized, {changed}/{scanned} user histories compacted, {backfilled} archives backfilled.")
+        return normalized, scanned, changed, backfilled
+
+    # --- Operasi dasar yang wajib diimplementasikan backend ---
+
+    @abc.abstractmethod
+    async def _fetch_last_entries(self, user_ids: list) -> dict:
+        """Mengembalikan {user_id: entri terakhir} untuk user yang sudah ada."""
+
+    @abc.abstractmethod
+    async def _fetch_history(self, user_id: int) -> list:
+        """Mengembalikan riwayat inline user (paling banyak `history_limit` entri terbaru, lama ke baru)."""
+
+    @abc.abstractmethod
+    async def count_archived_history(self, user_id: int, before: int) -> int:
+        """Jumlah entri arsip user dengan timestamp < `before`."""
+
+    @abc.abstractmethod
+    async def get_archived_history(self, user_id: int, before: int, offset: int = 0, limit: int = 30) -> list:
+        """Satu halaman entri arsip dengan timestamp < `before`, terbaru lebih dulu."""
+
+    @abc.abstractmethod
+    async def _write_entry(self, user_id: int, new_entry: dict, is_update: bool, stats: dict = None):
+        """Menambah entri riwayat baru, atau mengganti entri terakhir jika `is_update`."""
+
+    @abc.abstractmethod
+    async def _write_history_entries(self, new_entries: dict, stats: dict = None) -> int:
+        """Menambahkan {user_id: entri baru} dalam satu operasi batch; mengembalikan jumlah user tersimpan.
+
+        `stats` ({scope: {field: increment}}, lihat add_stat) diterapkan bersama penulisan itu.
+        """
+
+    @abc.abstractmethod
+    async def _write_memberships(self, pairs: list, now: int) -> int:
+        """Upsert pasangan (user_id, group_id) beserta counter dari _membership_stats; mengembalikan jumlah keanggotaan baru."""
+
+    @staticmethod
+    def _membership_stats(pairs: list, new_pairs: list) -> dict:
+        stats = {}
+        for _, group_id in pairs:
+            add_stat(stats, group_id)
+        for _, group_id in new_pairs:
+            add_stat(stats, group_id, 'members')
+        if new_pairs:
+            add_stat(stats, GLOBAL_STATS_SCOPE, 'memberships', len(new_pairs))
+        return stats
+
+    @abc.abstractmethod
+    async def get_user_groups(self, user_id: int) -> list:
+        """Daftar group_id tempat user pernah terlihat, terbaru lebih dulu."""
+
+    @abc.abstractmethod
+    def iter_group_members(self, group_id: int, page_size: int = 200):
+        """Reverse lookup: async generator yang menghasilkan user_id per halaman."""
+
+    @abc.abstractmethod
+    def iter_user_documents(self, since: int = None, until: int = None, batch_size: int = 1000):
+        """Async generator: seluruh user sebagai batch {'user_id', 'current', 'history'}, urut user_id.
+
+        Jika `since`/`until` diisi, hanya user yang punya entri riwayat dengan
+        timestamp di rentang [since, until).
+        """
+
+    @abc.abstractmethod
+    async def get_user_documents(self, user_ids: list, since: int = None, until: int = None) -> list:
+        """Dokumen {'user_id', 'current', 'history'} untuk `user_ids`, dengan filter waktu yang sama."""
+
+    @abc.abstractmethod
+    async def get_completed_scan_ids(self) -> set:
+        pass
+
+    @abc.abstractmethod
+    async def mark_scan_as_completed(self, group_id: int):
+        pass
+
+    @abc.abstractmethod
+    async def add_completed_scan_id(self, group_id: int):
+        pass
+
+    @abc.abstractmethod
+    async def get_scan_completion_times(self) -> dict:
+        """Mengembalikan {group_id: completed_at} untuk grup yang pernah discan penuh."""
+
+    @abc.abstractmethod
+    async def get_scan_status(self, group_id: int) -> dict:
+        pass
+
+    @abc.abstractmethod
+    async def update_scan_status(self, group_id: int, status_doc: dict):
+        """Menyimpan checkpoint scan; dokumen kosong menghapus checkpoint."""
+
+    @abc.abstractmethod
+    async def clear_scan_record(self, group_id: int):
+        pass
+
+    @abc.abstractmethod
+    async def add_scan_jobs(self, jobs: list):
+        pass
+
+    @abc.abstractmethod
+    async def get_scan_jobs(self, states: tuple = None, batch_id: str = None, limit: int = 0) -> list:
+        """Job scan (filter opsional per state/batch), urut created_at."""
+
+    @abc.abstractmethod
+    async def claim_scan_job(self, state: str, fields: dict) -> dict:
+        """Secara atomik mengambil job `state` tertua dan menerapkan `fields`; None jika tidak ada.
+        Dua instance yang memanggil bersamaan tidak pernah mendapat job yang sama."""
+
+    @abc.abstractmethod
+    async def update_scan_job(self, job_id: str, fields: dict, expect: dict = None) -> bool:
+        """Mengubah job; dengan `expect` hanya jika field-field itu masih bernilai sama. True jika job diubah."""
+
+    @abc.abstractmethod
+    async def requeue_stale_scan_jobs(self, state: str, heartbeat_before: float, fields: dict) -> list:
+        """Menerapkan `fields` ke job `state` yang heartbeat-nya lebih lama dari `heartbeat_before`
+        (atau tidak punya heartbeat); mengembalikan job yang diubah."""
+
+    @abc.abstractmethod
+    async def prune_scan_jobs(self, states: tuple, before: float) -> int:
+        """Menghapus job dengan state `states` yang terakhir diubah sebelum `before`."""
+
+    @abc.abstractmethod
+    async def load_chat_titles(self, limit: int) -> list:
+        pass
+
+    @abc.abstractmethod
+    async def save_chat_titles(self, items: list):
+        """Menyimpan [(group_id, title, updated_at)]."""
+
+    @abc.abstractmethod
+    async def append_cache_changes(self, origin: str, changes: list) -> int:
+        """Mencatat [{'kind', 'op', 'key', 'value'}] dengan versi berurutan; mengembalikan versi terakhir."""
+
+    @abc.abstractmethod
+    async def get_cache_version(self) -> int:
+        """Versi perubahan cache terakhir yang sudah dialokasikan (0 jika belum ada)."""
+
+    @abc.abstractmethod
+    async def get_cache_changes(self, after_version: int, limit: int = 1000) -> list:
+        """Perubahan dengan versi > `after_version`, urut versi."""
+
+    @abc.abstractmethod
+    async def prune_cache_changes(self, before: float) -> int:
+        pass
+
+    @abc.abstractmethod
+    async def get_total_user_count(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    async def get_stats(self, scope=GLOBAL_STATS_SCOPE) -> dict:
+        """Counter untuk satu grup atau GLOBAL_STATS_SCOPE (dict kosong jika belum ada); satu baca per key."""
+
+    @abc.abstractmethod
+    async def rebuild_stats(self) -> int:
+        """Menghitung ulang counter yang bisa diturunkan dari data (user, keanggotaan, perubahan identitas
+        global, aktivitas terakhir); mengembalikan jumlah scope yang ditulis. Perubahan identitas per grup
+        tidak tercatat di data sehingga dibiarkan."""
+
+    # --- Logika riwayat bersama ---
+
+    async def _load_last_entries(self, user_ids: list):
+        last_entries = await self._fetch_last_entries(user_ids)
+        for uid in user_ids:
+            self.identity_cache.set(uid, last_entries.get(uid, {}))
+        return last_entries
+
+    async def get_user_history(self, user_id: int):
+        history = await self._fetch_history(user_id)
+        self.identity_cache.set(user_id, history[-1] if history else {})
+        return history
+
+    async def get_last_entry(self, user_id: int):
+        cached = self.identity_cache.get(user_id)
+        if cached is not None:
+            return cached
+        last_entries = await self._load_last_entries([user_id])
+        return dict(last_entries.get(user_id, {}))
+
+    async def save_user_data_logic(self, user_id: int, new_entry: dict, is_update: bool):
+        # Pemanggil baru saja membaca get_last_entry, jadi cache menunjukkan apakah user sudah ada.
+        previous = self.identity_cache.get(user_id, count=False)
+        stats = {}
+        if not is_update:
+            add_stat(stats, GLOBAL_STATS_SCOPE, 'identity_changes' if previous else 'users')
+        self.identity_cache.invalidate(user_id)
+        await self._write_entry(user_id, new_entry, is_update, stats)
+        self.identity_cache.set(user_id, new_entry)
+
+    async def record_memberships(self, pairs):
+        """Mencatat keanggotaan grup, melewati pasangan yang baru saja ditulis."""
+        now = int(time.time())
+        new_pairs, keys = [], set()
+        for user_id, group_id in pairs:
+            key = (user_id, group_id)
+            if key in keys or self.membership_cache.get(key, count=False) is not None:
+                continue
+            keys.add(key)
+            new_pairs.append(key)
+        if not new_pairs:
+            return 0
+        try:
+            upserted = await self._write_memberships(new_pairs, now)
+        except Exception as e:
+            log.warning(f"[DB Membership] ❗️ Error during bulk write: {e}")
+            await self._spool_failed_write({}, new_pairs)
+            return 0
+        for key in keys:
+            self.membership_cache.set(key, {})
+        return upserted
+
+    async def _spool_failed_write(self, entries: dict, membership_pairs: list):
+        if self.on_write_failed is None:
+            return False
+        try:
+            await self.on_write_failed(entries, membership_pairs)
+            return True
+        except Exception as e:
+            log.error(f"[DB Spool] ❗️ Could not spool {len(entries)} entries: {e}")
+            return False
+
+    async def replay_spooled(self, entries: dict, membership_pairs: list):
+        """Menulis ulang isi retry spool. Entri dilewati jika identitas yang sama atau yang lebih baru
+        sudah tersimpan, jadi replay setelah bulk write yang sebagian berhasil tidak membuat entri ganda."""
+        if entries:
+            current = await self._fetch_last_entries(list(entries))
+            fresh, stats = {}, {}
+            for uid, entry in entries.items():
+                stored = current.get(uid) or {}
+                same = stored.get('full_name') == entry['full_name'] and stored.get('username') == entry['username']
+                if not same and stored.get('timestamp', 0) <= entry['timestamp']:
+                    fresh[uid] = entry
+                    add_stat(stats, GLOBAL_STATS_SCOPE, 'identity_changes' if stored else 'users')
+            if fresh:
+                await self._write_history_entries(fresh, stats)
+            for uid in entries:
+                self.identity_cache.invalidate(uid)
+        if membership_pairs:
+            await self._write_memberships(membership_pairs, int(time.time()))
+
+    @staticmethod
+    def _history_stats(new_entries: dict, new_users: set, entry_groups: dict) -> dict:
+        # Perubahan identitas dihitung juga per grup tempat perubahan itu terlihat.
+        stats = {}
+        for uid in new_entries:
+            if uid in new_users:
+                add_stat(stats, GLOBAL_STATS_SCOPE, 'users')
+                continue
+            add_stat(stats, GLOBAL_STATS_SCOPE, 'identity_changes')
+            if entry_groups.get(uid):
+                add_stat(stats, entry_groups[uid], 'identity_changes')
+        return stats
+
+    async def update_user_history_batch(self, batch: list):
+        if not batch: return 0
+
+        batch_log.debug("[DB Batch] Processing batch of %d users...", len(batch))
+        user_ids_in_batch = {item['user_entity'].id for item in batch}
+
+        last_entries = {}
+        for uid in user_ids_in_batch:
+            cached = self.identity_cache.get(uid)
+            if cached is not None:
+                last_entries[uid] = cached
+        missing_ids = [uid for uid in user_ids_in_batch if uid not in last_entries]
+        if missing_ids:
+            last_entries.update(await self._load_last_entries(missing_ids))
+        new_entries = {}
+        new_users, entry_groups = set(), {}
+        membership_pairs = []
+
+        for item in batch:
+            user_entity = item['user_entity']
+            active_chat_id = item['active_chat_id']
+            user_id = user_entity.id
+            current_identity = build_identity(user_entity)
+
+            if not current_identity['username'] and not current_identity['full_name']: continue
+
+            last_entry = last_entries.get(user_id) or {}
+
+            if last_entry.get('username') and not current_identity['username']: continue
+
+            if active_chat_id: membership_pairs.append((user_id, active_chat_id))
+            identity_changed = (last_entry.get('full_name') != current_identity['full_name'] or last_entry.get('username') != current_identity['username'])
+
+            if not last_entry or identity_changed:
+                # --- Pengguna Baru atau Identitas Berubah ---
+                # Grup tidak lagi disalin ke riwayat; keanggotaan dicatat terpisah di memberships.
+                new_entry = {
+                    'timestamp': int(time.time()),
+                    'full_name': current_identity['full_name'],
+                    'username': current_identity['username'],
+                    'shared_chats': last_entry.get('shared_chats', [])
+                }
+                # Entri terakhir dalam batch yang menang, jadi user yang muncul dua kali tidak membuat entri ganda.
+                if not last_entry:
+                    new_users.add(user_id)
+                last_entries[user_id] = new_entry
+                new_entries[user_id] = new_entry
+                entry_groups[user_id] = active_chat_id
+
+        saved = 0
+        if new_entries:
+            try:
+                saved = await self._write_history_entries(new_entries, self._history_stats(new_entries, new_users, entry_groups))
+                for uid, entry in new_entries.items():
+                    self.identity_cache.set(uid, entry)
+                batch_log.info("[DB Batch] ✅ Bulk write completed. New/Updated: %d records.", saved, extra={'batch_size': len(batch), 'saved': saved})
+            except Exception as e:
+                batch_log.error(f"[DB Batch] ❗️ Error during bulk write: {e}")
+                for uid in new_entries:
+                    self.identity_cache.invalidate(uid)
+                if not await self._spool_failed_write(new_entries, membership_pairs):
+                    return 0
+                # Keanggotaan ikut di-spool bersama entrinya, jadi tidak ditulis terpisah.
+                membership_pairs = []
+        if membership_pairs:
+            await self.record_memberships(membership_pairs)
+        return saved
+
+
+for _name in ('get_user_history', 'get_last_entry', 'save_user_data_logic', 'record_memberships', 'update_user_history_batch', 'replay_spooled'):
+    setattr(DataStore, _name, timed_db_call('DataStore', _name, getattr(DataStore, _name)))
+
+
+def create_data_store(backend: str, loop=None, mongo_connection_string: str = None, sqlite_path: str = None, **cache_options):
+    """Membuat backend penyimpanan: 'mongo' (MongoDB via motor) atau 'sqlite' (file lokal)."""
+    backend = (backend or 'mongo').lower()
+    if backend == 'sqlite':
+        from sqlite_data_store import SQLiteDataStore
+        return SQLiteDataStore(sqlite_path or 'telegram_scraper.db', **cache_options)
+    if backend == 'mongo':
+        from mongo_data_store import MongoDataStore
+        return MongoDataStore(loop, mongo_connection_string, **cache_options)
+    raise ValueError(f"Unknown DATA_STORE_BACKEND '{backend}' (expected 'mongo' or 'sqlite').")
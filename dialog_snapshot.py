@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from telethon import utils
+from telethon.tl.types import Chat, PeerChannel
+
+from log import get_logger
+
+log = get_logger('dialogs')
+
+
+def normalize_group_id(chat_id) -> int:
+    """Satu-satunya normalisasi ID grup: peer ID bertanda (marked) int64 seperti milik Telethon.
+
+    Supergroup/channel berawalan -100, grup biasa negatif tanpa -100 dan
+    dibiarkan apa adanya. Hanya ID channel polos yang positif (mis. argumen
+    perintah atau data lama) yang diberi awalan -100. Menerima int atau
+    string; melempar ValueError jika bukan angka.
+    """
+    gid = int(str(chat_id).strip())
+    if gid > 0:
+        return utils.get_peer_id(PeerChannel(gid))
+    return gid
+
+
+class DialogSnapshot:
+    """Snapshot bersama daftar grup bot: {group_id: {'title', 'member_count', 'entity'}}.
+
+    Diisi sekali dari dialog, lalu diperbarui per event ChatAction dan
+    di-refresh penuh di background tiap `refresh_interval` detik, sehingga
+    perintah admin tidak perlu memanggil get_dialogs() sendiri.
+    """
+
+    def __init__(self, client, refresh_interval: float = 1800, on_refresh=None):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self.on_refresh = on_refresh
+        self.groups = {}
+        self.refreshed_at = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    @staticmethod
+    def _is_group(entity):
+        return isinstance(entity, Chat) or getattr(entity, 'megagroup', False)
+
+    @staticmethod
+    def _group_info(entity):
+        return {'title': entity.title, 'member_count': getattr(entity, 'participants_count', None), 'entity': entity}
+
+    async def _load(self):
+        started = time.perf_counter()
+        groups = {}
+        async for dialog in self.client.iter_dialogs():
+            if dialog.is_group or (dialog.is_channel and getattr(dialog.entity, 'megagroup', False)):
+                groups[utils.get_peer_id(dialog.entity)] = self._group_info(dialog.entity)
+        self.groups = groups
+        self.refreshed_at = time.time()
+        log.info(f"✅ [Dialogs] Snapshot refreshed: {len(groups)} groups in {time.perf_counter() - started:.2f}s.")
+        if self.on_refresh:
+            await self.on_refresh(groups)
+
+    async def refresh(self):
+        async with self._lock:
+            await self._load()
+
+    async def get_groups(self):
+        if not self.refreshed_at:
+            async with self._lock:
+                if not self.refreshed_at:
+                    await self._load()
+        return self.groups
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.warning(f"❗️ [Dialogs] Background refresh failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def handle_chat_action(self, event, my_id):
+        """Memperbarui snapshot secara inkremental dari event ChatAction."""
+        if not self.refreshed_at:
+            return
+        gid = normalize_group_id(event.chat_id)
+        if event.new_title and gid in self.groups:
+            self.groups[gid]['title'] = event.new_title
+            log.info(f"[Dialogs] Group {gid} renamed to '{event.new_title}'.")
+        if my_id in (event.user_ids or []):
+            if event.user_joined or event.user_added:
+                chat = await event.get_chat()
+                if chat is not None and self._is_group(chat):
+                    self.groups[gid] = self._group_info(chat)
+                    log.info(f"[Dialogs] Joined group '{chat.title}' ({gid}).")
+            elif event.user_left or event.user_kicked:
+                if self.groups.pop(gid, None):
+                    log.info(f"[Dialogs] Left group {gid}.")
@@ -0,0 +1,134 @@
+"""Ekspor streaming riwayat user ke NDJSON terkompresi gzip, dipecah per part.
+
+Dipakai oleh perintah admin /export dan bisa dijalankan langsung:
+    python exporter.py --group -1001234567890 --since 2024-01-01 --until 2024-07-01 --out-dir exports
+"""
+import argparse
+import asyncio
+import calendar
+import gzip
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+from data_store import create_data_store
+from dialog_snapshot import normalize_group_id
+from log import get_logger, setup_logging
+
+log = get_logger('export')
+
+
+def parse_time(value):
+    """'2024-01-31' (UTC) atau unix timestamp -> int; None/'' -> None."""
+    if value in (None, '', '-'):
+        return None
+    if str(value).isdigit():
+        return int(value)
+    return calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+
+
+class HistoryExporter:
+    """Menulis dokumen user per batch ke `<prefix>-00001.ndjson.gz`, `-00002`, dst.
+
+    Hanya satu batch yang ada di memori pada satu waktu, dan kompresi/penulisan
+    disk berjalan di thread executor sehingga event loop tetap responsif.
+    """
+
+    def __init__(self, data_store, out_dir: str, prefix: str = 'users', part_size: int = 100000, batch_size: int = 1000):
+        self.data_store = data_store
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.part_size = part_size
+        self.batch_size = batch_size
+        self.records = 0
+        self.parts = []
+        self._file = None
+        self._part_records = 0
+
+    def _open_part(self):
+        path = os.path.join(self.out_dir, f"{self.prefix}-{len(self.parts) + 1:05d}.ndjson.gz")
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._part_records = 0
+        self.parts.append(path)
+
+    def _close_part(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_batch(self, docs):
+        for doc in docs:
+            if self._file is None or self._part_records >= self.part_size:
+                self._close_part()
+                self._open_part()
+            self._file.write(json.dumps(doc, ensure_ascii=False, separators=(',', ':')) + '\n')
+            self._part_records += 1
+        self.records += len(docs)
+
+    async def _batches(self, group_id, since, until):
+        if group_id is None:
+            async for docs in self.data_store.iter_user_documents(since, until, self.batch_size):
+                yield docs
+            return
+        async for user_ids in self.data_store.iter_group_members(group_id, self.batch_size):
+            docs = await self.data_store.get_user_documents(user_ids, since, until)
+            if docs:
+                yield docs
+
+    async def export(self, group_id: int = None, since: int = None, until: int = None, progress=None):
+        """Mengekspor semua user (atau anggota `group_id`) yang cocok; `progress(records, parts)` dipanggil per batch."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            async for docs in self._batches(group_id, since, until):
+                await loop.run_in_executor(None, self._write_batch, docs)
+                if progress is not None:
+                    await progress(self.records, len(self.parts))
+        finally:
+            await loop.run_in_executor(None, self._close_part)
+        log.info(f"✅ [Export] Wrote {self.records} users to {len(self.parts)} parts in {time.perf_counter() - started:.2f}s.")
+        return self.records, self.parts
+
+
+async def _run_cli(args):
+    data_store = create_data_store(
+        args.backend, asyncio.get_running_loop(), os.getenv('MONGO_CONNECTION_STRING'), args.sqlite_path
+    )
+    exporter = HistoryExporter(data_store, args.out_dir, args.prefix, args.part_size, args.batch_size)
+
+    async def progress(records, parts):
+        print(f"\r📦 [Export] {records} users, {parts} parts", end='', flush=True)
+
+    try:
+        records, parts = await exporter.export(normalize_group_id(args.group) if args.group else None, parse_time(args.since), parse_time(args.until), progress)
+    finally:
+        await data_store.close()
+    print(f"\n✅ [Export] {records} users -> {', '.join(parts) or '(tidak ada)'}")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Stream the users collection to gzip-compressed NDJSON parts.")
+    parser.add_argument('--group', default=None, help="Hanya user yang pernah terlihat di grup ini.")
+    parser.add_argument('--since', default=None, help="YYYY-MM-DD (UTC) atau unix timestamp, inklusif.")
+    parser.add_argument('--until', default=None, help="YYYY-MM-DD (UTC) atau unix timestamp, eksklusif.")
+    parser.add_argument('--out-dir', default=os.getenv('EXPORT_DIR', 'exports'))
+    parser.add_argument('--prefix', default='users')
+    parser.add_argument('--part-size', type=int, default=int(os.getenv('EXPORT_PART_SIZE', '100000')), help="Jumlah user per file part.")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--backend', default=os.getenv('DATA_STORE_BACKEND', 'mongo'))
+    parser.add_argument('--sqlite-path', default=os.getenv('SQLITE_PATH', 'telegram_scraper.db'))
+    args = parser.parse_args()
+
+    listener = setup_logging(os.getenv('LOG_LEVEL', 'WARNING'), os.getenv('LOG_FORMAT', 'text'))
+    try:
+        asyncio.run(_run_cli(args))
+    finally:
+        listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import sys
+import time
+from collections import OrderedDict
+
+
+def _approx_size(key, value: dict) -> int:
+    """Perkiraan memori satu item cache (kunci, dict entri, isi string/list-nya, dan node LRU)."""
+    size = sys.getsizeof(key) + sys.getsizeof(value) + 120
+    for field, item in value.items():
+        size += sys.getsizeof(field) + sys.getsizeof(item)
+        if isinstance(item, (list, tuple, set)):
+            size += sum(sys.getsizeof(element) for element in item)
+    return size
+
+
+class IdentityCache:
+    """Cache LRU + TTL berisi entri riwayat terakhir per user_id.
+
+    Nilai `{}` berarti user belum ada di database, sehingga user baru pun
+    tidak perlu dicek ulang ke database. Dibatasi jumlah entri dan, jika
+    `max_bytes` > 0, perkiraan ukuran memori; yang paling lama tidak dipakai
+    dibuang lebih dulu.
+    """
+
+    def __init__(self, max_entries: int = 50000, ttl: float = 3600, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        return self.get(user_id, count=False) is not None
+
+    def get(self, user_id: int, count: bool = True):
+        item = self._entries.get(user_id)
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            if item is not None:
+                self._remove(user_id)
+            if count: self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        if count: self.hits += 1
+        return dict(item[1])
+
+    def _remove(self, user_id):
+        item = self._entries.pop(user_id, None)
+        if item is not None:
+            self.bytes -= item[2]
+
+    def set(self, user_id: int, last_entry: dict):
+        if self.max_entries <= 0:
+            return
+        entry = dict(last_entry or {})
+        self._remove(user_id)
+        size = _approx_size(user_id, entry)
+        self._entries[user_id] = (time.monotonic(), entry, size)
+        self.bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or (self.max_bytes > 0 and self.bytes > self.max_bytes)):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def invalidate(self, user_id: int):
+        self._remove(user_id)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
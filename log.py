@@ -0,0 +1,101 @@
+"""Logging terstruktur yang tidak memblokir event loop.
+
+Semua logger `menelbot.*` menulis ke antrean di memori (QueueHandler); satu
+thread QueueListener yang melakukan I/O ke stdout. Event berfrekuensi tinggi
+bisa di-sampling per kategori, dan output bisa berupa teks atau JSON.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+ROOT_LOGGER = 'menelbot'
+
+# Atribut bawaan LogRecord; atribut lain dianggap field terstruktur (dari `extra=`).
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def get_logger(category: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{category}")
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """'passive=0.05,db.batch=0.1' -> {'passive': 0.05, 'db.batch': 0.1}"""
+    rates = {}
+    for part in filter(None, (p.strip() for p in (spec or '').split(','))):
+        category, _, rate = part.partition('=')
+        rates[category.strip()] = float(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Meloloskan hanya sebagian record INFO/DEBUG untuk kategori tertentu. WARNING ke atas selalu lolos."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = {f"{ROOT_LOGGER}.{category}": rate for category, rate in rates.items()}
+        self.dropped = {}
+
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if rate is None or record.levelno >= logging.WARNING or random.random() < rate:
+            return True
+        self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        payload.update({k: v for k, v in vars(record).items() if k not in _STANDARD_ATTRS})
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Format pesan sekarang (argumennya bisa berubah nanti), tapi tanpa I/O.
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+
+def setup_logging(level: str = 'INFO', fmt: str = 'text', sample_rates: str = ''):
+    """Memasang QueueHandler di logger `menelbot`.
+
+    Mengembalikan QueueListener (dengan atribut `sampling` untuk statistik record
+    yang dibuang) yang harus di-stop saat shutdown agar antrean terkuras.
+    """
+    root = logging.getLogger(ROOT_LOGGER)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level.upper())
+    root.propagate = False
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    sampling = SamplingFilter(parse_sample_rates(sample_rates))
+    queue_handler.addFilter(sampling)
+    root.addHandler(queue_handler)
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)-7s %(message)s', '%Y-%m-%d %H:%M:%S')
+        formatter.converter = time.localtime
+        stream_handler.setFormatter(formatter)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    listener.sampling = sampling
+    listener.start()
+    return listener
@@ -1,135 +1,375 @@
 
 import asyncio
+import html
 import os
 import time
 from dotenv import load_dotenv
 from telethon import TelegramClient, events
-from telethon.tl.types import User
-from telethon.errors import MessageNotModifiedError, MessageTooLongError
-from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.types import Channel, User
+from telethon.errors import MessageNotModifiedError, MessageTooLongError, UserNotParticipantError
+from telethon.tl.functions.channels import GetFullChannelRequest, GetParticipantRequest
 from telethon.tl.functions.messages import GetFullChatRequest
 
-from mongo_data_store import MongoDataStore
+from data_store import GLOBAL_STATS_SCOPE, build_identity, create_data_store
+from identity_cache import IdentityCache
+from passive_buffer import PassiveWriteBuffer
+from scan_pipeline import ScanWritePipeline
+from scan_queue import FINISHED_STATES, DONE, ScanJobQueue
+from title_cache import ChatTitleCache
+from cache_sync import CacheSync
+from retry_spool import RetrySpool
+from dialog_snapshot import DialogSnapshot, normalize_group_id
+from profiler import LoopProfiler
+from exporter import HistoryExporter, parse_time
+from metrics import DB_CALL_SECONDS, DB_CALLS, DB_BULK_SIZE, EVENT_LOOP_LAG, PASSIVE_DEDUPLICATED, PASSIVE_HANDLER_SECONDS, REGISTRY, monitor_event_loop_lag, start_http_server
+from log import get_logger, setup_logging
+
+log = get_logger('bot')
+cmd_log = get_logger('cmd')
+scan_log = get_logger('scan')
+passive_log = get_logger('passive')
 
 load_dotenv()
 
 class TeleScrapeTracker:
-    def __init__(self, session_name='bot_session'):
-        print("🤖 [TeleScrapeTracker] Initializing Bot...")
+    def __init__(self, session_name='bot_session', client=None, data_store=None):
+        self.LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+        self.LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+        # Sampling per kategori logger untuk event berfrekuensi tinggi, mis. "passive=0.05,db.batch=0.1".
+        self.LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'passive=0.05,db.batch=0.1')
+        self.log_listener = setup_logging(self.LOG_LEVEL, self.LOG_FORMAT, self.LOG_SAMPLE_RATES)
+        log.info("🤖 [TeleScrapeTracker] Initializing Bot...")
         self.API_ID = int(os.getenv('TG_API_ID'))
         self.API_HASH = os.getenv('TG_API_HASH')
         self.ADMIN_IDS = [int(i) for i in os.getenv('ADMIN_IDS', '').split(',') if i]
+        self.DATA_STORE_BACKEND = os.getenv('DATA_STORE_BACKEND', 'mongo')
         self.MONGO_CONNECTION_STRING = os.getenv('MONGO_CONNECTION_STRING')
+        self.SQLITE_PATH = os.getenv('SQLITE_PATH', 'telegram_scraper.db')
         self.BATCH_SIZE = 300
+        self.WHOIS_PAGE_SIZE = 200
+        self.SCAN_WRITERS = int(os.getenv('SCAN_WRITERS', '1'))
+        self.SCAN_QUEUE_BATCHES = int(os.getenv('SCAN_QUEUE_BATCHES', '4'))
+        self.CHAT_TITLE_TTL = float(os.getenv('CHAT_TITLE_TTL', '86400'))
+        self.CHAT_TITLE_CACHE_SIZE = int(os.getenv('CHAT_TITLE_CACHE_SIZE', '5000'))
+        self.CHAT_TITLE_CONCURRENCY = int(os.getenv('CHAT_TITLE_CONCURRENCY', '8'))
+        self.SCAN_USER_STALE_AFTER = float(os.getenv('SCAN_USER_STALE_AFTER', str(7 * 86400)))
+        self.DIALOG_REFRESH_INTERVAL = float(os.getenv('DIALOG_REFRESH_INTERVAL', '1800'))
+        self.PASSIVE_FLUSH_INTERVAL = float(os.getenv('PASSIVE_FLUSH_INTERVAL', '2'))
+        self.PASSIVE_FLUSH_SIZE = int(os.getenv('PASSIVE_FLUSH_SIZE', '100'))
+        self.IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '50000'))
+        self.IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', '3600'))
+        # Batas memori perkiraan cache identitas dalam byte; 0 = hanya dibatasi IDENTITY_CACHE_SIZE.
+        self.IDENTITY_CACHE_MAX_BYTES = int(os.getenv('IDENTITY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+        self.MEMBERSHIP_TOUCH_INTERVAL = float(os.getenv('MEMBERSHIP_TOUCH_INTERVAL', '3600'))
+        self.HISTORY_INLINE_LIMIT = int(os.getenv('HISTORY_INLINE_LIMIT', '20'))
+        self.HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '30'))
+        self.SENDER_DEDUP_WINDOW = float(os.getenv('SENDER_DEDUP_WINDOW', '300'))
+        self.SENDER_DEDUP_SIZE = int(os.getenv('SENDER_DEDUP_SIZE', '100000'))
+        self.METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+        self.METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+        self.EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+        self.EXPORT_PART_SIZE = int(os.getenv('EXPORT_PART_SIZE', '100000'))
+        self.COMPACTION_BATCH_SIZE = int(os.getenv('COMPACTION_BATCH_SIZE', '500'))
+        self.COMPACTION_PAUSE = float(os.getenv('COMPACTION_PAUSE', '0.05'))
+        self.SCAN_JOB_PAUSE = float(os.getenv('SCAN_JOB_PAUSE', '10'))
+        self.SCAN_JOB_RETENTION = float(os.getenv('SCAN_JOB_RETENTION', str(7 * 86400)))
+        self.SCAN_JOB_HEARTBEAT = float(os.getenv('SCAN_JOB_HEARTBEAT', '30'))
+        # Sinkronisasi whitelist & judul grup antar instance; 0 menonaktifkan (satu instance saja).
+        self.CACHE_SYNC_INTERVAL = float(os.getenv('CACHE_SYNC_INTERVAL', '5'))
+        self.CACHE_SYNC_RETENTION = float(os.getenv('CACHE_SYNC_RETENTION', '86400'))
+        self.CACHE_SYNC_GAP_GRACE = float(os.getenv('CACHE_SYNC_GAP_GRACE', '30'))
+        self.RETRY_SPOOL_PATH = os.getenv('RETRY_SPOOL_PATH', 'retry_spool.bin')
+        self.RETRY_SPOOL_MAX_DELAY = float(os.getenv('RETRY_SPOOL_MAX_DELAY', '300'))
 
-        self.client = TelegramClient(session_name, self.API_ID, self.API_HASH)
+        # client/data_store bisa diinjeksi (mis. oleh benchmark.py) agar bot bisa dijalankan tanpa jaringan.
+        self.client = client or TelegramClient(session_name, self.API_ID, self.API_HASH)
         self.loop = asyncio.get_event_loop()
         self.my_id = None
-        self.chat_titles_cache = {}
+        self.profiler = LoopProfiler()
+        self._export_lock = asyncio.Lock()
+        self._compaction_lock = asyncio.Lock()
         self.completed_scan_group_ids = set() 
         
-        self.data_store = MongoDataStore(self.loop, self.MONGO_CONNECTION_STRING)
-        
+        self.data_store = data_store or create_data_store(
+            self.DATA_STORE_BACKEND, self.loop, self.MONGO_CONNECTION_STRING, self.SQLITE_PATH,
+            cache_size=self.IDENTITY_CACHE_SIZE, cache_ttl=self.IDENTITY_CACHE_TTL, membership_touch_interval=self.MEMBERSHIP_TOUCH_INTERVAL,
+            history_limit=self.HISTORY_INLINE_LIMIT, cache_max_bytes=self.IDENTITY_CACHE_MAX_BYTES
+        )
+        # Batch yang gagal ditulis disimpan di disk dan dicoba ulang, bukan dibuang.
+        self.retry_spool = RetrySpool(self.data_store, self.RETRY_SPOOL_PATH, max_delay=self.RETRY_SPOOL_MAX_DELAY)
+        self.data_store.on_write_failed = self.retry_spool.add
+        # (user_id, chat_id, identitas) yang baru saja diproses; 0 pada SENDER_DEDUP_SIZE menonaktifkan.
+        self.recent_senders = IdentityCache(self.SENDER_DEDUP_SIZE, self.SENDER_DEDUP_WINDOW)
+        self.passive_buffer = PassiveWriteBuffer(self.data_store, self.PASSIVE_FLUSH_INTERVAL, self.PASSIVE_FLUSH_SIZE)
+        self.cache_sync = CacheSync(self.data_store, self.CACHE_SYNC_INTERVAL, self.CACHE_SYNC_RETENTION, self.CACHE_SYNC_GAP_GRACE)
+        self.title_cache = ChatTitleCache(
+            self.client, self.data_store, self.CHAT_TITLE_TTL, self.CHAT_TITLE_CACHE_SIZE, self.CHAT_TITLE_CONCURRENCY, on_saved=self._publish_titles
+        )
+        self.cache_sync.subscribe('whitelist', self._apply_whitelist_change, self._reload_whitelist)
+        self.cache_sync.subscribe('title', self._apply_title_change, self.title_cache.warm)
+        self.dialogs = DialogSnapshot(self.client, self.DIALOG_REFRESH_INTERVAL, on_refresh=self._on_dialogs_refreshed)
+        self.scan_queue = ScanJobQueue(self.data_store, self._run_scan_job, self.SCAN_JOB_PAUSE, on_batch_finished=self._report_scan_batch, heartbeat_interval=self.SCAN_JOB_HEARTBEAT)
+        REGISTRY.gauge('cache_requests', 'Cache lookups by cache and result.', self._cache_request_samples)
+        REGISTRY.gauge('cache_entries', 'Entries currently held per cache.', self._cache_size_samples)
+        REGISTRY.gauge('identity_cache_bytes', 'Approximate memory held by the identity cache.', lambda: [({}, self.data_store.identity_cache.bytes)])
+        REGISTRY.gauge('passive_buffer_pending', 'Passive events waiting to be flushed.', lambda: [({}, len(self.passive_buffer))])
+        REGISTRY.gauge('log_records_sampled_out', 'Log records dropped by per-category sampling.', self._log_sampling_samples)
+        REGISTRY.gauge('retry_spool_depth', 'Users waiting in the on-disk retry spool.', lambda: [({}, len(self.retry_spool))])
+        REGISTRY.gauge('cache_sync_events', 'Changes applied from other instances and full reloads.', lambda: [({'event': 'applied'}, self.cache_sync.applied), ({'event': 'resync'}, self.cache_sync.resyncs)])
+        self.startup_timings = {}
+        self._background_tasks = set()
+        REGISTRY.gauge('startup_phase_seconds', 'Duration of each startup phase.', lambda: [({'phase': phase}, seconds) for phase, seconds in self.startup_timings.items()])
+        log.info("✅ [TeleScrapeTracker] Bot ready.")
+
+    def _register_handlers(self):
         self.client.add_event_handler(self.handle_command, events.NewMessage(pattern=r'^/[a-zA-Z_]+', forwards=False, from_users=self.ADMIN_IDS))
         self.client.add_event_handler(self.handle_passive_tracking, events.NewMessage(incoming=True, forwards=False))
-        print("✅ [TeleScrapeTracker] Bot ready.")
+        self.client.add_event_handler(self.handle_chat_action, events.ChatAction())
+
+    async def _prepare_database(self):
+        await self._timed_phase('indexes', self.data_store.ensure_indexes())
+        # ID string lama harus sudah int64 sebelum whitelist dimuat dan handler menulis dokumen baru.
+        await self._timed_phase('migrate_int_ids', self.data_store.migrate_int_ids())
+        # Arsip harus lengkap sebelum $push ber-$slice pertama menggeser entri inline lama.
+        await self._timed_phase('migrate_history_archive', self.data_store.migrate_history_archive())
+        _, global_stats = await asyncio.gather(
+            self._timed_phase('whitelist', self._load_whitelist()),
+            self._timed_phase('stats', self.data_store.get_stats()),
+        )
+        return global_stats
 
     async def _initialize_connections(self):
-        print("🔌 [Init] Initializing connections...")
-        await self._ensure_my_id()
+        """Startup dua tahap: yang wajib (auth, index, migrasi ID, whitelist) berjalan bersamaan lalu
+        handler langsung dipasang; migrasi lain dan warm-up cache berjalan di background setelahnya."""
+        log.info("🔌 [Init] Initializing connections...")
+        started = time.perf_counter()
+        _, global_stats = await asyncio.gather(
+            self._timed_phase('auth', self._ensure_my_id()),
+            self._prepare_database(),
+        )
+        log.info(f"✅ [Init] Loaded {len(self.completed_scan_group_ids)} completed scan groups from DB.")
+        await self._timed_phase('retry_spool', self._drain_retry_spool())
+
+        self.passive_buffer.start()
+        self._register_handlers()
+        self.scan_queue.start()
+        self.cache_sync.start()
+        self.retry_spool.start()
+        self.startup_timings['ready'] = time.perf_counter() - started
+        log.info(f"✅ [Init] Handling events after {self.startup_timings['ready']:.2f}s.")
+
+        self._spawn(monitor_event_loop_lag())
+        if self.METRICS_PORT:
+            await start_http_server(self.METRICS_PORT, self.METRICS_HOST)
+        self._spawn(self._deferred_startup(rebuild_stats=not global_stats))
+
+    async def _deferred_startup(self, rebuild_stats: bool = False):
+        # Migrasi berurutan (index sudah ada), warm-up lain tidak saling bergantung.
+        await self._timed_phase('migrate_current_identity', self.data_store.migrate_current_identity())
+        await self._timed_phase('migrate_memberships', self.data_store.migrate_memberships())
+        self.dialogs.start()
+        _, total_users_in_db = await asyncio.gather(
+            self._timed_phase('title_cache_warm', self.title_cache.warm()),
+            self._timed_phase('user_count', self.data_store.get_total_user_count()),
+        )
+        log.info(f"📊 [Init] Total users in database: {total_users_in_db}")
+        await self.data_store.prune_scan_jobs(FINISHED_STATES, time.time() - self.SCAN_JOB_RETENTION)
+        if rebuild_stats:
+            # Database lama belum punya counter; selanjutnya counter diperbarui bersama setiap penulisan.
+            async with self._compaction_lock:
+                await self._timed_phase('stats_rebuild', self.data_store.rebuild_stats())
+
+    async def _drain_retry_spool(self):
+        # Isi spool lebih lama dari event baru, jadi dikuras sebelum handler dipasang.
+        if not await self.retry_spool.load():
+            return
+        try:
+            await self.retry_spool.drain()
+        except Exception as e:
+            log.warning(f"❗️ [Init] Retry spool not drained yet ({len(self.retry_spool)} users), retrying in background: {e}")
+
+    async def _load_whitelist(self):
+        # Versi dibaca sebelum whitelist, jadi perubahan di antaranya tetap diterapkan saat poll pertama.
+        await self.cache_sync.mark_loaded()
+        await self._reload_whitelist()
+
+    async def _reload_whitelist(self):
         self.completed_scan_group_ids = await self.data_store.get_completed_scan_ids()
-        print(f"✅ [Init] Loaded {len(self.completed_scan_group_ids)} completed scan groups from DB.")
-        print(f"   [Init Debug] Completed Group IDs loaded: {self.completed_scan_group_ids}")
-        total_users_in_db = await self.data_store.get_total_user_count()
-        print(f"📊 [Init] Total users in database: {total_users_in_db}")
+
+    def _apply_whitelist_change(self, op, group_id, _value):
+        if op == 'add':
+            self.completed_scan_group_ids.add(group_id)
+        elif op == 'remove':
+            self.completed_scan_group_ids.discard(group_id)
+
+    async def _set_whitelisted(self, group_id: int, enabled: bool):
+        self._apply_whitelist_change('add' if enabled else 'remove', group_id, None)
+        await self.cache_sync.publish('whitelist', [('add' if enabled else 'remove', group_id, None)])
+
+    def _apply_title_change(self, _op, chat_id, value):
+        title, updated_at = value
+        self.title_cache.put(chat_id, title, updated_at)
+
+    async def _publish_titles(self, items):
+        await self.cache_sync.publish('title', [('set', chat_id, [title, updated_at]) for chat_id, title, updated_at in items])
+
+    async def _timed_phase(self, phase: str, coro):
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.startup_timings[phase] = time.perf_counter() - started
+            log.info(f"⏱️  [Init] Phase '{phase}' took {self.startup_timings[phase]:.2f}s.")
+
+    def _spawn(self, coro):
+        """Menjalankan task background; referensinya disimpan dan error-nya dicatat."""
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+
+        def done(t):
+            self._background_tasks.discard(t)
+            if not t.cancelled() and t.exception():
+                log.error(f"❗️ [Init] Background task failed: {t.exception()}")
+        task.add_done_callback(done)
+        return task
+
+    async def _cancel_background_tasks(self):
+        for task in list(self._background_tasks):
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
 
     async def _ensure_my_id(self):
         if self.my_id is None:
             me = await self.client.get_me()
             self.my_id = me.id
-            print(f"   [Auth] Logged in as Bot ID: {self.my_id}")
+            log.info(f"[Auth] Logged in as Bot ID: {self.my_id}")
+
+    async def _get_chat_title(self, chat_id: int):
+        return await self.title_cache.get(chat_id)
+
+    def _cache_request_samples(self):
+        for name, cache in (('identity', self.data_store.identity_cache), ('chat_title', self.title_cache)):
+            yield {'cache': name, 'result': 'hit'}, cache.hits
+            yield {'cache': name, 'result': 'miss'}, cache.misses
+
+    def _cache_size_samples(self):
+        for name, cache in (('identity', self.data_store.identity_cache), ('membership', self.data_store.membership_cache), ('chat_title', self.title_cache), ('recent_senders', self.recent_senders)):
+            yield {'cache': name}, len(cache)
+
+    def _log_sampling_samples(self):
+        for logger_name, dropped in self.log_listener.sampling.dropped.items():
+            yield {'logger': logger_name}, dropped
+
+    async def _on_dialogs_refreshed(self, groups: dict):
+        await self.title_cache.prime_many({gid: info['title'] for gid, info in groups.items()})
 
-    async def _get_chat_title(self, chat_id: str):
-        if chat_id in self.chat_titles_cache:
-            return self.chat_titles_cache[chat_id]
+    async def handle_chat_action(self, event):
         try:
-            entity = await self.client.get_entity(int(chat_id))
-            title = entity.title if hasattr(entity, 'title') else f"Private Chat"
-            self.chat_titles_cache[chat_id] = title
-            return title
+            await self.dialogs.handle_chat_action(event, self.my_id)
+            if event.new_title:
+                await self.title_cache.prime(normalize_group_id(event.chat_id), event.new_title)
         except Exception as e:
-            return f"[Inaccessible Group: {chat_id}]"
+            log.warning(f"❗️ [ChatAction] Minor exception: {e}")
 
     def start(self):
-        print("🚀 [TeleScrapeTracker] Starting client...")
+        log.info("🚀 [TeleScrapeTracker] Starting client...")
         with self.client:
             self.client.loop.run_until_complete(self._initialize_connections())
-            print(f"✅ [TeleScrapeTracker] Client connected and ready.")
-            self.client.run_until_disconnected()
-        print("🛑 [TeleScrapeTracker] Client disconnected.")
+            log.info("✅ [TeleScrapeTracker] Client connected and ready.")
+            try:
+                self.client.run_until_disconnected()
+            finally:
+                self.client.loop.run_until_complete(self._cancel_background_tasks())
+                self.client.loop.run_until_complete(self.dialogs.close())
+                self.client.loop.run_until_complete(self.scan_queue.close())
+                self.client.loop.run_until_complete(self.cache_sync.close())
+                self.client.loop.run_until_complete(self.passive_buffer.close())
+                self.client.loop.run_until_complete(self.retry_spool.close())
+                self.client.loop.run_until_complete(self.data_store.close())
+        log.info("🛑 [TeleScrapeTracker] Client disconnected.")
+        self.log_listener.stop()
 
-    async def save_user_data(self, user_entity: User, active_chat_id: str = None, shared_chats: list = None):
+    async def save_user_data(self, user_entity: User, active_chat_id: int = None, shared_chats: list = None):
         if not isinstance(user_entity, User): return False
         
-        user_id = str(user_entity.id)
-        current_identity = {'full_name': (user_entity.first_name or "") + (" " + (user_entity.last_name or "") if user_entity.last_name else ""), 'username': user_entity.username}
+        user_id = user_entity.id
+        current_identity = build_identity(user_entity)
         if not current_identity['username'] and not current_identity['full_name']: return False
 
-        history = await self.data_store.get_user_history(user_id)
-        last_entry = history[-1] if history else {}
+        last_entry = await self.data_store.get_last_entry(user_id)
         
         if last_entry.get('username') and not current_identity['username']:
             return False
 
-        last_active_chats = set(last_entry.get('active_chats_snapshot', []))
-        is_new_group = active_chat_id and active_chat_id not in last_active_chats
+        # Keanggotaan grup disimpan terpisah di koleksi memberships, bukan di riwayat.
+        is_new_group = bool(active_chat_id) and await self.data_store.record_memberships([(user_id, active_chat_id)]) > 0
         identity_changed = (last_entry.get('full_name') != current_identity['full_name'] or last_entry.get('username') != current_identity['username'])
 
-        if not history or identity_changed:
-            if active_chat_id: last_active_chats.add(active_chat_id)
-            new_entry = {'timestamp': int(time.time()), 'full_name': current_identity['full_name'], 'username': current_identity['username'], 'active_chats_snapshot': sorted(list(last_active_chats)), 'shared_chats': shared_chats or last_entry.get('shared_chats', [])}
+        if not last_entry or identity_changed:
+            new_entry = {'timestamp': int(time.time()), 'full_name': current_identity['full_name'], 'username': current_identity['username'], 'shared_chats': shared_chats or last_entry.get('shared_chats', [])}
             await self.data_store.save_user_data_logic(user_id, new_entry, is_update=False)
             return True
-        elif is_new_group:
-            last_active_chats.add(active_chat_id)
-            last_entry['active_chats_snapshot'] = sorted(list(last_active_chats))
-            if shared_chats:
-                existing_shared = set(last_entry.get('shared_chats', [])); existing_shared.update(shared_chats)
-                last_entry['shared_chats'] = sorted(list(existing_shared))
-            
+        existing_shared = set(last_entry.get('shared_chats', []))
+        if shared_chats and not existing_shared.issuperset(shared_chats):
+            existing_shared.update(shared_chats)
+            last_entry['shared_chats'] = sorted(list(existing_shared))
             await self.data_store.save_user_data_logic(user_id, last_entry, is_update=True)
             return True
-        return False
+        return is_new_group
 
     async def handle_passive_tracking(self, event):
+        started = time.perf_counter()
+        tracked = False
+        try:
+            tracked = await self._track_passive_event(event)
+        finally:
+            PASSIVE_HANDLER_SECONDS.observe(time.perf_counter() - started, outcome='tracked' if tracked else 'skipped')
+
+    async def _track_passive_event(self, event):
         if event.sender_id == self.my_id or event.sender_id in self.ADMIN_IDS:
-            return
+            return False
 
-        chat_id_str = str(event.chat_id)
+        group_id = normalize_group_id(event.chat_id)
         
         process_message = False
         active_chat_id_to_save = None
         if event.is_private:
             process_message = True
-            print(f"🕵️  [PassiveTrack] Saw private message from User ID: {event.sender_id}.")
-        elif (event.is_group or event.is_channel) and chat_id_str in self.completed_scan_group_ids:
+            passive_log.info("🕵️  [PassiveTrack] Saw private message from User ID: %s.", event.sender_id, extra={'user_id': event.sender_id})
+        elif (event.is_group or event.is_channel) and group_id in self.completed_scan_group_ids:
             process_message = True
-            group_title = await self._get_chat_title(chat_id_str)
-            # print(f"🕵️  [PassiveTrack] Saw message from User ID {event.sender_id} in whitelisted group '{group_title}'.")
-            active_chat_id_to_save = chat_id_str
+            active_chat_id_to_save = group_id
         
         if not process_message:
-            return
+            return False
+
+        # Sender dari entitas update (tanpa await); event berulang dengan identitas sama dibuang di sini.
+        sender = event.sender
+        if isinstance(sender, User) and self._seen_recently(sender, active_chat_id_to_save):
+            return False
 
         try:
-            sender = await event.get_sender()
+            sender = sender or await event.get_sender()
             if isinstance(sender, User):
-                await self.save_user_data(sender, active_chat_id=active_chat_id_to_save)
+                self.passive_buffer.add(sender, active_chat_id=active_chat_id_to_save)
+                self.recent_senders.set(self._sender_key(sender, active_chat_id_to_save), {})
+                return True
         except Exception as e:
-            print(f"❗️ [PassiveTrack] Minor exception: {e}")
+            passive_log.warning(f"❗️ [PassiveTrack] Minor exception: {e}")
+        return False
+
+    @staticmethod
+    def _sender_key(sender: User, chat_id: int):
+        return (sender.id, chat_id, sender.first_name, sender.last_name, sender.username)
+
+    def _seen_recently(self, sender: User, chat_id: int):
+        if self._sender_key(sender, chat_id) in self.recent_senders:
+            PASSIVE_DEDUPLICATED.inc()
+            return True
+        return False
 
     async def handle_command(self, event):
-        print(f"⚙️  [HandleCommand] Admin {event.sender_id} sent command: {event.raw_text}")
+        cmd_log.info(f"⚙️  [HandleCommand] Admin {event.sender_id} sent command: {event.raw_text}")
         command_full, *args = event.raw_text.split()
         command = command_full.lstrip('/')
         
@@ -138,11 +378,19 @@ class TeleScrapeTracker:
             'scan_group': self.scan_group, 'scan_allgrup': self.scan_all_groups, 
             'scan_unscanned': lambda e, *a: self.scan_all_groups(e, *a, scan_mode='unscanned'),
             'scan_user': self.scan_user_details, 'clear_checkpoint': self.clear_checkpoint, 
-            'scanstatus': self.scan_status, 'addgroup': self.add_group
+            'scanstatus': self.scan_status, 'addgroup': self.add_group,
+            'whois_in': self.whois_in, 'metrics': self.show_metrics,
+            'profile': self.profile, 'export': self.export_histories,
+            'compact': self.compact, 'scanjobs': self.scan_jobs, 'scancancel': self.scan_cancel,
+            'stats': self.show_stats
         }
         
         if command in command_map:
-            await command_map[command](event, *args)
+            try:
+                await command_map[command](event, *args)
+            except ValueError as e:
+                # ID user/grup yang bukan angka ditolak oleh int()/normalize_group_id.
+                await event.reply(f"❌ Argumen tidak valid: `{e}`")
 
     async def show_help(self, event, *args):
         help_text = """
@@ -150,13 +398,21 @@ class TeleScrapeTracker:
 
 Berikut adalah daftar perintah yang tersedia:
 
-- `/hisz <user_id>`: Menampilkan riwayat nama dan username.
+- `/hisz <user_id> [halaman]`: Menampilkan riwayat nama dan username (halaman 2+ dari arsip).
 - `/scan_group <group_id>`: Memindai anggota dari satu grup.
 - `/scan_allgrup`: Memindai **semua** grup dimana bot menjadi anggota.
 - `/scan_unscanned`: Memindai grup yang **belum pernah** discan.
-- `/scan_user <user_id>`: Menemukan grup bersama dengan pengguna.
+- `/scan_user <user_id>`: Menemukan grup bersama dengan pengguna (database dulu, API untuk grup yang basi).
 - `/scanstatus`: Menampilkan status pemindaian grup.
+- `/scanjobs`: Menampilkan antrean scan (berjalan, antre, selesai).
+- `/scancancel <group_id|all>`: Membatalkan job scan di antrean.
 - `/addgroup <group_id>`: Menambahkan grup ke daftar lacak pasif.
+- `/whois_in <group_id>`: Menampilkan user yang pernah terlihat di grup.
+- `/metrics`: Ringkasan latensi database, batch, cache dan event loop.
+- `/profile <detik>`: Mem-profile event loop bot yang sedang berjalan (default 30 detik). Kerja database di thread executor (query MongoDB lewat motor, SQLite) tidak ikut terukur.
+- `/export [group_id|all] [dari] [sampai]`: Ekspor riwayat ke NDJSON.gz (tanggal YYYY-MM-DD).
+- `/compact`: Normalisasi ID grup dan merapikan riwayat duplikat (bisa dilanjutkan).
+- `/stats [group_id|rebuild]`: Statistik global atau per grup; `rebuild` menghitung ulang counter.
 - `/clear_checkpoint <group_id>`: Menghapus progres pemindaian grup.
 - `/help`: Menampilkan pesan bantuan ini.
 
@@ -169,20 +425,24 @@ Klik pada perintah untuk menyalinnya.
             await event.reply("Usage: `/hisz <user_id>`")
             return
             
-        user_id_str = args[0]
-        print(f"   [CMD /hisz] Looking up history for User ID: {user_id_str}")
+        user_id = int(args[0])
+        page = int(args[1]) if len(args) > 1 and args[1].isdigit() else 1
+        if page > 1:
+            await self._show_archived_history(event, user_id, page)
+            return
+        cmd_log.info(f"[CMD /hisz] Looking up history for User ID: {user_id}")
         
         try:
-            live_entity = await self.client.get_entity(int(user_id_str))
-            print(f"   [CMD /hisz] Found live entity, checking for updates...")
+            live_entity = await self.client.get_entity(user_id)
+            cmd_log.info("[CMD /hisz] Found live entity, checking for updates...")
             await self.save_user_data(live_entity)
         except Exception:
             live_entity = None
-            print(f"   [CMD /hisz] Could not fetch live entity for {user_id_str}.")
+            cmd_log.info(f"[CMD /hisz] Could not fetch live entity for {user_id}.")
         
-        history = await self.data_store.get_user_history(user_id_str)
+        history = await self.data_store.get_user_history(user_id)
         if not history:
-            await event.reply(f"❌ Tidak ada riwayat untuk User ID `{user_id_str}`.")
+            await event.reply(f"❌ Tidak ada riwayat untuk User ID `{user_id}`.")
             return
 
         last_entry = history[-1]
@@ -197,99 +457,121 @@ Klik pada perintah untuk menyalinnya.
         else:
             user_link_text = f"<code>{last_entry['full_name']}</code> (Tanpa Username)"
 
-        clickable_user_link = f"<a href='tg://user?id={user_id_str}'>{user_link_text}</a>"
+        clickable_user_link = f"<a href='tg://user?id={user_id}'>{user_link_text}</a>"
         
-        header = (f"**Riwayat untuk ID:** `{user_id_str}`\n"
+        header = (f"**Riwayat untuk ID:** `{user_id}`\n"
                   f"**Profil Terakhir:** {clickable_user_link}")
 
-        history_blocks = []
-        for e in reversed(history):
-            t = time.strftime('%Y-%m-%d', time.localtime(e['timestamp']))
-            u_name = e.get('username')
-            u_display = f"@{u_name}" if u_name else "(Tanpa Username)"
-            history_blocks.append(f"{t}: {e['full_name']} ({u_display})")
+        history_blocks = self._format_history_entries(reversed(history))
+        archived = await self.data_store.count_archived_history(user_id, history[0]['timestamp'])
+        if archived:
+            history_blocks.append(f"... {archived} perubahan lebih lama di arsip")
 
         groups_output = ""
-        for key, title in [('active_chats_snapshot', 'Terlihat di Grup'), ('shared_chats', 'Grup Bersama')]:
-            if chat_ids := last_entry.get(key):
-                titles = [await self._get_chat_title(cid) for cid in chat_ids]
+        seen_in_groups = await self.data_store.get_user_groups(user_id)
+        shared_chats = last_entry.get('shared_chats') or []
+        # Semua judul di-resolve sekaligus secara bersamaan, bukan satu per satu.
+        title_map = await self.title_cache.get_many(seen_in_groups + shared_chats)
+        for chat_ids, title in [(seen_in_groups, 'Terlihat di Grup'), (shared_chats, 'Grup Bersama')]:
+            if chat_ids:
+                titles = [title_map[cid] for cid in chat_ids]
                 groups_output += f"\n\n**{title}:**\n- " + "\n- ".join(titles)
         
-        await event.reply(f"{header}\n\n**Perubahan Identitas:**\n<pre>" + '\n'.join(history_blocks) + "</pre>" + groups_output, parse_mode='html')
+        archive_hint = f"\n\nRiwayat lama: <code>/hisz {user_id} 2</code>" if archived else ""
+        await event.reply(f"{header}\n\n**Perubahan Identitas:**\n<pre>" + '\n'.join(history_blocks) + "</pre>" + groups_output + archive_hint, parse_mode='html')
+
+    @staticmethod
+    def _format_history_entries(entries):
+        blocks = []
+        for e in entries:
+            t = time.strftime('%Y-%m-%d', time.localtime(e['timestamp']))
+            u_name = e.get('username')
+            u_display = f"@{u_name}" if u_name else "(Tanpa Username)"
+            blocks.append(f"{t}: {e['full_name']} ({u_display})")
+        return blocks
+
+    async def _show_archived_history(self, event, user_id, page):
+        # Halaman 2 dst. dibaca langsung dari arsip, hanya satu halaman per perintah.
+        history = await self.data_store.get_user_history(user_id)
+        before = history[0]['timestamp'] if history else float('inf')
+        offset = (page - 2) * self.HISTORY_PAGE_SIZE
+        entries = await self.data_store.get_archived_history(user_id, before, offset, self.HISTORY_PAGE_SIZE + 1)
+        if not entries:
+            await event.reply(f"❌ Tidak ada riwayat arsip halaman {page} untuk User ID `{user_id}`.")
+            return
+        has_more = len(entries) > self.HISTORY_PAGE_SIZE
+        blocks = self._format_history_entries(entries[:self.HISTORY_PAGE_SIZE])
+        next_hint = f"\n\nHalaman berikutnya: <code>/hisz {user_id} {page + 1}</code>" if has_more else ""
+        await event.reply(f"<b>Riwayat arsip untuk ID:</b> <code>{user_id}</code> (hal. {page})\n<pre>" + '\n'.join(blocks) + "</pre>" + next_hint, parse_mode='html')
 
     async def scan_group(self, event, *args):
         if not args:
             await event.reply("Usage: `/scan_group <group_id>`.\nTips: Klik `/scan_group` dari menu /help.")
             return
-        chat_id_str = args[0]
-        if not chat_id_str.startswith("-100"):
-            chat_id_str = "-100" + chat_id_str
+        group_id = normalize_group_id(args[0])
             
-        msg = await event.reply(f"<code>Mempersiapkan pemindaian grup {chat_id_str}...</code>", parse_mode='html')
-        await self._perform_group_scan(chat_id_str, msg)
+        msg = await event.reply(f"<code>Mempersiapkan pemindaian grup {group_id}...</code>", parse_mode='html')
+        if not await self.scan_queue.enqueue([(group_id, None)], event.chat_id, msg.id):
+            await msg.edit(f"ℹ️ Grup `{group_id}` sudah ada di antrean scan. Lihat /scanjobs.")
 
     async def scan_all_groups(self, event, *args, scan_mode='all'):
         mode_text = "semua grup" if scan_mode == 'all' else "grup yang belum discan"
         msg = await event.reply(f"<code>Mempersiapkan scan {mode_text}...</code>", parse_mode='html')
         
         try:
-            dialogs = await self.client.get_dialogs()
-            all_groups = [d.entity for d in dialogs if d.is_group or (d.is_channel and getattr(d.entity, 'megagroup', False))]
+            all_groups = await self.dialogs.get_groups()
         except Exception as e:
             await msg.edit(f"❌ Error: Gagal mendapatkan daftar grup.\n`{e}`")
             return
             
         groups_to_scan = []
         if scan_mode == 'unscanned':
-            print("[ScanUnscanned] Filtering for unscanned groups...")
-            for group in all_groups:
-                gid = str(group.id)
-                if not gid.startswith('-100'): gid = '-100' + gid
-                if gid not in self.completed_scan_group_ids:
-                    groups_to_scan.append(group)
-            print(f"[ScanUnscanned] Found {len(groups_to_scan)} unscanned groups out of {len(all_groups)} total groups.")
+            scan_log.info("[ScanUnscanned] Filtering for unscanned groups...")
+            groups_to_scan = [(gid, info['title']) for gid, info in all_groups.items() if gid not in self.completed_scan_group_ids]
+            scan_log.info(f"[ScanUnscanned] Found {len(groups_to_scan)} unscanned groups out of {len(all_groups)} total groups.")
         else:
-            groups_to_scan = all_groups
-            print(f"[ScanAll] Found {len(groups_to_scan)} groups to scan.")
+            groups_to_scan = [(gid, info['title']) for gid, info in all_groups.items()]
+            scan_log.info(f"[ScanAll] Found {len(groups_to_scan)} groups to scan.")
 
         if not groups_to_scan:
             await msg.edit("✅ Tidak ada grup baru untuk discan. Semua sudah terindeks.")
             return
 
-        summary = {"scanned": 0, "failed": []}
-        total_to_scan = len(groups_to_scan)
-        for i, chat in enumerate(groups_to_scan):
-            chat_id_str = str(chat.id)
-            if not chat_id_str.startswith("-100"): chat_id_str = "-100" + chat_id_str
+        scan_title = "SCAN UNSCANNED" if scan_mode == 'unscanned' else "SCAN SEMUA GRUP"
+        jobs = await self.scan_queue.enqueue(groups_to_scan, event.chat_id, msg.id, label=scan_title)
+        skipped = len(groups_to_scan) - len(jobs)
+        await msg.edit(f"<pre>{scan_title}\n{len(jobs)} grup masuk antrean{f' ({skipped} sudah antre)' if skipped else ''}.\nProgres tampil di pesan ini; lihat juga /scanjobs.</pre>", parse_mode='html')
 
-            scan_title = "SCAN UNSCANNED" if scan_mode == 'unscanned' else "SCAN SEMUA GRUP"
-            print(f"   [{'ScanUnscanned' if scan_mode == 'unscanned' else 'ScanAll'}] Scanning group {i+1}/{total_to_scan}: {chat.title} ({chat_id_str})")
-            await self._update_scan_msg(msg, f"{scan_title} ({i+1}/{total_to_scan})\nGRUP: {chat.title}", 0)
-            
+    async def _job_message(self, job):
+        """Pesan progres milik job; dibuat ulang jika pesan lama tidak bisa diambil (mis. setelah restart lama)."""
+        chat_id = job.get('report_chat_id') or self.ADMIN_IDS[0]
+        msg = None
+        if job.get('report_msg_id'):
             try:
-                if await self._perform_group_scan(chat_id_str, msg):
-                    summary["scanned"] += 1
-                else:
-                    summary["failed"].append(chat.title)
-            except Exception as e:
-                print(f"   [{'ScanUnscanned' if scan_mode == 'unscanned' else 'ScanAll'}] CRITICAL error scanning {chat.title}: {e}")
-                summary["failed"].append(f"{chat.title} (Error)")
+                msg = await self.client.get_messages(chat_id, ids=job['report_msg_id'])
+            except Exception:
+                msg = None
+        return msg or await self.client.send_message(chat_id, f"<code>Melanjutkan scan {job['group_id']}...</code>", parse_mode='html')
 
-            if i < total_to_scan - 1:
-                print("   [Scan] Pausing for 10 seconds...")
-                await asyncio.sleep(10)
+    async def _run_scan_job(self, job):
+        msg = await self._job_message(job)
+        if job.get('label'):
+            await self._update_scan_msg(msg, f"{job['label']}\nGRUP: {job.get('title') or job['group_id']}", 0)
+        return await self._perform_group_scan(job['group_id'], msg)
 
-        failed_list = "\n- ".join(summary['failed'])
-        final_text = f"✅ **PEMINDAIAN SELESAI ({mode_text.upper()})**\n\nSukses: {summary['scanned']}\nGagal: {len(summary['failed'])}"
-        if summary['failed']:
-            final_text += f"\n\n**Grup Gagal:**\n- {failed_list}"
-        await msg.edit(final_text, parse_mode='md')
+    async def _report_scan_batch(self, jobs):
+        if len(jobs) < 2:
+            return
+        failed = [job.get('title') or job['group_id'] for job in jobs if job['state'] != DONE]
+        final_text = f"✅ **PEMINDAIAN SELESAI ({jobs[0].get('label', '').rsplit(' (', 1)[0]})**\n\nSukses: {len(jobs) - len(failed)}\nGagal/Dibatalkan: {len(failed)}"
+        if failed:
+            final_text += "\n\n**Grup Gagal/Dibatalkan:**\n- " + "\n- ".join(failed)
+        await self.client.send_message(jobs[0].get('report_chat_id') or self.ADMIN_IDS[0], final_text[:4000], reply_to=jobs[0].get('report_msg_id'), parse_mode='md')
 
-    async def _perform_group_scan(self, chat_id_str: str, msg):
-        print(f"🔎 [Scan] Initiating scan for Chat ID: {chat_id_str}")
+    async def _perform_group_scan(self, group_id: int, msg):
+        scan_log.info(f"🔎 [Scan] Initiating scan for Chat ID: {group_id}")
         try:
-            chat_peer_id = int(chat_id_str)
-            chat = await self.client.get_entity(chat_peer_id)
+            chat = await self.client.get_entity(group_id)
             if isinstance(chat, User):
                 await msg.edit("❌ Error: ID ini milik pengguna, bukan grup."); return False
             
@@ -297,21 +579,26 @@ Klik pada perintah untuk menyalinnya.
                 full = await self.client(GetFullChannelRequest(channel=chat))
                 count = full.full_chat.participants_count
             except TypeError:
-                full = await self.client(GetFullChatRequest(chat_id=chat_peer_id))
+                full = await self.client(GetFullChatRequest(chat_id=chat.id))
                 count = len(full.users)
             title = chat.title
         except Exception as e:
-            await msg.edit(f"❌ Error: Tidak dapat mengakses grup {chat_id_str}.\n`{e}`"); return False
+            await msg.edit(f"❌ Error: Tidak dapat mengakses grup {group_id}.\n`{e}`"); return False
         
-        print(f"   [Scan] Group '{title}' has {count} members.")
-        if count < 10000:
-            await self._direct_scan_group(msg, chat, chat_id_str, count, title)
-        else:
-            await self._filtered_scan_group(msg, chat, chat_id_str, title)
+        scan_log.info(f"[Scan] Group '{title}' has {count} members.")
+        await self.title_cache.prime(group_id, title)
+        try:
+            if count < 10000:
+                await self._direct_scan_group(msg, chat, group_id, count, title)
+            else:
+                await self._filtered_scan_group(msg, chat, group_id, title)
+        except Exception as e:
+            scan_log.error(f"❗️ [Scan] Scan for '{title}' ({group_id}) failed: {e}")
+            await msg.edit(f"❌ Error: Pemindaian grup {title} gagal.\n`{e}`"); return False
         
-        await self.data_store.mark_scan_as_completed(chat_id_str)
-        self.completed_scan_group_ids.add(chat_id_str)
-        print(f"✅ [Scan] Finished scan for '{title}' ({chat_id_str}). Added to passive tracking list.")
+        await self.data_store.mark_scan_as_completed(group_id)
+        await self._set_whitelisted(group_id, True)
+        scan_log.info(f"✅ [Scan] Finished scan for '{title}' ({group_id}). Added to passive tracking list.")
         return True
 
     async def _update_scan_msg(self, msg, text, last_edit_time):
@@ -323,100 +610,133 @@ Klik pada perintah untuk menyalinnya.
                 pass
         return last_edit_time
 
-    async def _direct_scan_group(self, msg, chat, chat_id_str, count, title):
-        processed, saved, last_edit, batch = 0, 0, 0, []
-        print(f"   [Scan Direct] Starting direct scan for '{title}'.")
-        async for p in self.client.iter_participants(chat):
-            processed += 1
-            if p.id != self.my_id and not p.bot:
-                batch.append({'user_entity': p, 'active_chat_id': chat_id_str})
-
-            if len(batch) >= self.BATCH_SIZE:
-                saved_in_batch = await self.data_store.update_user_history_batch(batch)
-                saved += saved_in_batch
-                batch = []
-                print(f"   [Scan Direct] Batch of {self.BATCH_SIZE} processed for '{title}'. Saved: {saved_in_batch}")
-            
-            text = f"GROUP: {title}\nMETHOD: Direct (Batch)\nPROCESSED: {processed}/{count}\nSAVED: {saved}"
-            last_edit = await self._update_scan_msg(msg, text, last_edit)
-            
-        if batch:
-            saved_in_batch = await self.data_store.update_user_history_batch(batch)
-            saved += saved_in_batch
+    def _new_scan_pipeline(self, label):
+        return ScanWritePipeline(self.data_store, self.BATCH_SIZE, self.SCAN_WRITERS, self.SCAN_QUEUE_BATCHES, label)
+
+    async def _direct_scan_group(self, msg, chat, group_id, count, title):
+        # Urutan peserta dari Telegram tidak stabil antar run, jadi tidak ada posisi yang bisa di-checkpoint: scan
+        # yang terputus diulang dari awal (user yang tidak berubah dilewati dedup) dan hanya penyelesaian yang dicatat.
+        processed, last_edit = 0, 0
+        scan_log.info(f"[Scan Direct] Starting direct scan for '{title}'.")
+        pipeline = self._new_scan_pipeline('Scan Direct')
+        try:
+            async for p in self.client.iter_participants(chat):
+                processed += 1
+                if p.id != self.my_id and not p.bot:
+                    await pipeline.put({'user_entity': p, 'active_chat_id': group_id})
+
+                text = f"GROUP: {title}\nMETHOD: Direct (Batch)\nPROCESSED: {processed}/{count}\nSAVED: {pipeline.saved}"
+                last_edit = await self._update_scan_msg(msg, text, last_edit)
+        finally:
+            await pipeline.close()
 
-        final_text = f"GROUP: {title}\nSTATUS: ✅ Scan Selesai\nTOTAL DISIMPAN: {saved}"
+        final_text = f"GROUP: {title}\nSTATUS: ✅ Scan Selesai\nTOTAL DISIMPAN: {pipeline.saved}"
         await msg.edit(f"<pre>{final_text}</pre>", parse_mode='html')
+        await self.data_store.update_scan_status(group_id, {})
 
-    async def _filtered_scan_group(self, msg, chat, chat_id_str, title):
-        print(f"   [Scan Filtered] Starting filtered scan for '{title}' (members > 10k).")
-        status = await self.data_store.get_scan_status(chat_id_str)
+    async def _filtered_scan_group(self, msg, chat, group_id, title):
+        scan_log.info(f"[Scan Filtered] Starting filtered scan for '{title}' (members > 10k).")
+        status = await self.data_store.get_scan_status(group_id)
         alphabet = "abcdefghijklmnopqrstuvwxyz"
         filter_idx = status.get('filter_index', 0)
-        saved = status.get('total_saved_since_start', 0)
+        saved_before = status.get('total_saved_since_start', 0)
+        pipeline = self._new_scan_pipeline('Scan Filtered')
 
-        for i in range(filter_idx, len(alphabet)):
-            char = alphabet[i]
-            print(f"   [Scan Filtered] Applying filter: '{char}' in group '{title}'")
-            await self._update_scan_msg(msg, f"GROUP: {title}\nMETHOD: Filtered\nFILTER: '{char}'\nSAVED: {saved}", 0)
-            
-            batch = []
-            try:
-                async for p in self.client.iter_participants(chat, search=char):
-                    if p.id != self.my_id and not p.bot:
-                        batch.append({'user_entity': p, 'active_chat_id': chat_id_str})
-
-                    if len(batch) >= self.BATCH_SIZE:
-                        saved_in_batch = await self.data_store.update_user_history_batch(batch)
-                        saved += saved_in_batch
-                        batch = []
-                        print(f"   [Scan Filtered] Batch of {self.BATCH_SIZE} for filter '{char}'. Saved: {saved_in_batch}")
-
-                if batch:
-                    saved_in_batch = await self.data_store.update_user_history_batch(batch)
-                    saved += saved_in_batch
+        try:
+            for i in range(filter_idx, len(alphabet)):
+                char = alphabet[i]
+                scan_log.info(f"[Scan Filtered] Applying filter: '{char}' in group '{title}'")
+                await self._update_scan_msg(msg, f"GROUP: {title}\nMETHOD: Filtered\nFILTER: '{char}'\nSAVED: {saved_before + pipeline.saved}", 0)
                 
-                await self.data_store.update_scan_status(chat_id_str, {'filter_index': i + 1, 'total_saved_since_start': saved})
+                try:
+                    async for p in self.client.iter_participants(chat, search=char):
+                        if p.id != self.my_id and not p.bot:
+                            await pipeline.put({'user_entity': p, 'active_chat_id': group_id})
+                except Exception as e:
+                    if pipeline.error is not None:
+                        raise
+                    scan_log.warning(f"❗️ [Scan Filtered] Error on filter '{char}': {e}. Skipping to next.")
+                    await asyncio.sleep(10)
+                    continue
+
+                # Checkpoint hanya disimpan setelah semua batch filter ini tertulis.
+                await pipeline.drain()
+                await self.data_store.update_scan_status(group_id, {'filter_index': i + 1, 'total_saved_since_start': saved_before + pipeline.saved})
                 await asyncio.sleep(3)
-            except Exception as e:
-                print(f"❗️ [Scan Filtered] Error on filter '{char}': {e}. Skipping to next.")
-                await asyncio.sleep(10)
-                continue
+        finally:
+            await pipeline.close()
 
-        final_text = f"GROUP: {title}\nSTATUS: ✅ Scan Selesai\nTOTAL DISIMPAN: {saved}"
+        final_text = f"GROUP: {title}\nSTATUS: ✅ Scan Selesai\nTOTAL DISIMPAN: {saved_before + pipeline.saved}"
         await msg.edit(f"<pre>{final_text}</pre>", parse_mode='html')
-        await self.data_store.update_scan_status(chat_id_str, {})
+        await self.data_store.update_scan_status(group_id, {})
+
+    async def _probe_membership(self, chat, user):
+        """Cek langsung ke Telegram apakah user ada di grup (satu panggilan API per grup)."""
+        if isinstance(chat, Channel):
+            try:
+                await self.client(GetParticipantRequest(channel=chat, participant=user))
+                return True
+            except UserNotParticipantError:
+                return False
+        participants = await self.client.get_participants(chat)
+        return any(p.id == user.id for p in participants)
 
     async def scan_user_details(self, event, *args):
         if not args:
             await event.reply("Usage: `/scan_user <user_id>`")
             return
             
-        user_id_str = args[0]
-        msg = await event.reply(f"<code>Mencari grup bersama dengan user {user_id_str}...</code>", parse_mode='html')
-        print(f"   [CMD /scan_user] Finding common chats with {user_id_str}")
+        user_id = int(args[0])
+        msg = await event.reply(f"<code>Mencari grup bersama dengan user {user_id}...</code>", parse_mode='html')
+        cmd_log.info(f"[CMD /scan_user] Finding common chats with {user_id}")
         try:
-            user = await self.client.get_entity(int(user_id_str))
-            common_chats = []
-            
-            # --- PERBAIKAN: Implementasi manual yang andal ---
-            dialogs = await self.client.get_dialogs()
-            for dialog in dialogs:
-                if dialog.is_group or (dialog.is_channel and getattr(dialog.entity, 'megagroup', False)):
+            # 1. Jawaban utama dari database lokal (query memberships ber-index).
+            local_groups = set(await self.data_store.get_user_groups(user_id))
+            scan_times = await self.data_store.get_scan_completion_times()
+            try:
+                user = await self.client.get_entity(user_id)
+            except Exception:
+                user = None
+                cmd_log.info(f"[CMD /scan_user] Could not fetch live entity for {user_id}, answering from DB only.")
+
+            # 2. API hanya untuk grup yang datanya belum ada atau sudah basi.
+            fresh_after = time.time() - self.SCAN_USER_STALE_AFTER
+            skipped, to_probe = 0, []
+            for gid, info in (await self.dialogs.get_groups()).items():
+                if gid in local_groups:
+                    continue
+                if scan_times.get(gid, 0) >= fresh_after:
+                    skipped += 1
+                else:
+                    to_probe.append((gid, info['entity']))
+
+            api_groups = []
+            if user is not None:
+                cmd_log.info(f"[CMD /scan_user] {len(local_groups)} groups from DB, probing {len(to_probe)} stale/unscanned groups via API.")
+                for gid, chat in to_probe:
                     try:
-                        # Metode efisien untuk memeriksa apakah satu user ada di grup
-                        participants = await self.client.get_participants(dialog.entity, filter=User, search=user.username)
-                        if participants:
-                             common_chats.append(dialog.entity)
-                    except Exception as e:
+                        if await self._probe_membership(chat, user):
+                            api_groups.append(gid)
+                    except Exception:
                         # Abaikan grup di mana kita tidak memiliki izin
-                        # print(f"   [ScanUser] Could not check participants in '{dialog.title}': {e}")
                         pass
-            
-            common_chat_ids = [str(c.id) for c in common_chats]
-            if await self.save_user_data(user, shared_chats=common_chat_ids):
-                await msg.edit(f"✅ Data grup bersama untuk `{user_id_str}` telah diperbarui.")
-            else:
-                await msg.edit(f"ℹ️ Tidak ada data baru untuk disimpan bagi `{user_id_str}`.")
+                if api_groups:
+                    await self.data_store.record_memberships([(user_id, gid) for gid in api_groups])
+
+            common_chat_ids = sorted(local_groups | set(api_groups))
+            updated = user is not None and await self.save_user_data(user, shared_chats=common_chat_ids)
+
+            title_map = await self.title_cache.get_many(common_chat_ids)
+            header = f"🔎 **Grup bersama untuk** `{user_id}`\n"
+            sections = [
+                f"📦 **Dari database ({len(local_groups)}):**\n" + ('\n'.join(f"- {title_map[g]} (`{g}`)" for g in sorted(local_groups)) or "Tidak ada."),
+                f"🌐 **Dari API ({len(api_groups)} dari {len(to_probe)} dicek):**\n" + ('\n'.join(f"- {title_map[g]} (`{g}`)" for g in api_groups) or "Tidak ada."),
+                f"⏭️ Dilewati (scan masih baru, user tidak tercatat): {skipped} grup",
+            ]
+            if user is None:
+                sections.append("⚠️ Entitas user tidak bisa diambil, pengecekan API dilewati.")
+            sections.append("✅ Data grup bersama telah diperbarui." if updated else "ℹ️ Tidak ada data identitas baru untuk disimpan.")
+            await self.send_long_message(msg, header, '\n\n'.join(sections))
         except Exception as e:
             await msg.edit(f"❌ Error: Gagal memindai user.\n`{e}`")
 
@@ -424,25 +744,16 @@ Klik pada perintah untuk menyalinnya.
         if not args:
             await event.reply("Usage: `/clear_checkpoint <group_id>`")
             return
-        chat_id_str = args[0]
-        await self.data_store.clear_scan_record(chat_id_str)
-        if chat_id_str in self.completed_scan_group_ids:
-            self.completed_scan_group_ids.remove(chat_id_str)
-        await event.reply(f"✅ Catatan pemindaian dan status selesai untuk grup `{chat_id_str}` telah dihapus.")
-        print(f"   [CMD /clear_checkpoint] Cleared checkpoint for {chat_id_str}")
+        group_id = normalize_group_id(args[0])
+        await self.data_store.clear_scan_record(group_id)
+        await self._set_whitelisted(group_id, False)
+        await event.reply(f"✅ Catatan pemindaian dan status selesai untuk grup `{group_id}` telah dihapus.")
+        cmd_log.info(f"[CMD /clear_checkpoint] Cleared checkpoint for {group_id}")
 
     async def scan_status(self, event, *args):
         msg = await event.reply("<code>Mengambil status pemindaian...</code>", parse_mode='html')
         try:
-            dialogs = await self.client.get_dialogs()
-            
-            groups = {}
-            for d in dialogs:
-                if d.is_group or (d.is_channel and getattr(d.entity, 'megagroup', False)):
-                    gid = str(d.entity.id)
-                    if not gid.startswith('-100'):
-                        gid = '-100' + gid
-                    groups[gid] = d.entity.title
+            groups = {gid: info['title'] for gid, info in (await self.dialogs.get_groups()).items()}
             
             scanned_ids = self.completed_scan_group_ids
             scanned_list = [f"- {groups.get(gid, '[N/A]')} (`{gid}`)" for gid in scanned_ids if gid in groups]
@@ -463,6 +774,30 @@ Klik pada perintah untuk menyalinnya.
         except Exception as e:
             await msg.edit(f"❌ Error saat mengambil status: `{e}`")
 
+    async def scan_jobs(self, event, *args):
+        current, queued, finished = await self.scan_queue.status()
+
+        def describe(job):
+            return f"{job.get('title') or job['group_id']} ({job['group_id']})"
+
+        lines = ["BERJALAN:", f"- {describe(current)}" if current else "- (tidak ada)"]
+        lines.append(f"\nANTRE ({len(queued)}):")
+        lines.extend(f"- {describe(job)}" for job in queued[:30])
+        if len(queued) > 30:
+            lines.append(f"- ... dan {len(queued) - 30} lainnya")
+        lines.append("\nSELESAI TERAKHIR:")
+        lines.extend(f"- [{job['state']}] {describe(job)} {time.strftime('%m-%d %H:%M', time.localtime(job['updated_at']))}" for job in finished)
+        await event.reply(f"<pre>{html.escape(chr(10).join(lines))[:4000]}</pre>", parse_mode='html')
+
+    async def scan_cancel(self, event, *args):
+        if not args:
+            await event.reply("Usage: `/scancancel <group_id|all>`")
+            return
+        group_id = None if args[0] == 'all' else normalize_group_id(args[0])
+        cancelled = await self.scan_queue.cancel(group_id)
+        cmd_log.info(f"[CMD /scancancel] Cancelled {cancelled} scan jobs ({group_id or 'all'})")
+        await event.reply(f"✅ {cancelled} job scan dibatalkan. Checkpoint grup tetap disimpan; /clear_checkpoint untuk mengulang dari awal.")
+
     async def send_long_message(self, base_msg, header, body, is_reply=False):
         """Fungsi utilitas untuk mengirim pesan panjang, memecahnya jika perlu."""
         MAX_LEN = 4000 # Batas aman (maks 4096)
@@ -470,10 +805,9 @@ Klik pada perintah untuk menyalinnya.
         # Jika pesan keseluruhan cukup pendek, kirim/edit saja
         if len(header) + len(body) < MAX_LEN:
             if is_reply:
-                await base_msg.reply(header + body, parse_mode='md')
-            else:
-                await base_msg.edit(header + body, parse_mode='md')
-            return
+                return await base_msg.reply(header + body, parse_mode='md')
+            await base_msg.edit(header + body, parse_mode='md')
+            return base_msg
 
         # Jika panjang, pecah bagian body
         chunks = [body[i:i + MAX_LEN] for i in range(0, len(body), MAX_LEN)]
@@ -489,16 +823,206 @@ Klik pada perintah untuk menyalinnya.
         # Kirim sisa potongan sebagai balasan
         for chunk in chunks:
             current_msg = await current_msg.reply(chunk, parse_mode='md')
+        return current_msg
 
     async def add_group(self, event, *args):
         if not args:
             await event.reply("Usage: `/addgroup <group_id>`")
             return
-        group_id_str = args[0]
-        await self.data_store.add_completed_scan_id(group_id_str)
-        self.completed_scan_group_ids.add(group_id_str)
-        await event.reply(f"✅ Grup `{group_id_str}` ditambahkan ke daftar pelacakan pasif secara manual.")
-        print(f"   [CMD /addgroup] Manually added {group_id_str} to passive tracking list.")
+        group_id = normalize_group_id(args[0])
+        await self.data_store.add_completed_scan_id(group_id)
+        await self._set_whitelisted(group_id, True)
+        await event.reply(f"✅ Grup `{group_id}` ditambahkan ke daftar pelacakan pasif secara manual.")
+        cmd_log.info(f"[CMD /addgroup] Manually added {group_id} to passive tracking list.")
+
+    async def whois_in(self, event, *args):
+        if not args:
+            await event.reply("Usage: `/whois_in <group_id>`")
+            return
+        group_id = normalize_group_id(args[0])
+        cmd_log.info(f"[CMD /whois_in] Looking up users seen in {group_id}")
+
+        msg = await event.reply(f"<code>Mencari user yang terlihat di grup {group_id}...</code>", parse_mode='html')
+        title = await self._get_chat_title(group_id)
+        current_msg, total, page_no = msg, 0, 0
+        # Hanya satu halaman yang ada di memori pada satu waktu.
+        async for page in self.data_store.iter_group_members(group_id, self.WHOIS_PAGE_SIZE):
+            page_no += 1
+            total += len(page)
+            header = f"👥 **User di {title}** (hal. {page_no}):\n"
+            body = '\n'.join(f"- `{uid}`" for uid in page)
+            current_msg = await self.send_long_message(current_msg, header, body, is_reply=page_no > 1)
+            await asyncio.sleep(1)
+
+        if not total:
+            await msg.edit(f"❌ Tidak ada user tercatat untuk grup `{group_id}`.")
+            return
+        await current_msg.reply(f"✅ Total: {total} user di grup `{group_id}`.")
+        cmd_log.info(f"[CMD /whois_in] Sent {total} users in {page_no} pages for {group_id}")
+
+    async def export_histories(self, event, *args):
+        if self._export_lock.locked():
+            await event.reply("⏳ Ekspor lain masih berjalan.")
+            return
+        group_id = normalize_group_id(args[0]) if args and args[0] != 'all' else None
+        try:
+            since, until = parse_time(args[1] if len(args) > 1 else None), parse_time(args[2] if len(args) > 2 else None)
+        except ValueError:
+            await event.reply("Usage: `/export [group_id|all] [YYYY-MM-DD] [YYYY-MM-DD]`")
+            return
+        cmd_log.info(f"[CMD /export] Exporting {group_id or 'all users'} (since={since}, until={until})")
+
+        label = f"{group_id or 'all'}-{time.strftime('%Y%m%d-%H%M%S')}"
+        msg = await event.reply(f"<code>Mengekspor riwayat ({group_id or 'semua user'})...</code>", parse_mode='html')
+        exporter = HistoryExporter(self.data_store, self.EXPORT_DIR, f"users-{label}", self.EXPORT_PART_SIZE)
+        last_edit_time = 0
+
+        async def progress(records, parts):
+            nonlocal last_edit_time
+            last_edit_time = await self._update_scan_msg(msg, f"EKSPOR: {group_id or 'semua user'}\nUser: {records}\nPart: {parts}", last_edit_time)
+
+        async with self._export_lock:
+            try:
+                records, parts = await exporter.export(group_id, since, until, progress)
+            except Exception as e:
+                cmd_log.error(f"[CMD /export] Export failed: {e}")
+                await msg.edit(f"❌ Ekspor gagal setelah {exporter.records} user: {e}")
+                return
+
+        part_list = "\n".join(f"- `{path}`" for path in parts) or "- (tidak ada data)"
+        await msg.edit(f"✅ Ekspor selesai: {records} user dalam {len(parts)} part.\n{part_list}")
+        cmd_log.info(f"[CMD /export] Exported {records} users to {len(parts)} parts")
+
+    async def compact(self, event, *args):
+        if self._compaction_lock.locked():
+            await event.reply("⏳ Pemeliharaan masih berjalan.")
+            return
+        checkpoint = await self.data_store.get_job_checkpoint('compaction')
+        resume_note = f" (melanjutkan setelah user {checkpoint['after_user_id']})" if checkpoint.get('after_user_id') is not None else ""
+        msg = await event.reply(f"<code>Memulai pemeliharaan database{resume_note}...</code>", parse_mode='html')
+        cmd_log.info(f"[CMD /compact] Starting compaction{resume_note}")
+        last_edit_time = 0
+
+        async def progress(scanned, changed):
+            nonlocal last_edit_time
+            last_edit_time = await self._update_scan_msg(msg, f"PEMELIHARAAN\nUser dicek: {scanned}\nRiwayat dirapikan: {changed}", last_edit_time)
+
+        async with self._compaction_lock:
+            try:
+                normalized, scanned, changed, backfilled = await self.data_store.run_compaction(self.COMPACTION_BATCH_SIZE, self.COMPACTION_PAUSE, progress)
+            except Exception as e:
+                cmd_log.error(f"[CMD /compact] Compaction failed: {e}")
+                await msg.edit(f"❌ Pemeliharaan berhenti: {e}\nJalankan /compact lagi untuk melanjutkan dari checkpoint.")
+                return
+        await self._reload_whitelist()
+        await self.cache_sync.publish('whitelist', [('reload', None, None)])
+        await msg.edit(f"✅ Pemeliharaan selesai.\n- ID grup dinormalisasi: {normalized}\n- User dicek: {scanned}\n- Riwayat dirapikan: {changed}\n- Arsip dilengkapi: {backfilled}")
+
+    async def show_stats(self, event, *args):
+        if args and args[0] == 'rebuild':
+            await self.rebuild_stats(event)
+            return
+
+        def when(ts):
+            return time.strftime('%Y-%m-%d %H:%M', time.localtime(ts)) if ts else "-"
+
+        if not args:
+            stats = await self.data_store.get_stats(GLOBAL_STATS_SCOPE)
+            await event.reply(
+                "📊 **Statistik Global**\n"
+                f"- User tercatat: {stats.get('users', 0)}\n"
+                f"- Perubahan identitas: {stats.get('identity_changes', 0)}\n"
+                f"- Keanggotaan grup: {stats.get('memberships', 0)}\n"
+                f"- Grup dilacak pasif: {len(self.completed_scan_group_ids)}\n"
+                f"- Aktivitas terakhir: {when(stats.get('last_activity'))}"
+            )
+            return
+        group_id = normalize_group_id(args[0])
+        stats = await self.data_store.get_stats(group_id)
+        if not stats:
+            await event.reply(f"ℹ️ Belum ada statistik untuk grup `{group_id}`.")
+            return
+        title = self.title_cache.peek(group_id) or group_id
+        tracked = "ya" if group_id in self.completed_scan_group_ids else "tidak"
+        await event.reply(
+            f"📊 **Statistik {title}** (`{group_id}`)\n"
+            f"- Anggota tercatat: {stats.get('members', 0)}\n"
+            f"- Perubahan identitas terlihat: {stats.get('identity_changes', 0)}\n"
+            f"- Dilacak pasif: {tracked}\n"
+            f"- Aktivitas terakhir: {when(stats.get('last_activity'))}"
+        )
+
+    async def rebuild_stats(self, event):
+        if self._compaction_lock.locked():
+            await event.reply("⏳ Pemeliharaan masih berjalan.")
+            return
+        msg = await event.reply("<code>Menghitung ulang statistik...</code>", parse_mode='html')
+        cmd_log.info("[CMD /stats] Rebuilding counters")
+        started = time.perf_counter()
+        async with self._compaction_lock:
+            try:
+                scopes = await self.data_store.rebuild_stats()
+            except Exception as e:
+                cmd_log.error(f"[CMD /stats] Rebuild failed: {e}")
+                await msg.edit(f"❌ Gagal menghitung ulang statistik: {e}")
+                return
+        await msg.edit(f"✅ Statistik dihitung ulang: {scopes} counter dalam {time.perf_counter() - started:.1f} detik.")
+
+    async def show_metrics(self, event, *args):
+        def ms(value):
+            return "-" if value is None else ("inf" if value == float('inf') else f"{value * 1000:.0f}")
+
+        lines = ["DATABASE (calls, err, p50/p99 ms)"]
+        ops = sorted({dict(key)['op'] for key in DB_CALL_SECONDS.series})
+        for op in ops:
+            backend = next(dict(key)['backend'] for key in DB_CALL_SECONDS.series if dict(key)['op'] == op)
+            ok = DB_CALLS.get(backend=backend, op=op, status='ok')
+            err = DB_CALLS.get(backend=backend, op=op, status='error')
+            lines.append(f"{op[:30]:<30} {ok + err:>7} {err:>4} {ms(DB_CALL_SECONDS.quantile(0.5, backend=backend, op=op)):>5}/{ms(DB_CALL_SECONDS.quantile(0.99, backend=backend, op=op))}")
+
+        lines.append("\nBULK WRITES (batches, avg size)")
+        for key, series in DB_BULK_SIZE.series.items():
+            lines.append(f"{dict(key)['collection']:<30} {series['count']:>7} {series['sum'] / series['count']:.1f}")
+
+        lines.append("\nPASSIVE HANDLER (count, p50/p99 ms)")
+        for outcome in ('tracked', 'skipped'):
+            series = PASSIVE_HANDLER_SECONDS.series.get((('outcome', outcome),))
+            if series:
+                lines.append(f"{outcome:<30} {series['count']:>7} {ms(PASSIVE_HANDLER_SECONDS.quantile(0.5, outcome=outcome))}/{ms(PASSIVE_HANDLER_SECONDS.quantile(0.99, outcome=outcome))}")
+
+        lines.append("\nCACHE (hit rate, entries)")
+        for name, cache in (('identity', self.data_store.identity_cache), ('chat_title', self.title_cache)):
+            total = cache.hits + cache.misses
+            lines.append(f"{name:<30} {(cache.hits / total * 100 if total else 0):>6.1f}% {len(cache)}")
+
+        lines.append(f"\nEVENT LOOP LAG p50/p99 ms: {ms(EVENT_LOOP_LAG.quantile(0.5))}/{ms(EVENT_LOOP_LAG.quantile(0.99))}")
+        lines.append(f"PASSIVE BUFFER PENDING: {len(self.passive_buffer)}")
+        lines.append(f"PASSIVE DEDUPLICATED: {PASSIVE_DEDUPLICATED.get()} (window {self.SENDER_DEDUP_WINDOW:.0f}s, {len(self.recent_senders)} keys)")
+        lines.append(f"RETRY SPOOL: {len(self.retry_spool)} user ({self.retry_spool.size_bytes() / 1024:.1f} KB)")
+        lines.append(f"CACHE SYNC: versi {self.cache_sync.version}, diterapkan {self.cache_sync.applied}, reload penuh {self.cache_sync.resyncs}")
+        lines.append("STARTUP (s): " + ", ".join(f"{phase} {seconds:.2f}" for phase, seconds in self.startup_timings.items()))
+        await event.reply(f"<pre>{chr(10).join(lines)[:4000]}</pre>", parse_mode='html')
+
+    async def profile(self, event, *args):
+        if self.profiler.running:
+            await event.reply("⏳ Profiling sedang berjalan, tunggu sampai selesai.")
+            return
+        try:
+            seconds = float(args[0]) if args else 30
+        except ValueError:
+            await event.reply("Usage: `/profile <detik>`")
+            return
+        # Durasi dibatasi oleh LoopProfiler.profile_for; ringkasannya mencantumkan durasi sebenarnya.
+        msg = await event.reply(f"<code>Profiling event loop selama {seconds:g} detik (maks {LoopProfiler.MAX_SECONDS})...</code>", parse_mode='html')
+        cmd_log.info(f"[CMD /profile] Profiling for {seconds:g}s")
+
+        summary, path = await self.profiler.profile_for(seconds)
+        try:
+            await msg.edit(f"<pre>{html.escape(summary[:3900])}</pre>", parse_mode='html')
+            await self.client.send_file(event.chat_id, path, caption="📎 Profil lengkap (buka dengan pstats/snakeviz).", reply_to=msg.id)
+        finally:
+            os.remove(path)
+        cmd_log.info("[CMD /profile] Profile sent.")
 
 if __name__ == '__main__':
     bot = TeleScrapeTracker()
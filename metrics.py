@@ -0,0 +1,191 @@
+"""Metrik ringan (counter, gauge, histogram) dengan output format teks Prometheus.
+
+Tidak butuh dependensi tambahan: registry global `REGISTRY` dipakai oleh
+datastore dan handler bot, lalu diekspos lewat endpoint HTTP lokal opsional
+(`start_http_server`) dan perintah admin /metrics.
+"""
+import asyncio
+import bisect
+import time
+
+from log import get_logger
+
+log = get_logger('metrics')
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 300, 500, 1000, 5000)
+
+
+def _label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name, self.help = name, help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, (), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback=None):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        self.values[_label_key(labels)] = value
+
+    def samples(self):
+        if self.callback is not None:
+            for labels, value in self.callback():
+                self.set(value, **labels)
+        yield from super().samples()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name, self.help = name, help_text
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+        series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def quantile(self, q, **labels):
+        """Perkiraan kuantil dari bucket (batas atas bucket yang memuat kuantil)."""
+        series = self.series.get(_label_key(labels))
+        if not series or not series['count']:
+            return None
+        target, running = q * series['count'], 0
+        for bound, count in zip(self.buckets + (float('inf'),), series['counts']):
+            running += count
+            if running >= target:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        for key, series in self.series.items():
+            running = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series['counts']):
+                running += count
+                yield f"{self.name}_bucket", key, (('le', '+Inf' if bound == float('inf') else bound),), running
+            yield f"{self.name}_sum", key, (), series['sum']
+            yield f"{self.name}_count", key, (), series['count']
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, callback=None):
+        return self._register(Gauge(name, help_text, callback))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+DB_CALLS = REGISTRY.counter('db_calls_total', 'Datastore calls by operation and outcome.')
+DB_CALL_SECONDS = REGISTRY.histogram('db_call_seconds', 'Datastore call latency in seconds.')
+DB_BULK_SIZE = REGISTRY.histogram('db_bulk_write_size', 'Operations per bulk write.', SIZE_BUCKETS)
+DB_BULK_UPSERTED = REGISTRY.counter('db_bulk_upserted_total', 'Documents inserted/upserted by bulk writes.')
+DB_BULK_MODIFIED = REGISTRY.counter('db_bulk_modified_total', 'Documents modified by bulk writes.')
+PASSIVE_HANDLER_SECONDS = REGISTRY.histogram('passive_handler_seconds', 'handle_passive_tracking latency in seconds.')
+PASSIVE_DEDUPLICATED = REGISTRY.counter('passive_events_deduplicated_total', 'Passive events dropped because the same sender and identity was seen within the dedup window.')
+EVENT_LOOP_LAG = REGISTRY.histogram('event_loop_lag_seconds', 'Delay between scheduled and actual wake-up of the lag probe.')
+
+
+def observe_bulk_write(collection: str, size: int, upserted: int = 0, modified: int = 0):
+    DB_BULK_SIZE.observe(size, collection=collection)
+    DB_BULK_UPSERTED.inc(upserted, collection=collection)
+    DB_BULK_MODIFIED.inc(modified, collection=collection)
+
+
+def timed_db_call(backend: str, op: str, fn):
+    """Membungkus coroutine datastore agar jumlah panggilan dan latensinya tercatat."""
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            DB_CALLS.inc(backend=backend, op=op, status=status)
+            DB_CALL_SECONDS.observe(time.perf_counter() - started, backend=backend, op=op)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    wrapper.__wrapped__ = fn
+    return wrapper
+
+
+async def monitor_event_loop_lag(interval: float = 1.0):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+async def _handle_http(reader, writer):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = REGISTRY.render().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(port: int, host: str = '127.0.0.1'):
+    server = await asyncio.start_server(_handle_http, host, port)
+    log.info(f"✅ [Metrics] Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
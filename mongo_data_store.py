@@ -1,131 +1,577 @@
 
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import UpdateOne
+from pymongo import ASCENDING, DeleteOne, ReturnDocument, UpdateOne
 import time
 
-class MongoDataStore:
-    def __init__(self, loop, connection_string):
-        print("🗄️ [MongoDataStore] Initializing...")
+from data_store import GLOBAL_STATS_SCOPE, SCAN_CHECKPOINT_FIELDS, STATS_FIELDS, DataStore, compact_history, normalize_entry
+from dialog_snapshot import normalize_group_id
+from metrics import observe_bulk_write
+from log import get_logger
+
+log = get_logger('db')
+
+class MongoDataStore(DataStore):
+    def __init__(self, loop, connection_string, cache_size: int = 50000, cache_ttl: float = 3600, membership_touch_interval: float = 3600, history_limit: int = 20, cache_max_bytes: int = 0):
+        super().__init__(cache_size, cache_ttl, membership_touch_interval, history_limit, cache_max_bytes)
+        log.info("🗄️ [MongoDataStore] Initializing...")
         self.client = AsyncIOMotorClient(connection_string, io_loop=loop)
         self.db = self.client['telegram_scraper_db']
         
         self.users = self.db['users']
         self.scan_status = self.db['scan_status']
+        self.memberships = self.db['memberships']
+        self.chat_titles = self.db['chat_titles']
+        self.jobs = self.db['jobs']
+        self.scan_jobs = self.db['scan_jobs']
+        self.history_archive = self.db['history_archive']
+        self.cache_version = self.db['cache_version']
+        self.cache_changes = self.db['cache_changes']
+        self.stats = self.db['stats']
         
-        print(f"✅ [MongoDataStore] Connected to database '{self.db.name}'. Using collections: 'users', 'scan_status'.")
+        log.info(f"✅ [MongoDataStore] Connected to database '{self.db.name}'. Using collections: 'users', 'scan_status', 'memberships', 'chat_titles', 'jobs', 'scan_jobs', 'history_archive', 'cache_version', 'cache_changes', 'stats'.")
+
+    async def ensure_indexes(self):
+        """Membuat index yang dibutuhkan jika belum ada (aman dijalankan berulang)."""
+        index_specs = [
+            (self.users, [('user_id', ASCENDING)], {'name': 'user_id_unique', 'unique': True}),
+            (self.scan_status, [('group_id', ASCENDING)], {'name': 'group_id_unique', 'unique': True}),
+            (self.scan_status, [('completed', ASCENDING)], {'name': 'completed_partial', 'partialFilterExpression': {'completed': True}}),
+            (self.memberships, [('user_id', ASCENDING), ('group_id', ASCENDING)], {'name': 'user_group_unique', 'unique': True}),
+            (self.memberships, [('group_id', ASCENDING), ('user_id', ASCENDING)], {'name': 'group_user'}),
+            (self.chat_titles, [('group_id', ASCENDING)], {'name': 'group_id_unique', 'unique': True}),
+            (self.scan_jobs, [('job_id', ASCENDING)], {'name': 'job_id_unique', 'unique': True}),
+            (self.history_archive, [('user_id', ASCENDING), ('timestamp', ASCENDING), ('entry.full_name', ASCENDING), ('entry.username', ASCENDING)],
+             {'name': 'user_entry_unique', 'unique': True}),
+            (self.scan_jobs, [('state', ASCENDING), ('created_at', ASCENDING)], {'name': 'state_created'}),
+            (self.cache_changes, [('version', ASCENDING)], {'name': 'version_unique', 'unique': True}),
+            (self.cache_changes, [('at', ASCENDING)], {'name': 'at'}),
+        ]
+        built = []
+        for collection, keys, options in index_specs:
+            existing = await collection.index_information()
+            if options['name'] in existing:
+                continue
+            started = time.perf_counter()
+            try:
+                await collection.create_index(keys, **options)
+            except Exception as e:
+                log.warning(f"[DB Index] ❗️ Failed to build '{collection.name}.{options['name']}': {e}")
+                continue
+            elapsed = time.perf_counter() - started
+            built.append((f"{collection.name}.{options['name']}", elapsed))
+            log.info(f"[DB Index] Built '{collection.name}.{options['name']}' in {elapsed:.2f}s.")
+        # Kunci arsip lama (user_id, timestamp) membuat dua entri di detik yang sama saling menimpa.
+        if 'user_timestamp_unique' in await self.history_archive.index_information():
+            await self.history_archive.drop_index('user_timestamp_unique')
+            log.info("[DB Index] Dropped 'history_archive.user_timestamp_unique'.")
+        if not built:
+            log.info("✅ [DB Index] All indexes already present.")
+        return built
+
+    async def migrate_current_identity(self):
+        """Mengisi subdokumen `current` (salinan entri riwayat terakhir) untuk dokumen lama secara massal.
+
+        Query-nya tidak ber-index (full scan users), jadi hanya dijalankan sampai
+        selesai sekali; setelah itu ditandai di checkpoint dan dilewati.
+        """
+        if (await self.get_job_checkpoint('migrate_current_identity')).get('done'):
+            return 0
+        started = time.perf_counter()
+        result = await self.users.update_many(
+            {'current': {'$exists': False}, 'history.0': {'$exists': True}},
+            [{'$set': {'current': {'$arrayElemAt': ['$history', -1]}}}]
+        )
+        await self.save_job_checkpoint('migrate_current_identity', {'done': True})
+        if result.modified_count:
+            log.info(f"[DB Migrate] Added 'current' to {result.modified_count} user documents in {time.perf_counter() - started:.2f}s.")
+        return result.modified_count
+
+    async def migrate_memberships(self, batch_size: int = 1000):
+        """Memindahkan `active_chats_snapshot` lama ke koleksi memberships secara bertahap (idempoten).
+
+        `memberships_migrated` tidak ber-index, jadi users dibaca sekali urut
+        index user_id (`user_id > terakhir`, bukan query ulang dari awal per
+        batch) dan posisinya disimpan di checkpoint: run yang terhenti lanjut
+        dari sana, dan setelah selesai migrasi ditandai dan dilewati.
+        """
+        checkpoint = await self.get_job_checkpoint('migrate_memberships')
+        if checkpoint.get('done'):
+            return 0
+        started = time.perf_counter()
+        after, migrated = checkpoint.get('after_user_id'), 0
+        projection = {'_id': 0, 'user_id': 1, 'history.timestamp': 1, 'history.active_chats_snapshot': 1}
+        while True:
+            query = {'memberships_migrated': {'$ne': True}}
+            if after is not None:
+                query['user_id'] = {'$gt': after}
+            docs = await self.users.find(query, projection).sort('user_id', ASCENDING).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                break
+            after = docs[-1]['user_id']
+            operations = []
+            for doc in docs:
+                seen = {}
+                for entry in doc.get('history', []):
+                    ts = entry.get('timestamp', 0)
+                    for gid in map(normalize_group_id, entry.get('active_chats_snapshot', [])):
+                        first, last = seen.get(gid, (ts, ts))
+                        seen[gid] = (min(first, ts), max(last, ts))
+                for gid, (first, last) in seen.items():
+                    operations.append(UpdateOne(
+                        {'user_id': doc['user_id'], 'group_id': gid},
+                        {'$min': {'first_seen': first}, '$max': {'last_seen': last}},
+                        upsert=True
+                    ))
+            if operations:
+                await self.memberships.bulk_write(operations, ordered=False)
+            await self.users.update_many(
+                {'user_id': {'$in': [doc['user_id'] for doc in docs]}},
+                {'$set': {'memberships_migrated': True}, '$unset': {'current.active_chats_snapshot': ""}}
+            )
+            migrated += len(docs)
+            await self.save_job_checkpoint('migrate_memberships', {'after_user_id': after})
+        await self.save_job_checkpoint('migrate_memberships', {'done': True})
+        if migrated:
+            log.info(f"[DB Migrate] Moved group snapshots of {migrated} users to 'memberships' in {time.perf_counter() - started:.2f}s.")
+        return migrated
+
+    async def migrate_history_archive(self, batch_size: int = 1000):
+        """Menyalin semua entri riwayat inline ke history_archive (sekali, bisa dilanjutkan).
+
+        `$slice` pada `_push_capped` menganggap setiap entri inline sudah ada di
+        arsip. Dokumen dari sebelum arsip write-through hanya punya entri yang
+        sudah tergeser di arsip, jadi harus di-backfill sebelum handler menulis.
+        """
+        checkpoint = await self.get_job_checkpoint('migrate_history_archive')
+        if checkpoint.get('done'):
+            return 0
+        started = time.perf_counter()
+        after, migrated = checkpoint.get('after_user_id'), 0
+        while True:
+            docs = await self.users.find(
+                {} if after is None else {'user_id': {'$gt': after}}, {'_id': 0, 'user_id': 1, 'history': 1}
+            ).sort('user_id', ASCENDING).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                break
+            operations = [self._archive_operation(doc['user_id'], entry) for doc in docs for entry in doc.get('history', [])]
+            if operations:
+                await self.history_archive.bulk_write(operations, ordered=False)
+            after, migrated = docs[-1]['user_id'], migrated + len(docs)
+            await self.save_job_checkpoint('migrate_history_archive', {'after_user_id': after})
+        await self.save_job_checkpoint('migrate_history_archive', {'done': True})
+        if migrated:
+            log.info(f"[DB Migrate] Archived inline history of {migrated} users in {time.perf_counter() - started:.2f}s.")
+        return migrated
+
+    async def _migrate_user_documents(self, batch_size: int):
+        migrated = 0
+        while True:
+            docs = await self.users.find({'user_id': {'$type': 'string'}}).limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                return migrated
+            existing = {
+                doc['user_id']: doc
+                async for doc in self.users.find({'user_id': {'$in': [int(d['user_id']) for d in docs]}}, {'user_id': 1, 'history': 1})
+            }
+            operations, archive_operations = [], []
+            for doc in docs:
+                user_id = int(doc['user_id'])
+                history = [normalize_entry(entry) for entry in doc.get('history', [])]
+                target = existing.get(user_id)
+                if target is not None:
+                    # Dokumen int sudah ditulis (mis. oleh instance versi baru): riwayat digabung urut waktu.
+                    by_timestamp = {entry.get('timestamp', 0): entry for entry in history + [normalize_entry(e) for e in target.get('history', [])]}
+                    history = [by_timestamp[ts] for ts in sorted(by_timestamp)]
+                kept = history[-self.history_limit:]
+                # Arsip Mongo memuat seluruh riwayat (juga yang tetap inline); compaction bergantung pada itu.
+                archive_operations.extend(self._archive_operation(user_id, entry) for entry in history)
+                fields = {'user_id': user_id, 'history': kept}
+                if kept:
+                    fields['current'] = {k: v for k, v in kept[-1].items() if k != 'active_chats_snapshot'}
+                if target is None:
+                    operations.append(UpdateOne({'_id': doc['_id']}, {'$set': fields}))
+                else:
+                    operations.append(UpdateOne({'_id': target['_id']}, {'$set': fields}))
+                    operations.append(DeleteOne({'_id': doc['_id']}))
+            if archive_operations:
+                await self.history_archive.bulk_write(archive_operations, ordered=False)
+            await self.users.bulk_write(operations, ordered=False)
+            migrated += len(docs)
+            log.info(f"[DB Migrate] Converted {migrated} user documents to int64 IDs...")
+
+    async def _migrate_stats_scopes(self):
+        operations = []
+        async for doc in self.stats.find({'_id': {'$type': 'string', '$ne': GLOBAL_STATS_SCOPE}}):
+            counters = {field: doc[field] for field in STATS_FIELDS if doc.get(field)}
+            operations.append(UpdateOne(
+                {'_id': normalize_group_id(doc['_id'])},
+                {**({'$inc': counters} if counters else {}), '$max': {'last_activity': doc.get('last_activity') or 0}},
+                upsert=True
+            ))
+            operations.append(DeleteOne({'_id': doc['_id']}))
+        if operations:
+            await self.stats.bulk_write(operations, ordered=False)
+        return len(operations) // 2
+
+    async def migrate_int_ids(self, batch_size: int = 1000):
+        """Mengubah user_id/group_id string lama ke int64 di semua koleksi.
+
+        Setiap koleksi dibaca dengan filter `$type: 'string'`. Dokumen yang
+        sudah diubah tidak cocok lagi, jadi migrasi yang terhenti otomatis
+        lanjut dari sisanya. Filter ini (terutama `$or` lintas field) tidak
+        dijamin memakai index dan bisa menjadi full scan per koleksi, jadi
+        setelah selesai sekali ditandai di checkpoint `int_ids` dan dilewati.
+        """
+        if (await self.get_job_checkpoint('int_ids')).get('done'):
+            return 0
+        started = time.perf_counter()
+        migrated = await self._migrate_user_documents(batch_size)
+        migrated += await self._normalize_collection(
+            self.history_archive, lambda doc: {'$set': {f'entry.{k}': v for k, v in normalize_entry(doc['entry']).items()}},
+            ('user_id', 'timestamp'), batch_size,
+            extra_key=lambda doc: {'entry.full_name': doc['entry'].get('full_name'), 'entry.username': doc['entry'].get('username')}
+        )
+        migrated += await self.normalize_group_ids()
+        jobs = [UpdateOne({'_id': job['_id']}, {'$set': {'group_id': normalize_group_id(job['group_id'])}})
+                async for job in self.scan_jobs.find({'group_id': {'$type': 'string'}}, {'group_id': 1})]
+        if jobs:
+            await self.scan_jobs.bulk_write(jobs, ordered=False)
+        migrated += len(jobs) + await self._migrate_stats_scopes()
+        await self.save_job_checkpoint('int_ids', {'done': True})
+        if migrated:
+            log.info(f"✅ [DB Migrate] Converted {migrated} documents to int64 IDs in {time.perf_counter() - started:.2f}s.")
+        return migrated
+
+    # --- Pemeliharaan ---
+
+    async def get_job_checkpoint(self, job: str):
+        return await self.jobs.find_one({'_id': job}, {'_id': 0}) or {}
 
-    async def get_user_history(self, user_id: str):
+    async def save_job_checkpoint(self, job: str, checkpoint: dict):
+        await self.jobs.replace_one({'_id': job}, checkpoint, upsert=True)
+
+    async def _normalize_collection(self, collection, merge_update, key_fields: tuple = ('user_id', 'group_id'), batch_size: int = 1000, extra_key=None):
+        """Memindahkan dokumen dengan ID string lama ke kunci int64 kanonik, digabung dengan dokumen yang sudah ada.
+
+        `extra_key(doc)` menambah field kunci yang tidak perlu dikonversi, mis. identitas entri di history_archive.
+        """
+        converters = {'user_id': int, 'group_id': normalize_group_id}
+        operations, changed = [], 0
+        async for doc in collection.find({'$or': [{field: {'$type': 'string'}} for field in key_fields if field in converters]}):
+            key = {field: converters.get(field, lambda value: value)(doc[field]) for field in key_fields if field in doc}
+            if extra_key is not None:
+                key.update(extra_key(doc))
+            operations.append(UpdateOne(key, merge_update(doc), upsert=True))
+            operations.append(DeleteOne({'_id': doc['_id']}))
+            changed += 1
+            if len(operations) >= batch_size:
+                await collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await collection.bulk_write(operations, ordered=False)
+        return changed
+
+    async def normalize_group_ids(self):
+        def scan_status_update(doc):
+            fields = {k: v for k, v in doc.items() if k not in ('_id', 'group_id', 'completed', 'completed_at')}
+            update = {'$max': {'completed': bool(doc.get('completed'))}}
+            if doc.get('completed_at') is not None:
+                update['$max']['completed_at'] = doc['completed_at']
+            if fields:
+                update['$setOnInsert'] = fields
+            return update
+
+        changed = await self._normalize_collection(self.scan_status, scan_status_update)
+        changed += await self._normalize_collection(self.memberships, lambda doc: {
+            '$min': {'first_seen': doc.get('first_seen', doc.get('last_seen', 0))},
+            '$max': {'last_seen': doc.get('last_seen', 0)},
+        })
+        changed += await self._normalize_collection(self.chat_titles, lambda doc: {
+            '$setOnInsert': {'title': doc.get('title'), 'updated_at': doc.get('updated_at', 0)},
+        })
+        if changed:
+            log.info(f"[DB Compact] Normalized {changed} group IDs.")
+        return changed
+
+    async def _compact_histories_after(self, after_user_id: int, batch_size: int):
+        docs = await self.users.find(
+            {} if after_user_id is None else {'user_id': {'$gt': after_user_id}}, {'_id': 0, 'user_id': 1, 'history': 1}
+        ).sort('user_id', ASCENDING).limit(batch_size).to_list(length=batch_size)
+        if not docs:
+            return None, 0, [], 0
+        archived = {}
+        cursor = self.history_archive.find({'user_id': {'$in': [doc['user_id'] for doc in docs]}}, {'user_id': 1, 'entry': 1})
+        async for row in cursor.sort([('user_id', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)]):
+            archived.setdefault(row['user_id'], []).append(row)
+        user_operations, archive_operations, expected, stale, backfilled = [], [], {}, {}, set()
+        for doc in docs:
+            user_id, history = doc['user_id'], doc.get('history', [])
+            if not history:
+                continue
+            rows = archived.get(user_id, [])
+            # Arsip berisi semua entri (termasuk yang masih inline); versi inline yang dipakai jika ada.
+            inline_keys = {self._archive_key(entry) for entry in history}
+            full = [row['entry'] for row in rows if self._archive_key(row['entry']) not in inline_keys] + history
+            compacted = compact_history(full)
+            # Dokumen lama yang melebihi batas inline ikut dipangkas.
+            kept = compacted[-self.history_limit:]
+            if kept == history and compacted == [row['entry'] for row in rows]:
+                continue
+            # Arsip diganti dengan hasil compaction: upsert dulu, baru baris yang tergabung/usang dihapus,
+            # jadi tidak ada entri yang hilang jika proses berhenti di tengah. Tulisan live setelah
+            # pembacaan tidak ikut terhapus karena hanya baris yang terbaca yang bisa dihapus.
+            archive_operations.extend(self._archive_operation(user_id, entry) for entry in compacted)
+            compacted_keys = {self._archive_key(entry) for entry in compacted}
+            stale[user_id] = [row['_id'] for row in rows if self._archive_key(row['entry']) not in compacted_keys]
+            if kept != history:
+                current = {k: v for k, v in kept[-1].items() if k != 'active_chats_snapshot'}
+                # Filter ukuran + timestamp entri terakhir: jika ada $push live sejak dibaca, user dilewati dan diproses di run berikutnya.
+                user_operations.append(UpdateOne(
+                    {'user_id': user_id, 'history': {'$size': len(history)}, f'history.{len(history) - 1}.timestamp': history[-1].get('timestamp')},
+                    {'$set': {'history': kept, 'current': current}}
+                ))
+                expected[user_id] = kept
+            elif compacted == full:
+                # Hanya entri inline yang belum ada di arsip (dokumen lama): backfill, bukan compaction.
+                backfilled.add(user_id)
+        if not archive_operations:
+            return docs[-1]['user_id'], len(docs), [], 0
+        await self.history_archive.bulk_write(archive_operations, ordered=False)
+        modified, skipped = 0, set()
+        if user_operations:
+            result = await self.users.bulk_write(user_operations, ordered=False)
+            modified = result.modified_count
+            if result.matched_count < len(user_operations):
+                # Sebagian user tertulis live sejak dibaca: baris arsipnya belum boleh dihapus karena
+                # riwayat inline mereka masih versi lama.
+                async for doc in self.users.find({'user_id': {'$in': list(expected)}}, {'_id': 0, 'user_id': 1, 'history': 1}):
+                    if doc.get('history', []) != expected[doc['user_id']]:
+                        skipped.add(doc['user_id'])
+        stale_ids = [row_id for user_id, ids in stale.items() if user_id not in skipped for row_id in ids]
+        if stale_ids:
+            await self.history_archive.delete_many({'_id': {'$in': stale_ids}})
+        changed_ids = [user_id for user_id in stale if user_id not in skipped and user_id not in backfilled]
+        if user_operations:
+            observe_bulk_write('users', len(user_operations), 0, modified)
+        return docs[-1]['user_id'], len(docs), changed_ids, len(backfilled)
+
+    async def _write_memberships(self, pairs: list, now: int):
+        operations = [
+            UpdateOne(
+                {'user_id': user_id, 'group_id': group_id},
+                {'$setOnInsert': {'first_seen': now}, '$max': {'last_seen': now}},
+                upsert=True
+            )
+            for user_id, group_id in pairs
+        ]
+        result = await self.memberships.bulk_write(operations, ordered=False)
+        observe_bulk_write('memberships', len(operations), result.upserted_count, result.modified_count)
+        await self._write_stats(self._membership_stats(pairs, [pairs[i] for i in result.upserted_ids]), now)
+        return result.upserted_count
+
+    async def get_user_groups(self, user_id: int):
+        cursor = self.memberships.find({'user_id': user_id}, {'_id': 0, 'group_id': 1}).sort('last_seen', -1)
+        return [doc['group_id'] async for doc in cursor]
+
+    async def iter_group_members(self, group_id: int, page_size: int = 200):
+        """Reverse lookup: menghasilkan daftar user_id yang pernah terlihat di grup, per halaman."""
+        cursor = self.memberships.find({'group_id': group_id}, {'_id': 0, 'user_id': 1}).sort('user_id', ASCENDING).batch_size(page_size)
+        page = []
+        async for doc in cursor:
+            page.append(doc['user_id'])
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    @staticmethod
+    def _time_range(since, until):
+        timestamp = {}
+        if since is not None:
+            timestamp['$gte'] = since
+        if until is not None:
+            timestamp['$lt'] = until
+        return timestamp
+
+    async def _export_batch(self, docs, since, until):
+        """Menyisakan user yang punya entri di [since, until) (inline atau di arsip), lalu melengkapi riwayatnya."""
+        timestamp = self._time_range(since, until)
+        if timestamp and docs:
+            def in_range(entry):
+                ts = entry.get('timestamp', 0)
+                return (since is None or ts >= since) and (until is None or ts < until)
+
+            inline = {doc['user_id'] for doc in docs if any(in_range(entry) for entry in doc.get('history', []))}
+            rest = [doc['user_id'] for doc in docs if doc['user_id'] not in inline]
+            # Index (user_id, timestamp, ...) arsip: satu query per batch untuk user yang tidak cocok inline.
+            archived = set(await self.history_archive.distinct('user_id', {'user_id': {'$in': rest}, 'timestamp': timestamp})) if rest else set()
+            docs = [doc for doc in docs if doc['user_id'] in inline or doc['user_id'] in archived]
+        return await self._attach_archived_history(docs)
+
+    async def iter_user_documents(self, since: int = None, until: int = None, batch_size: int = 1000):
+        projection = {'_id': 0, 'user_id': 1, 'current': 1, 'history': 1}
+        cursor = self.users.find({}, projection).sort('user_id', ASCENDING).batch_size(batch_size)
+        batch = []
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                page = await self._export_batch(batch, since, until)
+                if page:
+                    yield page
+                batch = []
+        if batch:
+            page = await self._export_batch(batch, since, until)
+            if page:
+                yield page
+
+    async def get_user_documents(self, user_ids: list, since: int = None, until: int = None):
+        cursor = self.users.find({'user_id': {'$in': list(user_ids)}}, {'_id': 0, 'user_id': 1, 'current': 1, 'history': 1}).sort('user_id', ASCENDING)
+        return await self._export_batch([doc async for doc in cursor], since, until)
+
+    async def _fetch_last_entries(self, user_ids: list):
+        """Mengambil entri terakhir hanya lewat proyeksi `current`; riwayat penuh tidak ikut dibaca."""
+        last_entries = {}
+        legacy_ids = []
+        async for doc in self.users.find({'user_id': {'$in': user_ids}}, {'_id': 0, 'user_id': 1, 'current': 1}):
+            if 'current' in doc:
+                last_entries[doc['user_id']] = doc['current']
+            else:
+                legacy_ids.append(doc['user_id'])
+        if legacy_ids:
+            # Dokumen yang belum dimigrasi: ambil entri terakhir dari history.
+            async for doc in self.users.find({'user_id': {'$in': legacy_ids}}, {'_id': 0, 'user_id': 1, 'history': {'$slice': -1}}):
+                history = doc.get('history', [])
+                last_entries[doc['user_id']] = history[-1] if history else {}
+        return last_entries
+
+    async def _fetch_history(self, user_id: int):
         user_doc = await self.users.find_one({'user_id': user_id})
         return user_doc.get('history', []) if user_doc else []
 
-    async def save_user_data_logic(self, user_id: str, new_entry: dict, is_update: bool):
+    @staticmethod
+    def _archive_key(entry):
+        return entry.get('timestamp', 0), entry.get('full_name'), entry.get('username')
+
+    @classmethod
+    def _archive_operation(cls, user_id, entry):
+        # Kunci (user_id, timestamp, identitas): entri berbeda di detik yang sama tetap terpisah, sedangkan
+        # tulis ulang (retry, atau is_update yang hanya menambah grup) tetap idempoten dan menimpa versi lama.
+        timestamp, full_name, username = cls._archive_key(entry)
+        return UpdateOne(
+            {'user_id': user_id, 'timestamp': timestamp, 'entry.full_name': full_name, 'entry.username': username},
+            {'$set': {f'entry.{key}': value for key, value in entry.items()}}, upsert=True
+        )
+
+    def _push_capped(self, new_entry):
+        # Riwayat inline dibatasi `history_limit` entri terbaru; setiap entri juga ada di history_archive.
+        return {'$push': {'history': {'$each': [new_entry], '$slice': -self.history_limit}}, '$set': {'current': new_entry}}
+
+    async def _write_stats(self, stats: dict, now: int):
+        # Dikirim tepat setelah bulk utama (bulk_write tidak bisa lintas koleksi). Jika gagal, counter
+        # hanya tertinggal sedikit dan diperbaiki oleh rebuild_stats, jadi tulisan utama tidak diulang.
+        if not stats:
+            return
+        operations = [
+            UpdateOne({'_id': scope}, {**({'$inc': counters} if counters else {}), '$max': {'last_activity': now}}, upsert=True)
+            for scope, counters in stats.items()
+        ]
+        try:
+            await self.stats.bulk_write(operations, ordered=False)
+        except Exception as e:
+            log.warning(f"[DB Stats] ❗️ Error updating {len(operations)} counters: {e}")
+
+    async def _write_entry(self, user_id: int, new_entry: dict, is_update: bool, stats: dict = None):
+        # Arsip ditulis lebih dulu: jika update users gagal, entri tetap tidak hilang saat nanti tergeser.
+        await self.history_archive.bulk_write([self._archive_operation(user_id, new_entry)], ordered=False)
         if is_update:
             # Operasi ini menjadi lebih jarang digunakan karena logika batch yang baru
             await self.users.update_one(
                 {'user_id': user_id},
                 {'$pop': {'history': 1}}
             )
-            await self.users.update_one(
-                {'user_id': user_id},
-                {'$push': {'history': new_entry}}
-            )
+            await self.users.update_one({'user_id': user_id}, self._push_capped(new_entry))
         else:
             await self.users.update_one(
                 {'user_id': user_id},
-                {'$push': {'history': new_entry}},
+                {**self._push_capped(new_entry), '$setOnInsert': {'memberships_migrated': True}},
                 upsert=True
             )
+        await self._write_stats(stats, int(time.time()))
 
-    async def update_user_history_batch(self, batch: list):
-        if not batch: return 0
-            
-        print(f"   [DB Batch] Processing batch of {len(batch)} users...")
-        bulk_operations = []
-        user_ids_in_batch = {str(item['user_entity'].id) for item in batch}
-        
-        existing_users_cursor = self.users.find({'user_id': {'$in': list(user_ids_in_batch)}})
-        existing_users = {u['user_id']: u for u in await existing_users_cursor.to_list(length=len(user_ids_in_batch))}
-        
-        saved_count = 0
-
-        for item in batch:
-            user_entity = item['user_entity']
-            active_chat_id = item['active_chat_id']
-            user_id = str(user_entity.id)
-            current_identity = {'full_name': (user_entity.first_name or "") + (" " + (user_entity.last_name or "") if user_entity.last_name else ""), 'username': user_entity.username}
-            
-            if not current_identity['username'] and not current_identity['full_name']: continue
-            
-            user_doc = existing_users.get(user_id)
-            history = user_doc['history'] if user_doc and 'history' in user_doc else []
-            last_entry = history[-1] if history else {}
-            
-            if last_entry.get('username') and not current_identity['username']: continue
-            
-            identity_changed = (last_entry.get('full_name') != current_identity['full_name'] or last_entry.get('username') != current_identity['username'])
-            last_active_chats = set(last_entry.get('active_chats_snapshot', []))
-            is_new_group = active_chat_id and active_chat_id not in last_active_chats
-
-            if not history or identity_changed:
-                # --- KASUS 1: Pengguna Baru atau Identitas Berubah ---
-                # Membuat entri riwayat baru. Ini aman.
-                new_active_chats = last_active_chats.copy()
-                if active_chat_id: new_active_chats.add(active_chat_id)
-                new_entry = {
-                    'timestamp': int(time.time()), 
-                    'full_name': current_identity['full_name'], 
-                    'username': current_identity['username'], 
-                    'active_chats_snapshot': sorted(list(new_active_chats)), 
-                    'shared_chats': last_entry.get('shared_chats', [])
-                }
-                bulk_operations.append(UpdateOne({'user_id': user_id}, {'$push': {'history': new_entry}}, upsert=True))
-                saved_count += 1
-            elif is_new_group:
-                # --- KASUS 2: Hanya Grup Aktif Baru (Identitas Sama) ---
-                # Menggunakan operasi atomik untuk menambahkan grup ke entri riwayat terakhir.
-                # Ini adalah cara yang aman untuk menghindari race condition.
-                bulk_operations.append(UpdateOne(
-                    {'user_id': user_id, 'history': {'$exists': True, '$not': {'$size': 0}}},
-                    {'$addToSet': {'history.$[].active_chats_snapshot': active_chat_id}}
-                ))
-                # Perhatikan: saved_count tidak di-increment di sini karena ini adalah "update"
-                # pada data yang sudah ada, bukan entri "baru". Logika ini konsisten.
-                
-        if bulk_operations:
-            try:
-                result = await self.users.bulk_write(bulk_operations)
-                # Menggunakan result.modified_count dan result.upserted_count untuk log yang lebih akurat
-                print(f"   [DB Batch] ✅ Bulk write completed. New/Updated: {result.upserted_count + result.modified_count} records.")
-                return result.upserted_count + result.modified_count
-            except Exception as e:
-                print(f"   [DB Batch] ❗️ Error during bulk write: {e}")
-                return 0
-        return 0
+    async def _write_history_entries(self, new_entries: dict, stats: dict = None):
+        archive_result = await self.history_archive.bulk_write(
+            [self._archive_operation(user_id, new_entry) for user_id, new_entry in new_entries.items()], ordered=False
+        )
+        observe_bulk_write('history_archive', len(new_entries), archive_result.upserted_count, archive_result.modified_count)
+        bulk_operations = [
+            UpdateOne({'user_id': user_id}, {**self._push_capped(new_entry), '$setOnInsert': {'memberships_migrated': True}}, upsert=True)
+            for user_id, new_entry in new_entries.items()
+        ]
+        result = await self.users.bulk_write(bulk_operations)
+        observe_bulk_write('users', len(bulk_operations), result.upserted_count, result.modified_count)
+        await self._write_stats(stats, int(time.time()))
+        # Menggunakan result.modified_count dan result.upserted_count untuk log yang lebih akurat
+        return result.upserted_count + result.modified_count
+
+    async def count_archived_history(self, user_id: int, before: int):
+        return await self.history_archive.count_documents({'user_id': user_id, 'timestamp': {'$lt': before}})
+
+    async def get_archived_history(self, user_id: int, before: int, offset: int = 0, limit: int = 30):
+        cursor = self.history_archive.find(
+            {'user_id': user_id, 'timestamp': {'$lt': before}}, {'_id': 0, 'entry': 1}
+        ).sort([('timestamp', -1), ('_id', -1)]).skip(offset).limit(limit)
+        return [doc['entry'] async for doc in cursor]
+
+    async def _attach_archived_history(self, docs):
+        """Melengkapi dokumen ekspor dengan entri arsip yang lebih lama dari riwayat inline."""
+        if not docs:
+            return docs
+        archived = {}
+        cursor = self.history_archive.find({'user_id': {'$in': [doc['user_id'] for doc in docs]}}, {'_id': 0}).sort([('timestamp', ASCENDING), ('_id', ASCENDING)])
+        async for row in cursor:
+            archived.setdefault(row['user_id'], []).append(row['entry'])
+        for doc in docs:
+            history = doc.get('history', [])
+            oldest = history[0].get('timestamp', 0) if history else float('inf')
+            doc['history'] = [e for e in archived.get(doc['user_id'], []) if e.get('timestamp', 0) < oldest] + history
+        return docs
 
     async def get_completed_scan_ids(self):
-        cursor = self.scan_status.find({'completed': True})
-        return {doc['group_id'] for doc in await cursor.to_list(length=None)}
+        # Hanya group_id yang diambil, dan dokumen di-stream per batch alih-alih to_list(None).
+        cursor = self.scan_status.find({'completed': True}, {'group_id': 1, '_id': 0}, batch_size=1000)
+        return {doc['group_id'] async for doc in cursor}
+
+    async def mark_scan_as_completed(self, group_id: int):
+        await self.scan_status.update_one(
+            {'group_id': group_id},
+            {'$set': {'completed': True, 'group_id': group_id, 'completed_at': int(time.time())}},
+            upsert=True
+        )
 
-    async def mark_scan_as_completed(self, group_id: str):
+    async def add_completed_scan_id(self, group_id: int):
+        # Grup manual tidak pernah discan penuh, jadi tidak diberi completed_at.
         await self.scan_status.update_one(
             {'group_id': group_id},
             {'$set': {'completed': True, 'group_id': group_id}},
             upsert=True
         )
 
-    async def add_completed_scan_id(self, group_id: str):
-        await self.mark_scan_as_completed(group_id)
+    async def get_scan_completion_times(self):
+        """Mengembalikan {group_id: completed_at} untuk grup yang pernah discan penuh."""
+        cursor = self.scan_status.find({'completed': True}, {'_id': 0, 'group_id': 1, 'completed_at': 1})
+        return {doc['group_id']: doc['completed_at'] async for doc in cursor if doc.get('completed_at')}
 
-    async def get_scan_status(self, group_id: str):
+    async def get_scan_status(self, group_id: int):
         status = await self.scan_status.find_one({'group_id': group_id})
         return status or {}
 
-    async def update_scan_status(self, group_id: str, status_doc: dict):
+    async def update_scan_status(self, group_id: int, status_doc: dict):
         if not status_doc:
             await self.scan_status.update_one(
                 {'group_id': group_id},
-                {'$unset': {'filter_index': "", 'total_saved_since_start': ""}}
+                {'$unset': {field: "" for field in SCAN_CHECKPOINT_FIELDS}}
             )
         else:
             status_doc_with_id = {'group_id': group_id, **status_doc}
@@ -135,11 +581,130 @@ class MongoDataStore:
                 upsert=True
             )
 
-    async def clear_scan_record(self, group_id: str):
+    async def clear_scan_record(self, group_id: int):
         await self.scan_status.update_one(
             {'group_id': group_id},
             {'$set': {'completed': False}},
         )
 
+    # --- Antrean scan ---
+
+    async def add_scan_jobs(self, jobs: list):
+        await self.scan_jobs.insert_many([dict(job) for job in jobs], ordered=False)
+
+    async def get_scan_jobs(self, states: tuple = None, batch_id: str = None, limit: int = 0):
+        query = {}
+        if states:
+            query['state'] = {'$in': list(states)}
+        if batch_id:
+            query['batch_id'] = batch_id
+        cursor = self.scan_jobs.find(query, {'_id': 0}).sort('created_at', ASCENDING).limit(limit)
+        return [job async for job in cursor]
+
+    async def claim_scan_job(self, state: str, fields: dict):
+        return await self.scan_jobs.find_one_and_update(
+            {'state': state}, {'$set': fields}, projection={'_id': 0},
+            sort=[('created_at', ASCENDING)], return_document=ReturnDocument.AFTER
+        )
+
+    async def update_scan_job(self, job_id: str, fields: dict, expect: dict = None):
+        result = await self.scan_jobs.update_one({**(expect or {}), 'job_id': job_id}, {'$set': fields})
+        return result.matched_count > 0
+
+    async def requeue_stale_scan_jobs(self, state: str, heartbeat_before: float, fields: dict):
+        requeued = []
+        async for job in self.scan_jobs.find({'state': state, 'heartbeat': {'$not': {'$gte': heartbeat_before}}}, {'_id': 0}):
+            # Bersyarat pada heartbeat yang terbaca: job yang baru saja diperbarui pemiliknya tidak disentuh.
+            if await self.update_scan_job(job['job_id'], fields, {'state': state, 'heartbeat': job.get('heartbeat')}):
+                requeued.append({**job, **fields})
+        return requeued
+
+    async def prune_scan_jobs(self, states: tuple, before: float):
+        result = await self.scan_jobs.delete_many({'state': {'$in': list(states)}, 'updated_at': {'$lt': before}})
+        return result.deleted_count
+
+    async def load_chat_titles(self, limit: int):
+        cursor = self.chat_titles.find({}, {'_id': 0}).sort('updated_at', -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def save_chat_titles(self, items: list):
+        operations = [
+            UpdateOne({'group_id': group_id}, {'$set': {'title': title, 'updated_at': updated_at}}, upsert=True)
+            for group_id, title, updated_at in items
+        ]
+        if not operations:
+            return
+        try:
+            await self.chat_titles.bulk_write(operations, ordered=False)
+        except Exception as e:
+            log.warning(f"[DB Titles] ❗️ Error saving chat titles: {e}")
+
+    async def append_cache_changes(self, origin: str, changes: list):
+        # Versi dialokasikan dulu lewat $inc atomik, baru log ditulis; pembaca menunggu celah sesaat (lihat cache_sync).
+        counter = await self.cache_version.find_one_and_update(
+            {'_id': 'cache'}, {'$inc': {'version': len(changes)}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        last = counter['version']
+        now = time.time()
+        await self.cache_changes.insert_many([
+            {'version': last - len(changes) + i + 1, 'origin': origin, 'at': now, **change} for i, change in enumerate(changes)
+        ], ordered=False)
+        return last
+
+    async def get_cache_version(self):
+        counter = await self.cache_version.find_one({'_id': 'cache'})
+        return counter['version'] if counter else 0
+
+    async def get_cache_changes(self, after_version: int, limit: int = 1000):
+        cursor = self.cache_changes.find({'version': {'$gt': after_version}}, {'_id': 0}).sort('version', ASCENDING).limit(limit)
+        return [change async for change in cursor]
+
+    async def prune_cache_changes(self, before: float):
+        result = await self.cache_changes.delete_many({'at': {'$lt': before}})
+        return result.deleted_count
+
     async def get_total_user_count(self):
         return await self.users.estimated_document_count()
+
+    async def get_stats(self, scope: str = GLOBAL_STATS_SCOPE):
+        return await self.stats.find_one({'_id': scope}, {'_id': 0}) or {}
+
+    async def _count_identity_changes(self, docs):
+        # Entri sejak adanya arsip tersimpan inline dan di arsip sekaligus, jadi dihitung per kunci arsip unik.
+        keys = {doc['user_id']: {self._archive_key(entry) for entry in doc.get('history', [])} for doc in docs}
+        projection = {'_id': 0, 'user_id': 1, 'entry.timestamp': 1, 'entry.full_name': 1, 'entry.username': 1}
+        async for row in self.history_archive.find({'user_id': {'$in': list(keys)}}, projection):
+            keys[row['user_id']].add(self._archive_key(row['entry']))
+        return sum(max(len(k) - 1, 0) for k in keys.values())
+
+    async def rebuild_stats(self, batch_size: int = 1000):
+        stamp = time.time()
+        operations, memberships, last_activity = [], 0, 0
+        pipeline = [{'$group': {'_id': '$group_id', 'members': {'$sum': 1}, 'last_seen': {'$max': '$last_seen'}}}]
+        async for row in self.memberships.aggregate(pipeline, allowDiskUse=True):
+            memberships += row['members']
+            last_activity = max(last_activity, row['last_seen'] or 0)
+            operations.append(UpdateOne(
+                {'_id': row['_id']}, {'$set': {'members': row['members'], 'rebuilt_at': stamp}, '$max': {'last_activity': row['last_seen'] or 0}}, upsert=True
+            ))
+        for start in range(0, len(operations), batch_size):
+            await self.stats.bulk_write(operations[start:start + batch_size], ordered=False)
+        # Grup yang tidak lagi punya keanggotaan sama sekali.
+        await self.stats.update_many({'_id': {'$ne': GLOBAL_STATS_SCOPE}, 'rebuilt_at': {'$ne': stamp}}, {'$set': {'members': 0}})
+
+        users, identity_changes, batch = 0, 0, []
+        async for doc in self.users.find({}, {'_id': 0, 'user_id': 1, 'history.timestamp': 1, 'history.full_name': 1, 'history.username': 1}).batch_size(batch_size):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                users, identity_changes, batch = users + len(batch), identity_changes + await self._count_identity_changes(batch), []
+        if batch:
+            users, identity_changes = users + len(batch), identity_changes + await self._count_identity_changes(batch)
+        await self.stats.update_one(
+            {'_id': GLOBAL_STATS_SCOPE},
+            {'$set': {'users': users, 'identity_changes': identity_changes, 'memberships': memberships, 'rebuilt_at': stamp}, '$max': {'last_activity': last_activity}},
+            upsert=True
+        )
+        return len(operations) + 1
+
+    async def close(self):
+        self.client.close()
@@ -0,0 +1,68 @@
+import asyncio
+
+from log import get_logger
+
+log = get_logger('passive.buffer')
+
+
+class PassiveWriteBuffer:
+    """Write-behind buffer untuk pelacakan pasif.
+
+    Event pasif dikumpulkan di memori lalu disimpan sekaligus lewat
+    `update_user_history_batch` ketika buffer penuh (`max_size`) atau ketika
+    `flush_interval` detik sudah lewat, mana yang lebih dulu.
+    """
+
+    def __init__(self, data_store, flush_interval: float = 2.0, max_size: int = 100):
+        self.data_store = data_store
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._pending = {}
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._closing = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+            log.info(f"✅ [PassiveBuffer] Started (interval: {self.flush_interval}s, size: {self.max_size}).")
+
+    def add(self, user_entity, active_chat_id: int = None):
+        # Event berulang dari user & grup yang sama cukup disimpan versi terbarunya.
+        self._pending[(user_entity.id, active_chat_id)] = {'user_entity': user_entity, 'active_chat_id': active_chat_id}
+        if len(self._pending) >= self.max_size:
+            self._wake.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch = list(self._pending.values())
+            self._pending = {}
+            try:
+                return await self.data_store.update_user_history_batch(batch)
+            except Exception as e:
+                log.error(f"❗️ [PassiveBuffer] Flush of {len(batch)} events failed: {e}")
+                return 0
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def close(self):
+        self._closing = True
+        if self._task is not None:
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        log.info("🛑 [PassiveBuffer] Flushed and stopped.")
@@ -0,0 +1,50 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import tempfile
+import time
+
+
+class LoopProfiler:
+    """Profiler on-demand untuk thread event loop.
+
+    cProfile hanya aktif selama jendela waktu yang diminta; di luar itu
+    tidak ada hook yang terpasang, jadi tidak ada overhead sama sekali.
+    """
+
+    MAX_SECONDS = 300
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    async def profile_for(self, seconds: float, top: int = 25):
+        """Mem-profile event loop selama `seconds` detik; mengembalikan (ringkasan, path file .prof)."""
+        seconds = max(1.0, min(float(seconds), self.MAX_SECONDS))
+        async with self._lock:
+            profile = cProfile.Profile()
+            started = time.perf_counter()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            elapsed = time.perf_counter() - started
+
+        fd, path = tempfile.mkstemp(prefix='menelbot-profile-', suffix='.prof')
+        os.close(fd)
+        profile.dump_stats(path)
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+        summary = out.getvalue()
+        # Buang header pstats, sisakan tabel fungsinya saja.
+        table_start = summary.find('ncalls')
+        summary = summary[table_start:] if table_start >= 0 else summary
+        return f"Profiled {elapsed:.1f}s, {stats.total_calls} calls\n\n{summary}", path
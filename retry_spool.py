@@ -0,0 +1,163 @@
+import asyncio
+import json
+import os
+import struct
+
+from dialog_snapshot import normalize_group_id
+from log import get_logger
+
+log = get_logger('db.spool')
+
+_LENGTH = struct.Struct('>I')
+
+
+class RetrySpool:
+    """Spool di disk untuk penulisan batch yang gagal (mis. saat failover MongoDB).
+
+    Setiap user disimpan sebagai record `<panjang 4 byte><JSON>` yang
+    ditambahkan ke akhir file. Di memori record digabung per user_id (entri
+    terbaru menang, grup digabung), dan file ditulis ulang ringkas setiap
+    kali spool berhasil dikuras. Task background mencoba ulang dengan
+    backoff eksponensial.
+    """
+
+    def __init__(self, data_store, path: str, base_delay: float = 1, max_delay: float = 300):
+        self.data_store = data_store
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._pending = {}
+        self._file_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def size_bytes(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _merge(pending, user_id, entry, groups):
+        record = pending.setdefault(user_id, {'entry': None, 'groups': set()})
+        if entry is not None:
+            record['entry'] = entry
+        record['groups'].update(groups)
+
+    @staticmethod
+    def _encode(user_id, record):
+        payload = json.dumps({'u': user_id, 'e': record['entry'], 'g': sorted(record['groups'])}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return _LENGTH.pack(len(payload)) + payload
+
+    def _read_sync(self):
+        pending = {}
+        if not os.path.exists(self.path):
+            return pending
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _LENGTH.size <= len(data):
+            (length,) = _LENGTH.unpack_from(data, offset)
+            payload = data[offset + _LENGTH.size:offset + _LENGTH.size + length]
+            if len(payload) < length:
+                break
+            record = json.loads(payload)
+            # Spool dari versi lama bisa berisi ID string.
+            self._merge(pending, int(record['u']), record['e'], [normalize_group_id(gid) for gid in record['g']])
+            offset += _LENGTH.size + length
+        if offset < len(data):
+            log.warning(f"❗️ [RetrySpool] Ignoring {len(data) - offset} trailing bytes of a partially written record.")
+        return pending
+
+    def _append_sync(self, blob):
+        with open(self.path, 'ab') as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_sync(self, blob):
+        if not blob:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def _file_op(self, fn, *args):
+        async with self._file_lock:
+            return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def load(self):
+        """Membaca spool dari run sebelumnya; record ganda untuk user yang sama digabung."""
+        self._pending = await self._file_op(self._read_sync)
+        if self._pending:
+            log.warning(f"❗️ [RetrySpool] Loaded {len(self._pending)} spooled users from '{self.path}'.")
+        return len(self._pending)
+
+    async def add(self, entries: dict, membership_pairs: list):
+        """Menyimpan {user_id: entri} dan [(user_id, group_id)] yang gagal ditulis."""
+        touched = {}
+        for user_id, entry in entries.items():
+            self._merge(touched, user_id, entry, ())
+        for user_id, group_id in membership_pairs:
+            self._merge(touched, user_id, None, (group_id,))
+        if not touched:
+            return
+        for user_id, record in touched.items():
+            self._merge(self._pending, user_id, record['entry'], record['groups'])
+        await self._file_op(self._append_sync, b''.join(self._encode(uid, record) for uid, record in touched.items()))
+        log.warning(f"❗️ [RetrySpool] Spooled {len(touched)} users, depth {len(self._pending)}.")
+        self._wake.set()
+
+    async def drain(self):
+        """Mencoba menulis semua isi spool sekali; melempar exception jika database masih gagal."""
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        entries = {uid: record['entry'] for uid, record in batch.items() if record['entry'] is not None}
+        pairs = [(uid, gid) for uid, record in batch.items() for gid in sorted(record['groups'])]
+        try:
+            await self.data_store.replay_spooled(entries, pairs)
+        except Exception:
+            # Record yang masuk selama percobaan lebih baru, jadi entrinya yang dipertahankan.
+            for uid, record in self._pending.items():
+                self._merge(batch, uid, record['entry'], record['groups'])
+            self._pending = batch
+            raise
+        await self._file_op(self._rewrite_sync, b''.join(self._encode(uid, record) for uid, record in self._pending.items()))
+        log.info(f"✅ [RetrySpool] Replayed {len(batch)} spooled users, depth {len(self._pending)}.")
+        return len(batch)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        # Isi spool tetap di disk dan dikuras lagi saat start berikutnya.
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        delay = self.base_delay
+        while True:
+            if not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+                delay = self.base_delay
+                await asyncio.sleep(delay)
+            try:
+                await self.drain()
+                delay = self.base_delay
+            except Exception as e:
+                delay = min(delay * 2, self.max_delay)
+                log.warning(f"❗️ [RetrySpool] Retry of {len(self._pending)} users failed, next attempt in {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
@@ -0,0 +1,79 @@
+import asyncio
+
+from log import get_logger
+
+log = get_logger('scan.batch')
+
+
+class ScanWritePipeline:
+    """Pipeline producer/consumer untuk scan grup.
+
+    Iterator peserta (producer) memasukkan user lewat `put`, sementara satu
+    atau lebih writer menyimpan batch ke database secara bersamaan. User
+    dibagi ke writer berdasarkan user_id, jadi user yang sama selalu ditulis
+    oleh writer yang sama dan dua writer tidak pernah membaca identity cache
+    untuk user yang sama sebelum salah satunya menulis (entri riwayat ganda).
+    Antrean per writer dibatasi `max_pending_batches`, jadi producer otomatis
+    menunggu jika writer tertinggal. Error dari writer dilempar ulang ke pemanggil.
+    """
+
+    def __init__(self, data_store, batch_size: int, writers: int = 1, max_pending_batches: int = 4, label: str = "Scan"):
+        self.data_store = data_store
+        self.batch_size = batch_size
+        self.label = label
+        self.saved = 0
+        shards = max(1, writers)
+        self._batches = [[] for _ in range(shards)]
+        self._queues = [asyncio.Queue(maxsize=max_pending_batches) for _ in range(shards)]
+        self._error = None
+        self._writers = [asyncio.ensure_future(self._writer(queue)) for queue in self._queues]
+
+    async def _writer(self, queue):
+        while True:
+            batch = await queue.get()
+            try:
+                if batch is None:
+                    return
+                if self._error is None:
+                    saved_in_batch = await self.data_store.update_user_history_batch(batch)
+                    self.saved += saved_in_batch
+                    log.info("[%s] Batch of %d written. Saved: %d", self.label, len(batch), saved_in_batch, extra={'batch_size': len(batch), 'saved': saved_in_batch})
+            except Exception as e:
+                if self._error is None:
+                    self._error = e
+            finally:
+                queue.task_done()
+
+    @property
+    def error(self):
+        return self._error
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    async def put(self, item: dict):
+        self._raise_if_failed()
+        shard = item['user_entity'].id % len(self._queues)
+        self._batches[shard].append(item)
+        if len(self._batches[shard]) >= self.batch_size:
+            batch, self._batches[shard] = self._batches[shard], []
+            await self._queues[shard].put(batch)
+
+    async def drain(self):
+        """Menyimpan sisa batch dan menunggu semua batch di antrean selesai ditulis."""
+        for shard, queue in enumerate(self._queues):
+            if self._batches[shard]:
+                batch, self._batches[shard] = self._batches[shard], []
+                await queue.put(batch)
+        for queue in self._queues:
+            await queue.join()
+        self._raise_if_failed()
+
+    async def close(self):
+        try:
+            await self.drain()
+        finally:
+            for queue in self._queues:
+                await queue.put(None)
+            await asyncio.gather(*self._writers)
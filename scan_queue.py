@@ -0,0 +1,160 @@
+import asyncio
+import time
+import uuid
+
+from log import get_logger
+
+log = get_logger('scan.queue')
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class ScanJobQueue:
+    """Antrean scan grup yang disimpan di datastore, dikerjakan satu per satu oleh satu worker background.
+
+    Job diambil secara atomik (`queued` -> `running` beserta `owner`), jadi
+    beberapa instance pada database yang sama tidak pernah mengerjakan job
+    yang sama. Pemilik memperbarui `heartbeat` selama job berjalan; job
+    `running` yang heartbeat-nya basi (instance mati) dimasukkan kembali ke
+    antrean, dan progres per grup dilanjutkan dari checkpoint di scan_status.
+    """
+
+    def __init__(self, data_store, run_job, pause_between: float = 10, on_batch_finished=None, heartbeat_interval: float = 30):
+        self.data_store = data_store
+        self.run_job = run_job
+        self.pause_between = pause_between
+        self.on_batch_finished = on_batch_finished
+        self.heartbeat_interval = heartbeat_interval
+        self.owner = uuid.uuid4().hex[:12]
+        self.current = None
+        self._current_task = None
+        self._cancel_requested = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        # Job yang sedang berjalan sengaja tidak diubah statusnya, agar dilanjutkan saat start berikutnya.
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def enqueue(self, groups: list, report_chat_id=None, report_msg_id=None, label: str = None):
+        """Menambah job untuk [(group_id, title)]; grup yang sudah antre/berjalan dilewati."""
+        active = {job['group_id'] for job in await self.data_store.get_scan_jobs((QUEUED, RUNNING))}
+        now = time.time()
+        batch_id = uuid.uuid4().hex[:12]
+        fresh = [(gid, title) for gid, title in groups if gid not in active]
+        jobs = [{
+            'job_id': uuid.uuid4().hex[:12],
+            'group_id': gid,
+            'title': title,
+            'state': QUEUED,
+            'batch_id': batch_id,
+            'label': f"{label} ({i + 1}/{len(fresh)})" if label else None,
+            'report_chat_id': report_chat_id,
+            'report_msg_id': report_msg_id,
+            'created_at': now + i * 1e-6,
+            'updated_at': now,
+        } for i, (gid, title) in enumerate(fresh)]
+        if jobs:
+            await self.data_store.add_scan_jobs(jobs)
+            self._wake.set()
+            log.info(f"[ScanQueue] Queued {len(jobs)} jobs (batch {batch_id}), skipped {len(groups) - len(jobs)} already queued.")
+        return jobs
+
+    async def cancel(self, group_id: int = None):
+        """Membatalkan job antre/berjalan untuk `group_id`, atau semuanya jika None; mengembalikan jumlah job."""
+        cancelled = 0
+        for job in await self.data_store.get_scan_jobs((QUEUED, RUNNING)):
+            if group_id is not None and job['group_id'] != group_id:
+                continue
+            if self.current is not None and self.current['job_id'] == job['job_id']:
+                self._cancel_requested = job['job_id']
+                self._current_task.cancel()
+            else:
+                await self.data_store.update_scan_job(job['job_id'], {'state': CANCELLED, 'updated_at': time.time()})
+            cancelled += 1
+        return cancelled
+
+    async def status(self, recent: int = 10):
+        """(job berjalan, job antre, job selesai terbaru)."""
+        jobs = await self.data_store.get_scan_jobs()
+        queued = [job for job in jobs if job['state'] == QUEUED]
+        finished = sorted((job for job in jobs if job['state'] in FINISHED_STATES), key=lambda job: job['updated_at'], reverse=True)
+        return self.current, queued, finished[:recent]
+
+    async def _requeue_stale(self):
+        # Heartbeat yang terlewat beberapa kali berarti pemiliknya sudah mati.
+        stale_before = time.time() - 3 * self.heartbeat_interval
+        for job in await self.data_store.requeue_stale_scan_jobs(RUNNING, stale_before, {'state': QUEUED, 'owner': None, 'updated_at': time.time()}):
+            log.info(f"[ScanQueue] Resuming interrupted scan of {job['group_id']}.")
+
+    async def _next_job(self):
+        while True:
+            self._wake.clear()
+            await self._requeue_stale()
+            now = time.time()
+            job = await self.data_store.claim_scan_job(QUEUED, {'state': RUNNING, 'owner': self.owner, 'heartbeat': now, 'started_at': now, 'updated_at': now})
+            if job is not None:
+                return job
+            # Job dari instance lain tidak membangunkan worker ini, jadi antrean juga dicek berkala.
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.heartbeat_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _heartbeat(self, job):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                owned = await self.data_store.update_scan_job(job['job_id'], {'heartbeat': time.time()}, {'state': RUNNING, 'owner': self.owner})
+            except Exception as e:
+                log.warning(f"❗️ [ScanQueue] Heartbeat for {job['group_id']} failed: {e}")
+                continue
+            if not owned:
+                # Dibatalkan lewat /scancancel di instance lain (atau diambil alih setelah basi).
+                log.info(f"[ScanQueue] Job for {job['group_id']} is no longer owned by this instance, stopping it.")
+                self._cancel_requested = job['job_id']
+                self._current_task.cancel()
+                return
+
+    async def _run_one(self, job):
+        self.current = job
+        self._current_task = asyncio.ensure_future(self.run_job(job))
+        heartbeat = asyncio.ensure_future(self._heartbeat(job))
+        fields = {}
+        try:
+            fields['state'] = DONE if await self._current_task else FAILED
+        except asyncio.CancelledError:
+            if self._cancel_requested != job['job_id']:
+                # Worker sendiri yang dihentikan (shutdown): job tetap `running` dan diambil lagi setelah heartbeat basi.
+                raise
+            fields['state'] = CANCELLED
+        except Exception as e:
+            log.error(f"❗️ [ScanQueue] Job for {job['group_id']} crashed: {e}")
+            fields.update(state=FAILED, error=str(e))
+        finally:
+            heartbeat.cancel()
+            self.current, self._current_task, self._cancel_requested = None, None, None
+        fields['updated_at'] = time.time()
+        # Bersyarat: job yang sudah dibatalkan atau diambil alih instance lain tidak ditimpa.
+        await self.data_store.update_scan_job(job['job_id'], fields, {'state': RUNNING, 'owner': self.owner})
+        log.info(f"[ScanQueue] Job for {job['group_id']} finished: {fields['state']}.")
+        if self.on_batch_finished is not None and not await self.data_store.get_scan_jobs((QUEUED, RUNNING), batch_id=job['batch_id']):
+            await self.on_batch_finished(await self.data_store.get_scan_jobs(batch_id=job['batch_id']))
+
+    async def _run(self):
+        while True:
+            try:
+                await self._run_one(await self._next_job())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"❗️ [ScanQueue] Worker error: {e}")
+            await asyncio.sleep(self.pause_between)
@@ -0,0 +1,621 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from data_store import GLOBAL_STATS_SCOPE, SCAN_CHECKPOINT_FIELDS, STATS_FIELDS, DataStore, compact_history, normalize_entry
+from dialog_snapshot import normalize_group_id
+from metrics import observe_bulk_write
+from log import get_logger
+
+log = get_logger('db')
+
+# Kolom ID tetap TEXT agar database lama tidak perlu dibangun ulang: ID int yang di-bind
+# disimpan dan dibandingkan sebagai teks lewat affinity kolom, lalu dikembalikan ke int saat dibaca.
+SCHEMA = [
+    ('users', "CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, current TEXT NOT NULL)"),
+    ('history', "CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, entry TEXT NOT NULL)"),
+    ('history_user', "CREATE INDEX IF NOT EXISTS history_user ON history (user_id, id)"),
+    ('history_archive', "CREATE TABLE IF NOT EXISTS history_archive (id INTEGER PRIMARY KEY, user_id TEXT NOT NULL, timestamp INTEGER NOT NULL, entry TEXT NOT NULL)"),
+    ('history_archive_user', "CREATE INDEX IF NOT EXISTS history_archive_user ON history_archive (user_id, timestamp)"),
+    ('memberships', "CREATE TABLE IF NOT EXISTS memberships (user_id TEXT NOT NULL, group_id TEXT NOT NULL, first_seen INTEGER NOT NULL, last_seen INTEGER NOT NULL, PRIMARY KEY (user_id, group_id))"),
+    ('memberships_group_user', "CREATE INDEX IF NOT EXISTS memberships_group_user ON memberships (group_id, user_id)"),
+    ('scan_status', "CREATE TABLE IF NOT EXISTS scan_status (group_id TEXT PRIMARY KEY, completed INTEGER NOT NULL DEFAULT 0, completed_at INTEGER, data TEXT NOT NULL DEFAULT '{}')"),
+    ('scan_status_completed', "CREATE INDEX IF NOT EXISTS scan_status_completed ON scan_status (completed) WHERE completed = 1"),
+    ('chat_titles', "CREATE TABLE IF NOT EXISTS chat_titles (group_id TEXT PRIMARY KEY, title TEXT NOT NULL, updated_at REAL NOT NULL)"),
+    ('jobs', "CREATE TABLE IF NOT EXISTS jobs (name TEXT PRIMARY KEY, data TEXT NOT NULL)"),
+    ('scan_jobs', "CREATE TABLE IF NOT EXISTS scan_jobs (job_id TEXT PRIMARY KEY, state TEXT NOT NULL, batch_id TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, data TEXT NOT NULL)"),
+    ('scan_jobs_state_created', "CREATE INDEX IF NOT EXISTS scan_jobs_state_created ON scan_jobs (state, created_at)"),
+    ('cache_changes', "CREATE TABLE IF NOT EXISTS cache_changes (version INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, kind TEXT NOT NULL, op TEXT NOT NULL, key TEXT, value TEXT, at REAL NOT NULL)"),
+    ('cache_changes_at', "CREATE INDEX IF NOT EXISTS cache_changes_at ON cache_changes (at)"),
+    ('stats', "CREATE TABLE IF NOT EXISTS stats (scope TEXT PRIMARY KEY, users INTEGER NOT NULL DEFAULT 0, members INTEGER NOT NULL DEFAULT 0, "
+              "identity_changes INTEGER NOT NULL DEFAULT 0, memberships INTEGER NOT NULL DEFAULT 0, last_activity INTEGER)"),
+]
+
+
+class SQLiteDataStore(DataStore):
+    """Backend tertanam (SQLite, mode WAL) untuk deployment kecil, CI dan benchmark tanpa MongoDB.
+
+    Semua akses database berjalan di satu thread lewat ThreadPoolExecutor,
+    sehingga event loop tidak pernah terblokir oleh I/O disk.
+    """
+
+    def __init__(self, path: str, cache_size: int = 50000, cache_ttl: float = 3600, membership_touch_interval: float = 3600, history_limit: int = 20, cache_max_bytes: int = 0):
+        super().__init__(cache_size, cache_ttl, membership_touch_interval, history_limit, cache_max_bytes)
+        log.info("🗄️ [SQLiteDataStore] Initializing...")
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-store')
+        self._conn = None
+        self._executor.submit(self._connect).result()
+        log.info(f"✅ [SQLiteDataStore] Opened '{path}' (WAL mode).")
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for _, statement in SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _existing_tables(self):
+        rows = self._conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')").fetchall()
+        return {row[0] for row in rows}
+
+    async def ensure_indexes(self):
+        # Skema sudah dibuat saat koneksi dibuka; di sini hanya melaporkan apa yang ada.
+        existing = await self._run(self._existing_tables)
+        missing = [name for name, _ in SCHEMA if name not in existing]
+        if missing:
+            log.warning(f"[DB Index] ❗️ Missing SQLite objects: {missing}")
+        else:
+            log.info("✅ [DB Index] All indexes already present.")
+        return []
+
+    async def close(self):
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+
+    # --- Riwayat user ---
+
+    def _fetch_last_entries_sync(self, user_ids):
+        last_entries = {}
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for user_id, current in self._conn.execute(f"SELECT user_id, current FROM users WHERE user_id IN ({placeholders})", chunk):
+                last_entries[int(user_id)] = json.loads(current)
+        return last_entries
+
+    async def _fetch_last_entries(self, user_ids: list):
+        return await self._run(self._fetch_last_entries_sync, list(user_ids))
+
+    def _fetch_history_sync(self, user_id):
+        rows = self._conn.execute("SELECT entry FROM history WHERE user_id = ? ORDER BY id", (user_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    async def _fetch_history(self, user_id: int):
+        return await self._run(self._fetch_history_sync, user_id)
+
+    def _write_stats_sync(self, stats, now):
+        """Menerapkan increment counter (lihat add_stat); dipanggil di dalam transaksi penulis."""
+        if not stats:
+            return
+        self._conn.executemany(
+            f"INSERT INTO stats (scope, {', '.join(STATS_FIELDS)}, last_activity) VALUES (?, {', '.join('?' * len(STATS_FIELDS))}, ?) "
+            f"ON CONFLICT(scope) DO UPDATE SET {', '.join(f'{field} = {field} + excluded.{field}' for field in STATS_FIELDS)}, "
+            "last_activity = MAX(COALESCE(last_activity, 0), excluded.last_activity)",
+            [(scope, *(counters.get(field, 0) for field in STATS_FIELDS), now) for scope, counters in stats.items()]
+        )
+
+    def _write_entry_sync(self, user_id, new_entry, is_update, stats):
+        entry_json = json.dumps(new_entry)
+        with self._conn:
+            if is_update:
+                self._conn.execute("DELETE FROM history WHERE id = (SELECT MAX(id) FROM history WHERE user_id = ?)", (user_id,))
+            self._conn.execute("INSERT INTO history (user_id, entry) VALUES (?, ?)", (user_id, entry_json))
+            self._conn.execute("INSERT INTO users (user_id, current) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET current = excluded.current", (user_id, entry_json))
+            self._archive_overflow_sync([user_id])
+            self._write_stats_sync(stats, int(time.time()))
+
+    async def _write_entry(self, user_id: int, new_entry: dict, is_update: bool, stats: dict = None):
+        await self._run(self._write_entry_sync, user_id, new_entry, is_update, stats)
+
+    def _archive_overflow_sync(self, user_ids):
+        """Memindahkan entri di luar `history_limit` terbaru ke history_archive (dipanggil di dalam transaksi penulis)."""
+        overflow = []
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            overflow.extend(self._conn.execute(
+                "SELECT id, user_id, entry FROM (SELECT id, user_id, entry, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id DESC) AS rn "
+                f"FROM history WHERE user_id IN ({','.join('?' * len(chunk))})) WHERE rn > ?",
+                (*chunk, self.history_limit)
+            ))
+        if not overflow:
+            return
+        self._conn.executemany(
+            "INSERT INTO history_archive (user_id, timestamp, entry) VALUES (?, ?, ?)",
+            [(user_id, json.loads(entry).get('timestamp', 0), entry) for _, user_id, entry in overflow]
+        )
+        self._conn.executemany("DELETE FROM history WHERE id = ?", [(row_id,) for row_id, _, _ in overflow])
+
+    def _write_history_entries_sync(self, new_entries, stats):
+        rows = [(user_id, json.dumps(entry)) for user_id, entry in new_entries.items()]
+        with self._conn:
+            self._conn.executemany("INSERT INTO history (user_id, entry) VALUES (?, ?)", rows)
+            self._conn.executemany("INSERT INTO users (user_id, current) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET current = excluded.current", rows)
+            self._archive_overflow_sync(list(new_entries))
+            self._write_stats_sync(stats, int(time.time()))
+        return len(rows)
+
+    async def _write_history_entries(self, new_entries: dict, stats: dict = None):
+        saved = await self._run(self._write_history_entries_sync, new_entries, stats)
+        observe_bulk_write('users', len(new_entries), saved)
+        return saved
+
+    @staticmethod
+    def _export_filter(since, until):
+        # Filter rentang waktu: user yang punya entri riwayat (inline atau arsip) dengan timestamp di [since, until).
+        inline, archived, params = [], [], []
+        if since is not None:
+            inline.append("json_extract(h.entry, '$.timestamp') >= ?")
+            archived.append("a.timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            inline.append("json_extract(h.entry, '$.timestamp') < ?")
+            archived.append("a.timestamp < ?")
+            params.append(until)
+        if not inline:
+            return "", []
+        return (f" AND (EXISTS (SELECT 1 FROM history h WHERE h.user_id = users.user_id AND {' AND '.join(inline)})"
+                f" OR EXISTS (SELECT 1 FROM history_archive a WHERE a.user_id = users.user_id AND {' AND '.join(archived)}))"), params * 2
+
+    def _attach_history_sync(self, rows):
+        docs = {int(user_id): {'user_id': int(user_id), 'current': json.loads(current), 'history': []} for user_id, current in rows}
+        if docs:
+            placeholders = ','.join('?' * len(docs))
+            for user_id, entry in self._conn.execute(
+                f"SELECT user_id, entry FROM (SELECT user_id, entry, 0 AS part, timestamp AS k FROM history_archive WHERE user_id IN ({placeholders}) "
+                f"UNION ALL SELECT user_id, entry, 1, id FROM history WHERE user_id IN ({placeholders})) ORDER BY part, k",
+                [*docs, *docs]
+            ):
+                docs[int(user_id)]['history'].append(json.loads(entry))
+        return list(docs.values())
+
+    def _user_documents_page_sync(self, after, since, until, limit):
+        time_filter, params = self._export_filter(since, until)
+        rows = self._conn.execute(
+            f"SELECT user_id, current FROM users WHERE user_id > ?{time_filter} ORDER BY user_id LIMIT ?",
+            (after, *params, limit)
+        ).fetchall()
+        return self._attach_history_sync(rows)
+
+    async def iter_user_documents(self, since: int = None, until: int = None, batch_size: int = 1000):
+        # Keyset pagination seperti iter_group_members: memori tetap konstan.
+        last_user_id = ''
+        while True:
+            page = await self._run(self._user_documents_page_sync, last_user_id, since, until, batch_size)
+            if not page:
+                return
+            yield page
+            if len(page) < batch_size:
+                return
+            last_user_id = page[-1]['user_id']
+
+    def _get_user_documents_sync(self, user_ids, since, until):
+        time_filter, params = self._export_filter(since, until)
+        docs = []
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT user_id, current FROM users WHERE user_id IN ({placeholders}){time_filter} ORDER BY user_id",
+                (*chunk, *params)
+            ).fetchall()
+            docs.extend(self._attach_history_sync(rows))
+        return docs
+
+    async def get_user_documents(self, user_ids: list, since: int = None, until: int = None):
+        return await self._run(self._get_user_documents_sync, list(user_ids), since, until)
+
+    async def count_archived_history(self, user_id: int, before: int):
+        return await self._run(lambda: self._conn.execute(
+            "SELECT COUNT(*) FROM history_archive WHERE user_id = ? AND timestamp < ?", (user_id, before)
+        ).fetchone()[0])
+
+    async def get_archived_history(self, user_id: int, before: int, offset: int = 0, limit: int = 30):
+        rows = await self._run(lambda: self._conn.execute(
+            "SELECT entry FROM history_archive WHERE user_id = ? AND timestamp < ? ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+            (user_id, before, limit, offset)
+        ).fetchall())
+        return [json.loads(row[0]) for row in rows]
+
+    async def get_total_user_count(self):
+        return await self._run(lambda: self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0])
+
+    async def get_stats(self, scope: str = GLOBAL_STATS_SCOPE):
+        row = await self._run(lambda: self._conn.execute(
+            f"SELECT {', '.join(STATS_FIELDS)}, last_activity FROM stats WHERE scope = ?", (scope,)
+        ).fetchone())
+        return dict(zip((*STATS_FIELDS, 'last_activity'), row)) if row else {}
+
+    def _rebuild_stats_sync(self):
+        with self._conn:
+            groups = self._conn.execute(
+                "INSERT INTO stats (scope, members, last_activity) SELECT group_id, COUNT(*), MAX(last_seen) FROM memberships WHERE true GROUP BY group_id "
+                "ON CONFLICT(scope) DO UPDATE SET members = excluded.members, last_activity = MAX(COALESCE(last_activity, 0), excluded.last_activity)"
+            ).rowcount
+            # Grup yang tidak lagi punya keanggotaan sama sekali.
+            self._conn.execute(
+                "UPDATE stats SET members = 0 WHERE scope != ? AND scope NOT IN (SELECT DISTINCT group_id FROM memberships)", (GLOBAL_STATS_SCOPE,)
+            )
+            # Riwayat inline dan arsip tidak tumpang tindih di SQLite, jadi cukup dijumlahkan.
+            users, entries, memberships, last_seen = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM history) + (SELECT COUNT(*) FROM history_archive), "
+                "(SELECT COUNT(*) FROM memberships), (SELECT MAX(last_seen) FROM memberships)"
+            ).fetchone()
+            self._conn.execute(
+                "INSERT INTO stats (scope, users, identity_changes, memberships, last_activity) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(scope) DO UPDATE SET users = excluded.users, identity_changes = excluded.identity_changes, memberships = excluded.memberships, "
+                "last_activity = MAX(COALESCE(last_activity, 0), COALESCE(excluded.last_activity, 0))",
+                (GLOBAL_STATS_SCOPE, users, max(entries - users, 0), memberships, last_seen)
+            )
+        return groups + 1
+
+    async def rebuild_stats(self):
+        return await self._run(self._rebuild_stats_sync)
+
+    # --- Pemeliharaan ---
+
+    async def get_job_checkpoint(self, job: str):
+        row = await self._run(lambda: self._conn.execute("SELECT data FROM jobs WHERE name = ?", (job,)).fetchone())
+        return json.loads(row[0]) if row else {}
+
+    async def save_job_checkpoint(self, job: str, checkpoint: dict):
+        def save():
+            with self._conn:
+                self._conn.execute(
+                    "INSERT INTO jobs (name, data) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET data = excluded.data",
+                    (job, json.dumps(checkpoint))
+                )
+        await self._run(save)
+
+    def _normalize_group_ids_sync(self):
+        merges = {
+            'scan_status': ("INSERT INTO scan_status (group_id, completed, completed_at, data) SELECT ?, completed, completed_at, data FROM scan_status WHERE rowid = ? "
+                            "ON CONFLICT(group_id) DO UPDATE SET completed = MAX(completed, excluded.completed), completed_at = COALESCE(MAX(completed_at, excluded.completed_at), completed_at, excluded.completed_at)"),
+            'memberships': ("INSERT INTO memberships (group_id, user_id, first_seen, last_seen) SELECT ?, user_id, first_seen, last_seen FROM memberships WHERE rowid = ? "
+                            "ON CONFLICT(user_id, group_id) DO UPDATE SET first_seen = MIN(first_seen, excluded.first_seen), last_seen = MAX(last_seen, excluded.last_seen)"),
+            'chat_titles': "INSERT OR IGNORE INTO chat_titles (group_id, title, updated_at) SELECT ?, title, updated_at FROM chat_titles WHERE rowid = ?",
+        }
+        changed = 0
+        with self._conn:
+            for table, merge in merges.items():
+                # ID bertanda (negatif) sudah kanonik, termasuk grup biasa tanpa -100.
+                rows = self._conn.execute(f"SELECT rowid, group_id FROM {table} WHERE group_id NOT LIKE '-%'").fetchall()
+                for rowid, group_id in rows:
+                    self._conn.execute(merge, (normalize_group_id(group_id), rowid))
+                    self._conn.execute(f"DELETE FROM {table} WHERE rowid = ?", (rowid,))
+                changed += len(rows)
+        return changed
+
+    async def normalize_group_ids(self):
+        changed = await self._run(self._normalize_group_ids_sync)
+        if changed:
+            log.info(f"[DB Compact] Normalized {changed} group IDs.")
+        return changed
+
+    # Kolom JSON yang bisa berisi daftar grup lama berbentuk string.
+    _ENTRY_COLUMNS = (('history', 'entry'), ('history_archive', 'entry'), ('users', 'current'))
+
+    def _migrate_entries_sync(self, table, column, after, batch_size):
+        rows = self._conn.execute(f"SELECT rowid, {column} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, batch_size)).fetchall()
+        updates = []
+        for rowid, raw in rows:
+            entry = json.loads(raw)
+            normalized = normalize_entry(entry)
+            if normalized != entry:
+                updates.append((json.dumps(normalized), rowid))
+        with self._conn:
+            self._conn.executemany(f"UPDATE {table} SET {column} = ? WHERE rowid = ?", updates)
+        return (rows[-1][0] if rows else None), len(updates)
+
+    async def migrate_int_ids(self, batch_size: int = 1000):
+        checkpoint = await self.get_job_checkpoint('int_ids')
+        if checkpoint.get('done'):
+            return 0
+        migrated = await self.normalize_group_ids()
+        tables = [table for table, _ in self._ENTRY_COLUMNS]
+        start = tables.index(checkpoint['table']) if checkpoint.get('table') in tables else 0
+        for table, column in self._ENTRY_COLUMNS[start:]:
+            after = checkpoint.get('after', 0) if table == checkpoint.get('table') else 0
+            while True:
+                after_next, changed = await self._run(self._migrate_entries_sync, table, column, after, batch_size)
+                if after_next is None:
+                    break
+                after, migrated = after_next, migrated + changed
+                await self.save_job_checkpoint('int_ids', {'table': table, 'after': after})
+        await self.save_job_checkpoint('int_ids', {'done': True})
+        if migrated:
+            log.info(f"[DB Migrate] Normalized {migrated} rows to int64 IDs.")
+        return migrated
+
+    def _compact_histories_after_sync(self, after_user_id, batch_size):
+        user_ids = [int(row[0]) for row in self._conn.execute(
+            "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", ('' if after_user_id is None else after_user_id, batch_size)
+        )]
+        if not user_ids:
+            return None, 0, []
+        histories = {uid: [] for uid in user_ids}
+        archived = {uid: 0 for uid in user_ids}
+        placeholders = ','.join('?' * len(user_ids))
+        # Arsip ikut dirapikan: entri arsip (lebih tua) lebih dulu, lalu riwayat inline.
+        for user_id, entry, part in self._conn.execute(
+            f"SELECT user_id, entry, part FROM (SELECT user_id, entry, 0 AS part, timestamp AS k, id FROM history_archive WHERE user_id IN ({placeholders}) "
+            f"UNION ALL SELECT user_id, entry, 1, id, id FROM history WHERE user_id IN ({placeholders})) ORDER BY part, k, id",
+            [*user_ids, *user_ids]
+        ):
+            histories[int(user_id)].append(json.loads(entry))
+            archived[int(user_id)] += part == 0
+        changed_ids = []
+        # Satu transaksi di thread database yang sama dengan tulisan live, jadi tidak ada yang tertimpa.
+        with self._conn:
+            for user_id, history in histories.items():
+                compacted = compact_history(history)
+                if compacted == history and len(history) - archived[user_id] <= self.history_limit:
+                    continue
+                kept, overflow = compacted[-self.history_limit:], compacted[:-self.history_limit]
+                self._conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+                self._conn.execute("DELETE FROM history_archive WHERE user_id = ?", (user_id,))
+                self._conn.executemany("INSERT INTO history (user_id, entry) VALUES (?, ?)", [(user_id, json.dumps(entry)) for entry in kept])
+                self._conn.executemany(
+                    "INSERT INTO history_archive (user_id, timestamp, entry) VALUES (?, ?, ?)",
+                    [(user_id, entry.get('timestamp', 0), json.dumps(entry)) for entry in overflow]
+                )
+                current = {k: v for k, v in kept[-1].items() if k != 'active_chats_snapshot'}
+                self._conn.execute("UPDATE users SET current = ? WHERE user_id = ?", (json.dumps(current), user_id))
+                changed_ids.append(user_id)
+        return user_ids[-1], len(user_ids), changed_ids
+
+    async def _compact_histories_after(self, after_user_id: int, batch_size: int):
+        last_user_id, scanned, changed_ids = await self._run(self._compact_histories_after_sync, after_user_id, batch_size)
+        if changed_ids:
+            observe_bulk_write('users', len(changed_ids), 0, len(changed_ids))
+        # Arsip SQLite hanya berisi entri yang tergeser, jadi tidak pernah perlu backfill.
+        return last_user_id, scanned, changed_ids, 0
+
+    # --- Keanggotaan grup ---
+
+    def _write_memberships_sync(self, pairs, now):
+        with self._conn:
+            # Per baris agar keanggotaan yang benar-benar baru diketahui untuk counter members.
+            new_pairs = [
+                (user_id, group_id) for user_id, group_id in pairs
+                if self._conn.execute(
+                    "INSERT OR IGNORE INTO memberships (user_id, group_id, first_seen, last_seen) VALUES (?, ?, ?, ?)", (user_id, group_id, now, now)
+                ).rowcount
+            ]
+            self._conn.executemany(
+                "UPDATE memberships SET last_seen = MAX(last_seen, ?) WHERE user_id = ? AND group_id = ?",
+                [(now, user_id, group_id) for user_id, group_id in pairs]
+            )
+            self._write_stats_sync(self._membership_stats(pairs, new_pairs), now)
+        return len(new_pairs)
+
+    async def _write_memberships(self, pairs: list, now: int):
+        inserted = await self._run(self._write_memberships_sync, pairs, now)
+        observe_bulk_write('memberships', len(pairs), inserted, len(pairs) - inserted)
+        return inserted
+
+    async def get_user_groups(self, user_id: int):
+        rows = await self._run(lambda: self._conn.execute("SELECT group_id FROM memberships WHERE user_id = ? ORDER BY last_seen DESC", (user_id,)).fetchall())
+        return [int(row[0]) for row in rows]
+
+    async def iter_group_members(self, group_id: int, page_size: int = 200):
+        # Keyset pagination: satu halaman per query, memori tetap konstan.
+        last_user_id = ''
+        while True:
+            rows = await self._run(lambda after=last_user_id: self._conn.execute(
+                "SELECT user_id FROM memberships WHERE group_id = ? AND user_id > ? ORDER BY user_id LIMIT ?",
+                (group_id, after, page_size)
+            ).fetchall())
+            if not rows:
+                return
+            page = [int(row[0]) for row in rows]
+            yield page
+            if len(page) < page_size:
+                return
+            last_user_id = page[-1]
+
+    # --- Status scan ---
+
+    def _get_scan_status_sync(self, group_id):
+        row = self._conn.execute("SELECT completed, completed_at, data FROM scan_status WHERE group_id = ?", (group_id,)).fetchone()
+        if not row:
+            return {}
+        status = {'group_id': group_id, **json.loads(row[2]), 'completed': bool(row[0])}
+        if row[1] is not None:
+            status['completed_at'] = row[1]
+        return status
+
+    async def get_scan_status(self, group_id: int):
+        return await self._run(self._get_scan_status_sync, group_id)
+
+    def _set_completed_sync(self, group_id, completed, completed_at=None):
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO scan_status (group_id, completed, completed_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(group_id) DO UPDATE SET completed = excluded.completed, completed_at = COALESCE(excluded.completed_at, completed_at)",
+                (group_id, int(completed), completed_at)
+            )
+
+    async def get_completed_scan_ids(self):
+        rows = await self._run(lambda: self._conn.execute("SELECT group_id FROM scan_status WHERE completed = 1").fetchall())
+        return {int(row[0]) for row in rows}
+
+    async def mark_scan_as_completed(self, group_id: int):
+        await self._run(self._set_completed_sync, group_id, True, int(time.time()))
+
+    async def add_completed_scan_id(self, group_id: int):
+        # Grup manual tidak pernah discan penuh, jadi tidak diberi completed_at.
+        await self._run(self._set_completed_sync, group_id, True)
+
+    async def get_scan_completion_times(self):
+        rows = await self._run(lambda: self._conn.execute("SELECT group_id, completed_at FROM scan_status WHERE completed = 1 AND completed_at IS NOT NULL").fetchall())
+        return {int(gid): completed_at for gid, completed_at in rows}
+
+    def _update_scan_status_sync(self, group_id, status_doc):
+        current = self._get_scan_status_sync(group_id)
+        data = {k: v for k, v in current.items() if k not in ('group_id', 'completed', 'completed_at')}
+        if not status_doc:
+            if not current:
+                return
+            for field in SCAN_CHECKPOINT_FIELDS:
+                data.pop(field, None)
+        else:
+            data.update({k: v for k, v in status_doc.items() if k not in ('group_id', 'completed', 'completed_at')})
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO scan_status (group_id, data) VALUES (?, ?) ON CONFLICT(group_id) DO UPDATE SET data = excluded.data",
+                (group_id, json.dumps(data))
+            )
+        if 'completed' in (status_doc or {}):
+            self._set_completed_sync(group_id, status_doc['completed'], status_doc.get('completed_at'))
+
+    async def update_scan_status(self, group_id: int, status_doc: dict):
+        await self._run(self._update_scan_status_sync, group_id, status_doc)
+
+    async def clear_scan_record(self, group_id: int):
+        def clear():
+            with self._conn:
+                self._conn.execute("UPDATE scan_status SET completed = 0 WHERE group_id = ?", (group_id,))
+        await self._run(clear)
+
+    # --- Antrean scan ---
+
+    async def add_scan_jobs(self, jobs: list):
+        def add():
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO scan_jobs (job_id, state, batch_id, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(job['job_id'], job['state'], job.get('batch_id'), job['created_at'], job['updated_at'], json.dumps(job)) for job in jobs]
+                )
+        await self._run(add)
+
+    async def get_scan_jobs(self, states: tuple = None, batch_id: str = None, limit: int = 0):
+        clauses, params = [], []
+        if states:
+            clauses.append(f"state IN ({','.join('?' * len(states))})")
+            params.extend(states)
+        if batch_id:
+            clauses.append("batch_id = ?")
+            params.append(batch_id)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = await self._run(lambda: self._conn.execute(
+            f"SELECT data FROM scan_jobs{where} ORDER BY created_at LIMIT ?", (*params, limit or -1)
+        ).fetchall())
+        return [json.loads(row[0]) for row in rows]
+
+    # json_patch di dalam UPDATE: baca-ubah-tulis terjadi dalam satu statement, aman antar proses.
+    _PATCH_JOB = ("UPDATE scan_jobs SET data = json_patch(data, :patch), state = COALESCE(json_extract(:patch, '$.state'), state), "
+                  "updated_at = COALESCE(json_extract(:patch, '$.updated_at'), updated_at)")
+
+    async def claim_scan_job(self, state: str, fields: dict):
+        def claim():
+            with self._conn:
+                row = self._conn.execute(
+                    f"{self._PATCH_JOB} WHERE job_id = (SELECT job_id FROM scan_jobs WHERE state = :state ORDER BY created_at LIMIT 1) "
+                    "AND state = :state RETURNING data",
+                    {'patch': json.dumps(fields), 'state': state}
+                ).fetchone()
+            return json.loads(row[0]) if row else None
+        return await self._run(claim)
+
+    def _update_scan_job_sync(self, job_id, fields, expect):
+        conditions = ''.join(f" AND json_extract(data, '$.{key}') IS :expect_{key}" for key in expect)
+        with self._conn:
+            return self._conn.execute(
+                f"{self._PATCH_JOB} WHERE job_id = :job_id{conditions}",
+                {'patch': json.dumps(fields), 'job_id': job_id, **{f'expect_{key}': value for key, value in expect.items()}}
+            ).rowcount > 0
+
+    async def update_scan_job(self, job_id: str, fields: dict, expect: dict = None):
+        return await self._run(self._update_scan_job_sync, job_id, fields, expect or {})
+
+    async def requeue_stale_scan_jobs(self, state: str, heartbeat_before: float, fields: dict):
+        def requeue():
+            with self._conn:
+                rows = self._conn.execute(
+                    f"{self._PATCH_JOB} WHERE state = :state AND COALESCE(json_extract(data, '$.heartbeat'), 0) < :before RETURNING data",
+                    {'patch': json.dumps(fields), 'state': state, 'before': heartbeat_before}
+                ).fetchall()
+            return [json.loads(row[0]) for row in rows]
+        return await self._run(requeue)
+
+    async def prune_scan_jobs(self, states: tuple, before: float):
+        def prune():
+            with self._conn:
+                return self._conn.execute(
+                    f"DELETE FROM scan_jobs WHERE state IN ({','.join('?' * len(states))}) AND updated_at < ?", (*states, before)
+                ).rowcount
+        return await self._run(prune)
+
+    # --- Sinkronisasi cache antar instance ---
+
+    async def append_cache_changes(self, origin: str, changes: list):
+        def append():
+            now = time.time()
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO cache_changes (origin, kind, op, key, value, at) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(origin, c['kind'], c['op'], json.dumps(c.get('key')), json.dumps(c.get('value')), now) for c in changes]
+                )
+                return self._get_cache_version_sync()
+        return await self._run(append)
+
+    def _get_cache_version_sync(self):
+        # sqlite_sequence tetap menyimpan versi tertinggi walaupun baris lama sudah dipangkas.
+        row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'cache_changes'").fetchone()
+        return row[0] if row else 0
+
+    async def get_cache_version(self):
+        return await self._run(self._get_cache_version_sync)
+
+    async def get_cache_changes(self, after_version: int, limit: int = 1000):
+        rows = await self._run(lambda: self._conn.execute(
+            "SELECT version, origin, kind, op, key, value, at FROM cache_changes WHERE version > ? ORDER BY version LIMIT ?", (after_version, limit)
+        ).fetchall())
+        return [
+            {'version': version, 'origin': origin, 'kind': kind, 'op': op, 'key': json.loads(key) if key is not None else None, 'value': json.loads(value), 'at': at}
+            for version, origin, kind, op, key, value, at in rows
+        ]
+
+    async def prune_cache_changes(self, before: float):
+        def prune():
+            with self._conn:
+                return self._conn.execute("DELETE FROM cache_changes WHERE at < ?", (before,)).rowcount
+        return await self._run(prune)
+
+    # --- Judul grup ---
+
+    async def load_chat_titles(self, limit: int):
+        rows = await self._run(lambda: self._conn.execute("SELECT group_id, title, updated_at FROM chat_titles ORDER BY updated_at DESC LIMIT ?", (limit,)).fetchall())
+        return [{'group_id': int(gid), 'title': title, 'updated_at': updated_at} for gid, title, updated_at in rows]
+
+    async def save_chat_titles(self, items: list):
+        def save():
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO chat_titles (group_id, title, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(group_id) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at",
+                    items
+                )
+        if not items:
+            return
+        try:
+            await self._run(save)
+        except Exception as e:
+            log.warning(f"[DB Titles] ❗️ Error saving chat titles: {e}")
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Modul bot ada di root repo (tanpa package), jadi root ditambahkan ke sys.path.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mongo_data_store  # noqa: E402
+from sqlite_data_store import SQLiteDataStore  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'test.db')
+
+
+@pytest.fixture
+def make_store(db_path):
+    """Membuat SQLiteDataStore pada file yang sama (beberapa instance = beberapa proses bot)."""
+    stores = []
+
+    def make(**options):
+        store = SQLiteDataStore(db_path, **options)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store._executor.shutdown(wait=True)
+        if store._conn is not None:
+            store._conn.close()
+
+
+
+@pytest.fixture
+def make_mongo_store(monkeypatch):
+    """Membuat MongoDataStore di atas mongomock-motor; semua instance berbagi satu database in-memory."""
+    mongomock_motor = pytest.importorskip('mongomock_motor')
+    from mongomock.collection import BulkOperationBuilder
+    # pymongo >= 4.11 mengirim argumen `sort` ke builder bulk yang belum dikenal mongomock.
+    add_update = BulkOperationBuilder.add_update
+    monkeypatch.setattr(BulkOperationBuilder, 'add_update', lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs))
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(mongo_data_store, 'AsyncIOMotorClient', lambda *args, **kwargs: client)
+
+    def make(**options):
+        return mongo_data_store.MongoDataStore(asyncio.get_running_loop(), 'mongodb://localhost', **options)
+
+    return make
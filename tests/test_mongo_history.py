@@ -0,0 +1,137 @@
+import asyncio
+
+from data_store import GLOBAL_STATS_SCOPE
+
+
+def entry(timestamp, full_name, username=None, shared_chats=()):
+    return {'timestamp': timestamp, 'full_name': full_name, 'username': username, 'shared_chats': list(shared_chats)}
+
+
+async def write_all(store, user_id, entries):
+    for e in entries:
+        await store.get_last_entry(user_id)
+        await store.save_user_data_logic(user_id, e, is_update=False)
+
+
+def test_inline_history_is_capped_and_every_entry_is_archived(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store(history_limit=3)
+        await store.ensure_indexes()
+        await write_all(store, 1, [entry(ts, f'name{ts}') for ts in range(1, 9)])
+
+        inline = await store.get_user_history(1)
+        assert [e['timestamp'] for e in inline] == [6, 7, 8]
+        # Arsip Mongo memuat semua entri, termasuk yang masih inline.
+        assert await store.history_archive.count_documents({'user_id': 1}) == 8
+        assert await store.count_archived_history(1, inline[0]['timestamp']) == 5
+        first = await store.get_archived_history(1, inline[0]['timestamp'], offset=0, limit=2)
+        second = await store.get_archived_history(1, inline[0]['timestamp'], offset=2, limit=2)
+        assert [e['timestamp'] for e in first + second] == [5, 4, 3, 2]
+    asyncio.run(scenario())
+
+
+def test_same_second_entries_are_archived_separately(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store(history_limit=1)
+        await store.ensure_indexes()
+        await write_all(store, 1, [entry(5, 'A'), entry(5, 'B'), entry(6, 'C')])
+
+        archived = await store.get_archived_history(1, 6)
+        assert sorted(e['full_name'] for e in archived) == ['A', 'B']
+    asyncio.run(scenario())
+
+
+def test_export_time_filter_matches_archived_entries(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store(history_limit=2)
+        await store.ensure_indexes()
+        await write_all(store, 1, [entry(10, 'A'), entry(20, 'B'), entry(30, 'C'), entry(40, 'D')])
+        await write_all(store, 2, [entry(35, 'X')])
+
+        pages = [page async for page in store.iter_user_documents(since=5, until=15)]
+        docs = [doc for page in pages for doc in page]
+        assert [doc['user_id'] for doc in docs] == [1]
+        assert [e['timestamp'] for e in docs[0]['history']] == [10, 20, 30, 40]
+        assert [doc['user_id'] for doc in await store.get_user_documents([1, 2], since=30)] == [1, 2]
+    asyncio.run(scenario())
+
+
+def test_legacy_history_over_limit_survives_capped_push(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store(history_limit=3)
+        await store.ensure_indexes()
+        # Dokumen dari sebelum arsip write-through: 5 entri inline (di atas batas), arsip kosong.
+        legacy = [entry(ts, f'name{ts}') for ts in range(1, 6)]
+        await store.users.insert_one({'user_id': 1, 'history': legacy, 'current': legacy[-1]})
+
+        assert await store.migrate_history_archive(batch_size=1) == 1
+        await write_all(store, 1, [entry(6, 'name6')])
+
+        inline = await store.get_user_history(1)
+        assert [e['timestamp'] for e in inline] == [4, 5, 6]
+        archived = await store.get_archived_history(1, inline[0]['timestamp'])
+        assert [e['timestamp'] for e in archived] == [3, 2, 1]
+        # Sudah selesai: run berikutnya dilewati lewat checkpoint.
+        assert await store.migrate_history_archive() == 0
+    asyncio.run(scenario())
+
+
+def test_int_id_migration_archives_whole_history_and_keeps_same_second_rows(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store(history_limit=2)
+        await store.ensure_indexes()
+        await store.users.insert_one({'user_id': '1', 'history': [entry(ts, f'name{ts}') for ts in range(1, 5)]})
+        # Arsip lama dengan dua entri berbeda di detik yang sama.
+        await store.history_archive.insert_many([
+            {'user_id': '2', 'timestamp': 7, 'entry': entry(7, 'A')},
+            {'user_id': '2', 'timestamp': 7, 'entry': entry(7, 'B')},
+        ])
+
+        await store.migrate_int_ids()
+        assert [e['timestamp'] for e in await store.get_user_history(1)] == [3, 4]
+        assert await store.history_archive.count_documents({'user_id': 1}) == 4
+        assert sorted(e['full_name'] for e in await store.get_archived_history(2, 10)) == ['A', 'B']
+        assert await store.history_archive.count_documents({'user_id': {'$type': 'string'}}) == 0
+    asyncio.run(scenario())
+
+
+def test_incremental_stats_match_rebuild(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store(history_limit=2)
+        await store.ensure_indexes()
+        # User 1 melewati batas inline: entrinya ada inline dan di arsip sekaligus.
+        await write_all(store, 1, [entry(1, 'A'), entry(2, 'B'), entry(3, 'C')])
+        await write_all(store, 2, [entry(4, 'D')])
+        await store.record_memberships([(1, -1001), (2, -1001), (2, -1002)])
+
+        incremental = {scope: await store.get_stats(scope) for scope in (GLOBAL_STATS_SCOPE, -1001, -1002)}
+        assert incremental[GLOBAL_STATS_SCOPE]['identity_changes'] == 2
+
+        await store.rebuild_stats()
+        for scope, stats in incremental.items():
+            rebuilt = await store.get_stats(scope)
+            for field in ('users', 'members', 'identity_changes', 'memberships'):
+                assert rebuilt.get(field, 0) == stats.get(field, 0), (scope, field)
+    asyncio.run(scenario())
+
+
+def test_compaction_merges_across_archive_and_inline_and_reports_backfill(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store(history_limit=2)
+        await store.ensure_indexes()
+        await write_all(store, 7, [entry(1, 'A', shared_chats=[-1001]), entry(2, 'A', shared_chats=[-1002]),
+                                   entry(3, 'B'), entry(4, 'B'), entry(5, 'C')])
+        # Dokumen lama yang riwayat inline-nya belum ada di arsip: hanya perlu backfill.
+        await store.users.insert_one({'user_id': 8, 'history': [entry(1, 'X'), entry(2, 'Y')]})
+
+        normalized, scanned, changed, backfilled = await store.run_compaction()
+        assert (scanned, changed, backfilled) == (2, 1, 1)
+        assert [e['full_name'] for e in await store.get_user_history(7)] == ['B', 'C']
+        archived = await store.get_archived_history(7, 3)
+        assert [(e['timestamp'], e['full_name']) for e in archived] == [(1, 'A')]
+        assert sorted(archived[0]['shared_chats']) == [-1002, -1001]
+        assert await store.history_archive.count_documents({'user_id': 7}) == 3
+        assert await store.history_archive.count_documents({'user_id': 8}) == 2
+
+        assert (await store.run_compaction())[2:] == (0, 0)
+    asyncio.run(scenario())
@@ -0,0 +1,20 @@
+import asyncio
+
+
+def test_memberships_migration_resumes_from_checkpoint(make_mongo_store):
+    async def scenario():
+        store = make_mongo_store()
+        await store.ensure_indexes()
+        await store.users.insert_many([
+            {'user_id': uid, 'history': [{'timestamp': uid, 'full_name': 'A', 'active_chats_snapshot': ['555', -12345]}]}
+            for uid in (1, 2, 3)
+        ] + [{'user_id': 4, 'memberships_migrated': True, 'history': [{'timestamp': 4, 'active_chats_snapshot': [-999]}]}])
+        # Run sebelumnya berhenti setelah user 1.
+        await store.save_job_checkpoint('migrate_memberships', {'after_user_id': 1})
+
+        assert await store.migrate_memberships(batch_size=1) == 2
+        assert await store.get_user_groups(1) == []
+        assert sorted(await store.get_user_groups(3)) == [-1000000000555, -12345]
+        assert await store.get_user_groups(4) == []
+        assert await store.migrate_memberships() == 0
+    asyncio.run(scenario())
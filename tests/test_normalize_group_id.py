@@ -0,0 +1,24 @@
+import pytest
+
+from dialog_snapshot import normalize_group_id
+
+
+def test_marked_channel_id_is_kept():
+    assert normalize_group_id(-1001234567890) == -1001234567890
+    assert normalize_group_id(' -1001234567890 ') == -1001234567890
+
+
+def test_bare_channel_id_gets_marked():
+    assert normalize_group_id(1234567890) == -1001234567890
+    assert normalize_group_id('1234567890') == -1001234567890
+
+
+def test_basic_group_stays_in_chat_space():
+    assert normalize_group_id(-12345) == -12345
+    assert normalize_group_id('-12345') == -12345
+    assert normalize_group_id(-12345) != normalize_group_id(12345)
+
+
+def test_non_numeric_raises_value_error():
+    with pytest.raises(ValueError):
+        normalize_group_id('abc')
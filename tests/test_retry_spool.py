@@ -0,0 +1,58 @@
+import asyncio
+
+from retry_spool import RetrySpool
+
+
+def entry(timestamp, full_name, username=None):
+    return {'timestamp': timestamp, 'full_name': full_name, 'username': username, 'shared_chats': []}
+
+
+def test_spool_survives_restart_and_replays_merged_records(make_store, tmp_path):
+    path = str(tmp_path / 'spool.bin')
+
+    async def scenario():
+        store = make_store()
+        await store.ensure_indexes()
+        spool = RetrySpool(store, path)
+        await spool.add({1: entry(1, 'old')}, [(1, -1001)])
+        await spool.add({1: entry(2, 'new'), 2: entry(3, 'other')}, [(1, -1002)])
+
+        # Proses baru: record ganda untuk user yang sama digabung saat dimuat.
+        restarted = RetrySpool(store, path)
+        assert await restarted.load() == 2
+        assert await restarted.drain() == 2
+        assert len(restarted) == 0
+        assert restarted.size_bytes() == 0
+
+        assert [e['full_name'] for e in await store.get_user_history(1)] == ['new']
+        assert sorted(await store.get_user_groups(1)) == [-1002, -1001]
+        assert [e['full_name'] for e in await store.get_user_history(2)] == ['other']
+
+        # Replay ulang tidak menambah entri untuk identitas yang sudah tersimpan.
+        await store.replay_spooled({1: entry(2, 'new')}, [])
+        assert len(await store.get_user_history(1)) == 1
+    asyncio.run(scenario())
+
+
+def test_failed_drain_keeps_records_for_the_next_attempt(make_store, tmp_path):
+    async def scenario():
+        store = make_store()
+        await store.ensure_indexes()
+        spool = RetrySpool(store, str(tmp_path / 'spool.bin'))
+        await spool.add({1: entry(1, 'A')}, [])
+
+        original = store.replay_spooled
+
+        async def failing(entries, pairs):
+            raise ConnectionError('primary stepped down')
+        store.replay_spooled = failing
+        try:
+            await spool.drain()
+        except ConnectionError:
+            pass
+        assert len(spool) == 1
+
+        store.replay_spooled = original
+        assert await spool.drain() == 1
+        assert [e['full_name'] for e in await store.get_user_history(1)] == ['A']
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from scan_queue import CANCELLED, DONE, QUEUED, RUNNING, ScanJobQueue
+
+
+def test_two_instances_never_run_the_same_job(make_store):
+    async def scenario():
+        ran = []
+
+        def worker(name):
+            async def run_job(job):
+                ran.append((name, job['group_id']))
+                await asyncio.sleep(0.05)
+                return True
+            return run_job
+
+        first = ScanJobQueue(make_store(), worker('a'), pause_between=0, heartbeat_interval=0.05)
+        second = ScanJobQueue(make_store(), worker('b'), pause_between=0, heartbeat_interval=0.05)
+        await first.enqueue([(-1001, None), (-1002, None), (-1003, None), (-1004, None)])
+        first.start()
+        second.start()
+        for _ in range(100):
+            if len(await first.data_store.get_scan_jobs((DONE,))) == 4:
+                break
+            await asyncio.sleep(0.05)
+        await first.close()
+        await second.close()
+
+        assert sorted(gid for _, gid in ran) == [-1004, -1003, -1002, -1001]
+        assert {job['state'] for job in await first.data_store.get_scan_jobs()} == {DONE}
+    asyncio.run(scenario())
+
+
+def test_only_stale_running_jobs_are_requeued(make_store):
+    async def scenario():
+        store = make_store()
+        now = time.time()
+        base = {'title': None, 'batch_id': 'x', 'created_at': now, 'updated_at': now}
+        await store.add_scan_jobs([
+            {**base, 'job_id': 'dead', 'group_id': -1001, 'state': RUNNING, 'owner': 'gone', 'heartbeat': now - 600},
+            {**base, 'job_id': 'alive', 'group_id': -1002, 'state': RUNNING, 'owner': 'other', 'heartbeat': now},
+        ])
+        ran = []
+
+        async def run_job(job):
+            ran.append(job['group_id'])
+            return True
+
+        queue = ScanJobQueue(store, run_job, pause_between=0, heartbeat_interval=30)
+        queue.start()
+        for _ in range(100):
+            if ran:
+                break
+            await asyncio.sleep(0.02)
+        await queue.close()
+
+        assert ran == [-1001]
+        states = {job['job_id']: job['state'] for job in await store.get_scan_jobs()}
+        assert states == {'dead': DONE, 'alive': RUNNING}
+    asyncio.run(scenario())
+
+
+def test_claim_is_atomic_and_finishing_requires_ownership(make_store):
+    async def scenario():
+        store = make_store()
+        now = time.time()
+        await store.add_scan_jobs([{'job_id': 'j', 'group_id': -1001, 'state': QUEUED, 'batch_id': 'x', 'created_at': now, 'updated_at': now}])
+        claims = await asyncio.gather(*[
+            store.claim_scan_job(QUEUED, {'state': RUNNING, 'owner': owner, 'heartbeat': now, 'updated_at': now})
+            for owner in ('a', 'b', 'c')
+        ])
+        winners = [job['owner'] for job in claims if job is not None]
+        assert len(winners) == 1
+
+        # Dibatalkan dari instance lain: pemilik tidak bisa menimpanya lagi.
+        await store.update_scan_job('j', {'state': CANCELLED, 'updated_at': now})
+        assert not await store.update_scan_job('j', {'state': DONE, 'updated_at': now}, {'state': RUNNING, 'owner': winners[0]})
+        assert (await store.get_scan_jobs())[0]['state'] == CANCELLED
+    asyncio.run(scenario())
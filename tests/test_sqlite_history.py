@@ -0,0 +1,105 @@
+import asyncio
+
+from data_store import GLOBAL_STATS_SCOPE
+
+
+def entry(timestamp, full_name, username=None, shared_chats=()):
+    return {'timestamp': timestamp, 'full_name': full_name, 'username': username, 'shared_chats': list(shared_chats)}
+
+
+async def write_all(store, user_id, entries):
+    for e in entries:
+        await store.get_last_entry(user_id)
+        await store.save_user_data_logic(user_id, e, is_update=False)
+
+
+def test_inline_history_is_capped_and_overflow_is_paged_from_archive(make_store):
+    async def scenario():
+        store = make_store(history_limit=3)
+        await store.ensure_indexes()
+        await write_all(store, 1, [entry(ts, f'name{ts}') for ts in range(1, 9)])
+
+        inline = await store.get_user_history(1)
+        assert [e['timestamp'] for e in inline] == [6, 7, 8]
+        assert await store.count_archived_history(1, inline[0]['timestamp']) == 5
+        first = await store.get_archived_history(1, inline[0]['timestamp'], offset=0, limit=2)
+        second = await store.get_archived_history(1, inline[0]['timestamp'], offset=2, limit=2)
+        assert [e['timestamp'] for e in first + second] == [5, 4, 3, 2]
+    asyncio.run(scenario())
+
+
+def test_compaction_merges_across_archive_and_inline(make_store):
+    async def scenario():
+        store = make_store(history_limit=2)
+        await store.ensure_indexes()
+        # Riwayat lama (sebelum dedup identitas) dengan entri beruntun yang sama persis.
+        await write_all(store, 7, [entry(1, 'A', shared_chats=[-1001]), entry(2, 'A', shared_chats=[-1002]),
+                                   entry(3, 'B'), entry(4, 'B'), entry(5, 'C')])
+        assert await store.count_archived_history(7, 10**9) == 3
+
+        normalized, scanned, changed, backfilled = await store.run_compaction()
+        assert (scanned, changed, backfilled) == (1, 1, 0)
+        assert [e['full_name'] for e in await store.get_user_history(7)] == ['B', 'C']
+        archived = await store.get_archived_history(7, 10**9)
+        assert [(e['timestamp'], e['full_name']) for e in archived] == [(1, 'A')]
+        assert archived[0]['shared_chats'] == [-1002, -1001]
+
+        # Run kedua tidak menemukan apa pun lagi.
+        assert (await store.run_compaction())[2] == 0
+    asyncio.run(scenario())
+
+
+def test_export_time_filter_matches_archived_entries(make_store):
+    async def scenario():
+        store = make_store(history_limit=2)
+        await store.ensure_indexes()
+        await write_all(store, 1, [entry(10, 'A'), entry(20, 'B'), entry(30, 'C'), entry(40, 'D')])
+        await write_all(store, 2, [entry(35, 'X')])
+
+        pages = [page async for page in store.iter_user_documents(since=5, until=15)]
+        docs = [doc for page in pages for doc in page]
+        assert [doc['user_id'] for doc in docs] == [1]
+        assert [e['timestamp'] for e in docs[0]['history']] == [10, 20, 30, 40]
+        assert [doc['user_id'] for doc in await store.get_user_documents([1, 2], since=30)] == [1, 2]
+    asyncio.run(scenario())
+
+
+def test_incremental_stats_match_rebuild(make_store):
+    async def scenario():
+        store = make_store()
+        await store.ensure_indexes()
+        await write_all(store, 1, [entry(1, 'A'), entry(2, 'B')])
+        await write_all(store, 2, [entry(3, 'C')])
+        await store.record_memberships([(1, -1001), (2, -1001), (2, -1002)])
+        await store.record_memberships([(1, -1001)])
+
+        incremental = {scope: await store.get_stats(scope) for scope in (GLOBAL_STATS_SCOPE, -1001, -1002)}
+        assert incremental[GLOBAL_STATS_SCOPE]['users'] == 2
+        assert incremental[GLOBAL_STATS_SCOPE]['identity_changes'] == 1
+        assert incremental[GLOBAL_STATS_SCOPE]['memberships'] == 3
+        assert incremental[-1001]['members'] == 2
+
+        await store.rebuild_stats()
+        for scope, stats in incremental.items():
+            rebuilt = await store.get_stats(scope)
+            for field in ('users', 'members', 'identity_changes', 'memberships'):
+                assert rebuilt.get(field, 0) == stats.get(field, 0), (scope, field)
+    asyncio.run(scenario())
+
+
+def test_int_id_migration_normalizes_legacy_string_ids(make_store):
+    async def scenario():
+        store = make_store()
+        await store.ensure_indexes()
+        legacy = '{"timestamp": 1, "full_name": "A", "username": null, "shared_chats": ["555", "-12345"]}'
+        with store._conn:
+            store._conn.execute("INSERT INTO users VALUES ('42', ?)", (legacy,))
+            store._conn.execute("INSERT INTO history (user_id, entry) VALUES ('42', ?)", (legacy,))
+            store._conn.execute("INSERT INTO memberships VALUES ('42', '555', 1, 2)")
+            store._conn.execute("INSERT INTO memberships VALUES ('42', '-1000000000555', 3, 4)")
+
+        assert await store.migrate_int_ids(batch_size=1) > 0
+        assert await store.migrate_int_ids() == 0
+        assert (await store.get_user_history(42))[0]['shared_chats'] == [-1000000000555, -12345]
+        assert await store.get_user_groups(42) == [-1000000000555]
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from log import get_logger
+
+log = get_logger('titles')
+
+
+class ChatTitleCache:
+    """Cache judul grup yang dibatasi ukurannya, disimpan lewat DataStore (MongoDB atau SQLite) dan diperbarui per TTL.
+
+    Judul yang kedaluwarsa tetap dipakai jika Telegram gagal dihubungi, jadi
+    /hisz tidak pernah menampilkan "[Inaccessible Group]" untuk grup yang
+    judulnya pernah diketahui.
+    """
+
+    def __init__(self, client, data_store, ttl: float = 86400, max_entries: int = 5000, concurrency: int = 8, on_saved=None):
+        self.client = client
+        self.data_store = data_store
+        self.on_saved = on_saved
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, chat_id: int, title: str, updated_at: float):
+        self._entries[chat_id] = (title, updated_at)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, chat_id: int, title: str, updated_at: float):
+        """Menyimpan judul yang sudah tersimpan di DB (mis. dari instance lain) tanpa menulis ulang."""
+        self._store(chat_id, title, updated_at)
+
+    async def _save(self, items: list):
+        await self.data_store.save_chat_titles(items)
+        if self.on_saved is not None:
+            await self.on_saved(items)
+
+    async def warm(self):
+        started = time.perf_counter()
+        for doc in await self.data_store.load_chat_titles(self.max_entries):
+            self._store(doc['group_id'], doc['title'], doc.get('updated_at', 0))
+        log.info(f"✅ [TitleCache] Warmed {len(self._entries)} chat titles in {time.perf_counter() - started:.2f}s.")
+
+    async def prime(self, chat_id: int, title: str):
+        """Menyimpan judul yang sudah diketahui (mis. dari scan) tanpa memanggil get_entity."""
+        await self.prime_many({chat_id: title})
+
+    async def prime_many(self, titles: dict):
+        now = time.time()
+        changed = []
+        for chat_id, title in titles.items():
+            item = self._entries.get(chat_id)
+            self._store(chat_id, title, now)
+            if not item or item[0] != title or now - item[1] > self.ttl:
+                changed.append((chat_id, title, now))
+        if changed:
+            await self._save(changed)
+
+    def peek(self, chat_id: int):
+        item = self._entries.get(chat_id)
+        return item[0] if item else None
+
+    async def _resolve(self, chat_id: int):
+        async with self._semaphore:
+            try:
+                entity = await self.client.get_entity(int(chat_id))
+            except Exception:
+                return None
+        return entity.title if hasattr(entity, 'title') else "Private Chat"
+
+    async def get_many(self, chat_ids: list):
+        """Mengembalikan {chat_id: judul}; yang belum ada/kedaluwarsa di-resolve bersamaan."""
+        now = time.time()
+        titles, to_resolve = {}, []
+        for chat_id in dict.fromkeys(chat_ids):
+            item = self._entries.get(chat_id)
+            if item:
+                self._entries.move_to_end(chat_id)
+                titles[chat_id] = item[0]
+            if not item or now - item[1] > self.ttl:
+                to_resolve.append(chat_id)
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if to_resolve:
+            resolved = await asyncio.gather(*(self._resolve(cid) for cid in to_resolve))
+            fresh = [(cid, title, now) for cid, title in zip(to_resolve, resolved) if title is not None]
+            for cid, title, updated_at in fresh:
+                self._store(cid, title, updated_at)
+                titles[cid] = title
+            if fresh:
+                await self._save(fresh)
+
+        for chat_id in chat_ids:
+            titles.setdefault(chat_id, f"[Inaccessible Group: {chat_id}]")
+        return titles
+
+    async def get(self, chat_id: int):
+        return (await self.get_many([chat_id]))[chat_id]